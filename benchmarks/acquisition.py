@@ -0,0 +1,51 @@
+"""
+Measure end-to-end scan time of the fast and conservative acquisition against
+the virtual device. Note that host-side processing time is scaled by the
+speedup as well; use low speedup to get representative numbers.
+
+Usage: python benchmarks/acquisition.py --speedup 20 --latency 0.001
+"""
+import time
+import click
+from drlcd.acquire import fastMeasurement, conservativeMeasurement, getSensor
+from drlcd.machine import machineConnection
+from drlcd.ui_common import Resolution
+
+@click.command()
+@click.option("--size", type=Resolution(), default="202x130",
+    help="Screen size in millimeters")
+@click.option("--resolution", type=Resolution(), default="40x26",
+    help="Number of samples in vertical and horizontal direction")
+@click.option("--feedrate", type=int, default=3000,
+    help="Feedrate for the measurement")
+@click.option("--speedup", type=float, default=10,
+    help="How many times faster than real time the simulation runs")
+@click.option("--latency", type=float, default=0.001,
+    help="Link latency in seconds")
+@click.option("--baudrate", type=int, default=115200,
+    help="Link baudrate")
+@click.option("--mode", type=click.Choice(["fast", "conservative", "both"]), default="both",
+    help="Acquisition mode to benchmark")
+def main(size, resolution, feedrate, speedup, latency, baudrate, mode):
+    port = f"sim:speedup={speedup},latency={latency},baudrate={baudrate},size={size[0]}x{size[1]},seed=0"
+    modes = {
+        "fast": fastMeasurement,
+        "conservative": conservativeMeasurement
+    }
+    if mode != "both":
+        modes = {mode: modes[mode]}
+    sensor = getSensor("TSL2561")
+    results = {}
+    for name, measure in modes.items():
+        with machineConnection(port) as machine:
+            machine.command("G28")
+            start = time.perf_counter()
+            measure(machine, size, resolution, sensor, feedrate)
+            machine.command("M400", timeout=40)
+            results[name] = (time.perf_counter() - start) * speedup
+    for name, duration in results.items():
+        points = resolution[0] * resolution[1]
+        print(f"{name:>12}: {duration:8.1f} s simulated scan time, {1000 * duration / points:6.2f} ms per point")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,69 @@
+"""
+Compare the original per-pixel implementation of `replacePeaks` with the
+vectorized one on synthetic measurements of various sizes.
+
+Usage: python benchmarks/replace_peaks.py
+"""
+import time
+import numpy as np
+from drlcd.image import replacePeaks
+
+SIZES = [(65, 101), (130, 202), (260, 404), (520, 808)]
+REPEATS = 3
+
+def replacePeaksLoop(arr: np.array, threshold: float, windowSize: int):
+    """
+    The original implementation of replacePeaks used as a reference.
+    """
+    result = np.copy(arr)
+    height, width = arr.shape
+
+    halfWindow = windowSize // 2
+
+    for i in range(halfWindow, height - halfWindow):
+        for j in range(halfWindow, width - halfWindow):
+            if arr[i, j] > threshold:
+                localWindow = arr[i - halfWindow: i + halfWindow + 1, j - halfWindow: j + halfWindow + 1]
+                localWindowWithoutPeak = localWindow[localWindow != arr[i, j]]
+                localAverage = np.mean(localWindowWithoutPeak)
+                result[i, j] = localAverage
+
+    return result
+
+def syntheticMeasurement(shape, rng):
+    """
+    Smooth backlight-like surface with noise and sparse sensor spikes
+    """
+    y, x = np.mgrid[0:shape[0], 0:shape[1]]
+    surface = 3000 + 400 * np.sin(x / shape[1] * 3) * np.cos(y / shape[0] * 2)
+    surface += rng.normal(0, 20, shape)
+    spikes = rng.random(shape) < 0.01
+    surface[spikes] *= rng.uniform(1.6, 3, np.count_nonzero(spikes))
+    return np.round(surface)
+
+def bestOf(fn, repeats):
+    best = None
+    for _ in range(repeats):
+        start = time.perf_counter()
+        fn()
+        duration = time.perf_counter() - start
+        best = duration if best is None else min(best, duration)
+    return best
+
+def main():
+    rng = np.random.default_rng(0)
+    print(f"{'size':>10} {'window':>6} {'loop [s]':>10} {'vector [s]':>11} {'speedup':>8}")
+    for shape in SIZES:
+        data = syntheticMeasurement(shape, rng)
+        threshold = 1.5 * np.mean(data)
+        for window in [3, 5]:
+            reference = replacePeaksLoop(data, threshold, window)
+            vectorized = replacePeaks(data, threshold, window)
+            assert np.array_equal(reference, vectorized, equal_nan=True)
+
+            loopTime = bestOf(lambda: replacePeaksLoop(data, threshold, window), REPEATS)
+            vectorTime = bestOf(lambda: replacePeaks(data, threshold, window), REPEATS)
+            print(f"{shape[0]:>4}x{shape[1]:<5} {window:>6} {loopTime:>10.4f} {vectorTime:>11.4f} {loopTime / vectorTime:>7.1f}x")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,54 @@
+"""
+Compare the transfer size and host-side parsing time of M6000 samples sent as
+text lines (parsed line by line and by `Sensor.interpretBatch`) and as binary
+frames.
+
+Usage: python benchmarks/sample_decoding.py
+"""
+import time
+import numpy as np
+from drlcd.acquire import TSL2561
+from drlcd.machine import LineFramer, encodeSampleFrame, FRAME_MAX_SAMPLES
+
+ROW_LENGTHS = [101, 202, 404, 808]
+REPEATS = 200
+
+def timeit(fn) -> float:
+    """
+    Return the best time of REPEATS calls; it is the least affected by the
+    other load of the machine
+    """
+    best = float("inf")
+    for _ in range(REPEATS):
+        start = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+def main() -> None:
+    rng = np.random.default_rng(0)
+    sensor = TSL2561()
+    print(f"{'samples':>8} {'text B':>8} {'binary B':>9} {'text ms':>8} {'batch ms':>9} {'binary ms':>10}")
+    for length in ROW_LENGTHS:
+        samples = rng.integers(0, 4000, length).tolist()
+        text = b"".join(f"{s}\n".encode() for s in samples)
+        binary = b"".join(encodeSampleFrame(samples[i:i + FRAME_MAX_SAMPLES])
+                          for i in range(0, length, FRAME_MAX_SAMPLES))
+
+        textLines = LineFramer().feed(text)
+        frames = LineFramer().feed(binary)
+
+        def parseText():
+            return np.array([sensor.interpret(l) for l in textLines])
+        def parseBatch():
+            return sensor.interpretBatch(textLines)
+        def parseBinary():
+            return sensor.interpretBatch(frames)
+
+        assert np.array_equal(parseText(), parseBatch())
+        assert np.array_equal(parseText(), parseBinary())
+        print(f"{length:>8} {len(text):>8} {len(binary):>9} {1000 * timeit(parseText):>8.3f} "
+              f"{1000 * timeit(parseBatch):>9.3f} {1000 * timeit(parseBinary):>10.3f}")
+
+if __name__ == "__main__":
+    main()
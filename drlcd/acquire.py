@@ -1,8 +1,38 @@
-from typing import Any, Callable, List, Optional, Tuple
-from .machine import machineConnection, Machine
+from itertools import groupby
+from typing import Any, Callable, Dict, List, NamedTuple, Optional, TextIO, Tuple, Union
+from .journal import MeasurementJournal
+from .averaging import CellAccumulator
+from .machine import machineConnection, Machine, ResponseItem, FRAME_MAX_SAMPLES, MARLIN_BUFSIZE, MISSED_SAMPLE
+from .storage import saveMeasurement
+from .telemetry import AcquisitionTelemetry
 from .ui_common import Resolution
+from datetime import datetime
 import click
-import json
+import math
+import numpy as np
+import os
+import queue
+import sys
+import time
+
+def decodeSampleStream(data: bytes) -> np.ndarray:
+    """
+    Decode the samples of binary M6000 frames (as returned by the machine,
+    possibly concatenated) into an array. Missed samples are NaN.
+    """
+    raw = np.frombuffer(data, dtype="<u2")
+    values = raw.astype(np.float64)
+    values[raw == MISSED_SAMPLE] = np.nan
+    return values
+
+# Channels of AS7341 in the order M5501 and M6000 report them, see
+# as7341_color_channel_t in the Adafruit AS7341 library
+AS7341_CHANNELS = ["415nm", "445nm", "480nm", "515nm", "clear0", "nir0",
+                   "555nm", "590nm", "630nm", "680nm", "clear", "nir"]
+
+# Raw readings passed to Sensor.interpretBatch - either response lines
+# (possibly with binary frames) or the bytes of binary frames
+RawReadings = Union[List[ResponseItem], bytes]
 
 class Sensor:
     @property
@@ -13,9 +43,61 @@ class Sensor:
     def index(self) -> int:
         raise NotImplementedError("Base class")
 
+    @property
+    def readTime(self) -> float:
+        """
+        Time in seconds the firmware needs to take a single reading
+        """
+        raise NotImplementedError("Base class")
+
+    @property
+    def channels(self) -> List[str]:
+        """
+        Names of the values a single reading consists of
+        """
+        raise NotImplementedError("Base class")
+
     def interpret(self, values: List[str]) -> Any:
         raise NotImplementedError("Base class")
 
+    def interpretBatch(self, readings: RawReadings) -> np.ndarray:
+        """
+        Interpret a batch of readings at once. Returns an array with a reading
+        per item of the first axis; missed samples are NaN.
+        """
+        if isinstance(readings, (bytes, bytearray)):
+            return self.interpretBinary(bytes(readings))
+        if bytes not in map(type, readings):
+            return self.interpretText(readings) # type: ignore
+        parts = [self.interpretBinary(b"".join(group)) if binary else self.interpretText(list(group)) # type: ignore
+                 for binary, group in groupby(readings, key=lambda x: isinstance(x, bytes))]
+        if len(parts) == 1:
+            return parts[0]
+        if len(parts) == 0:
+            return self.interpretText([])
+        return np.concatenate(parts)
+
+    def interpretText(self, lines: List[str]) -> np.ndarray:
+        raise NotImplementedError("Base class")
+
+    def interpretBinary(self, data: bytes) -> np.ndarray:
+        raise NotImplementedError(f"{type(self).__name__} does not support binary readings")
+
+def parseReadingLines(lines: List[str], channels: int) -> np.ndarray:
+    """
+    Parse text readings ("Data: <values>", plain values or "Missed") with given
+    number of values per line into an array in a single pass. The numbers
+    are converted by the C parser of np.loadtxt, not one by one in Python.
+    """
+    text = " ".join(lines).replace("Data:", " ")
+    text = text.replace("Missed", " ".join(["nan"] * channels))
+    values = np.loadtxt([text], dtype=np.float64, ndmin=1) if len(lines) > 0 else np.empty(0)
+    if len(values) != channels * len(lines):
+        raise ValueError(f"Expected {channels} values per reading, got {len(values)} values in {len(lines)} readings")
+    if channels == 1:
+        return values
+    return values.reshape(len(lines), channels)
+
 class TSL2561(Sensor):
     @Sensor.directCommand.getter
     def directCommand(self) -> str:
@@ -25,9 +107,25 @@ class TSL2561(Sensor):
     def index(self) -> int:
         return 0
 
+    @Sensor.readTime.getter
+    def readTime(self) -> float:
+        # 13 ms integration time configured in fw/Marlin/src/feature/drlcd/drlcd.h,
+        # the driver waits 15 ms for it
+        return 0.015
+
+    @Sensor.channels.getter
+    def channels(self) -> List[str]:
+        return ["luminosity"]
+
     def interpret(self, data: str) -> Any:
         return float(data.replace("Data:", "").strip())
 
+    def interpretText(self, lines: List[str]) -> np.ndarray:
+        return parseReadingLines(lines, 1)
+
+    def interpretBinary(self, data: bytes) -> np.ndarray:
+        return decodeSampleStream(data)
+
 class AS7625(Sensor):
     @Sensor.directCommand.getter
     def directCommand(self) -> str:
@@ -37,8 +135,24 @@ class AS7625(Sensor):
     def index(self) -> int:
         return 1
 
-    def interpret(self, values: List[str]) -> Any:
-        raise NotImplementedError("TBA")
+    @Sensor.readTime.getter
+    def readTime(self) -> float:
+        # Two integrations (ATIME = ASTEP = 100, i.e., ~28 ms) for the two
+        # halves of the channels
+        return 0.06
+
+    @Sensor.channels.getter
+    def channels(self) -> List[str]:
+        return AS7341_CHANNELS
+
+    def interpret(self, data: str) -> Any:
+        return self.interpretText([data])[0].tolist()
+
+    def interpretText(self, lines: List[str]) -> np.ndarray:
+        return parseReadingLines(lines, len(AS7341_CHANNELS))
+
+    def interpretBinary(self, data: bytes) -> np.ndarray:
+        return decodeSampleStream(data).reshape(-1, len(AS7341_CHANNELS))
 
 
 def getSensor(sensor: str) -> Sensor:
@@ -53,6 +167,274 @@ def getSensor(sensor: str) -> Sensor:
     except KeyError:
         raise RuntimeError(f"Unknown sensor {sensor}") from None
 
+class MeasurementJob(NamedTuple):
+    """
+    Parameters of a single measurement, see `measureLcd` for their meaning
+    """
+    output: str
+    size: Tuple[int, int]
+    resolution: Tuple[int, int]
+    sensor: str = "TSL2561"
+    feedrate: int = 3000
+    minFeedrate: Optional[int] = None
+    maxFeedrate: Optional[int] = None
+    fast: bool = False
+    binary: bool = False
+    autoFeedrate: bool = False
+    probeFeedrate: bool = False
+    tagged: bool = False
+    adaptive: bool = False
+    batched: bool = False
+    passes: int = 1
+    alternate: bool = False
+    varianceTarget: Optional[float] = None
+    lagCorrection: bool = False
+    coarseFactor: int = 4
+    refineFraction: float = 0.25
+    metrics: Optional[str] = None
+
+def jobFromDict(spec: Dict[str, Any]) -> MeasurementJob:
+    """
+    Build a job from a dictionary with fields of `MeasurementJob`. Size and
+    resolution can be given either as lists or as strings (e.g., "202x130").
+    """
+    spec = dict(spec)
+    for key in ["size", "resolution"]:
+        value = spec.get(key)
+        if isinstance(value, str):
+            try:
+                spec[key] = Resolution().convert(value, None, None)
+            except click.BadParameter as e:
+                raise RuntimeError(f"Invalid {key}: {e}") from None
+        elif value is not None:
+            spec[key] = tuple(value)
+    spec.setdefault("size", None)
+    spec.setdefault("resolution", None)
+    try:
+        return MeasurementJob(**spec)
+    except TypeError as e:
+        raise RuntimeError(f"Invalid job specification: {e}") from None
+
+def openJournal(job: MeasurementJob, resume: bool=False) -> Tuple[MeasurementJob, MeasurementJournal]:
+    """
+    Create the journal of a new measurement or open the journal of an
+    interrupted one. When resuming, the job parameters are taken from the
+    journal. Returns the (updated) job and the journal.
+    """
+    journalPath = job.output + ".journal"
+    if resume:
+        journal = MeasurementJournal.resume(journalPath)
+        if journal.header.get("adaptive", False):
+            raise RuntimeError("Adaptive measurements cannot be resumed")
+        job = job._replace(
+            sensor=journal.header["sensor"],
+            size=tuple(journal.header["size"]),
+            resolution=tuple(journal.header["resolution"]),
+            feedrate=journal.header.get("feedrate", job.feedrate),
+            minFeedrate=journal.header.get("minFeedrate"),
+            maxFeedrate=journal.header.get("maxFeedrate"),
+            autoFeedrate=journal.header.get("autoFeedrate", False),
+            probeFeedrate=journal.header.get("probeFeedrate", False),
+            fast=journal.header["fast"],
+            tagged=journal.header.get("tagged", False),
+            binary=journal.header.get("binary", False),
+            batched=journal.header.get("batched", False),
+            passes=journal.header.get("passes", 1),
+            alternate=journal.header.get("alternate", False),
+            varianceTarget=journal.header.get("varianceTarget"),
+            lagCorrection=journal.header.get("lagCorrection", False))
+        passInfo = f" of pass {journal.passIndex + 1}" if job.passes > 1 else ""
+        print(f"Resuming measurement from row {journal.firstMissingRow() + 1}{passInfo}")
+        return job, journal
+    if os.path.exists(journalPath):
+        raise RuntimeError(f"Journal {journalPath} of an unfinished measurement exists. Use --resume or remove it")
+    if job.size is None or job.resolution is None:
+        raise RuntimeError("Size and resolution of the measurement have to be specified")
+    if len(getSensor(job.sensor).channels) > 1 and (job.tagged or job.adaptive):
+        raise RuntimeError("Tagged and adaptive acquisition support only single-channel sensors")
+    if job.adaptive and job.passes > 1:
+        raise RuntimeError("Adaptive acquisition does not support multiple passes")
+    if job.lagCorrection and (not job.fast or job.tagged or job.adaptive or job.passes > 1):
+        raise RuntimeError("Lag correction is supported only for single-pass fast acquisition")
+    journal = MeasurementJournal.create(journalPath, {
+        "sensor": job.sensor,
+        "size": job.size,
+        "resolution": job.resolution,
+        "feedrate": job.feedrate,
+        "minFeedrate": job.minFeedrate,
+        "maxFeedrate": job.maxFeedrate,
+        "autoFeedrate": job.autoFeedrate,
+        "probeFeedrate": job.probeFeedrate,
+        "fast": job.fast,
+        "tagged": job.tagged,
+        "binary": job.binary,
+        "adaptive": job.adaptive,
+        "batched": job.batched,
+        "passes": job.passes,
+        "alternate": job.alternate,
+        "varianceTarget": job.varianceTarget,
+        "lagCorrection": job.lagCorrection,
+        "started": datetime.now().isoformat(timespec="seconds")
+    })
+    return job, journal
+
+def runMeasurement(machine: Machine, job: MeasurementJob,
+                   journal: MeasurementJournal, home: bool=True,
+                   release: bool=True, progress: Optional[TextIO]=sys.stdout) -> Dict[str, Any]:
+    """
+    Take the measurement described by the job on a connected machine, save it
+    into job.output and remove the journal. The machine is homed first unless
+    home is False (e.g., it is known to be homed already). Unless release is
+    False, the motors are disabled at the end, so the machine is no longer
+    homed. Per-row telemetry is written into job.metrics (if set) and
+    summarized into progress (if not None). With several passes, the result
+    is the per-cell mean of the passes together with the per-cell variance.
+    Returns the measurement.
+    """
+    size, resolution, feedrate = job.size, job.resolution, job.feedrate
+    measurement = {
+        "sensor": job.sensor,
+        "size": size,
+        "resolution": resolution,
+        "fast": job.fast,
+        "tagged": job.tagged,
+        "feedrate": feedrate,
+        "started": journal.header["started"]
+    }
+    if len(machine.firmware) > 0:
+        measurement["firmware"] = machine.firmware
+
+    sensor = getSensor(job.sensor)
+
+    machine.command("M17")
+    if home:
+        machine.command("G28", timeout=120)
+    machine.command(f"G0 X0 Y0 F{feedrate}")
+
+    # Rows are folded into the statistics as they are measured; on resume,
+    # the statistics are restored from the journal
+    accumulator = CellAccumulator(resolution[1], resolution[0], len(sensor.channels))
+    if journal.passState is not None:
+        accumulator.restore(journal.passState)
+    for y, values in journal.rows.items():
+        accumulator.addRow(y, values)
+
+    startRow = journal.firstMissingRow()
+    # The metrics file is closed even when the measurement fails
+    with AcquisitionTelemetry(machine, resolution, startRow, job.metrics, progress,
+            job.passes, journal.passIndex) as telemetry:
+        def onRow(y: int, values: List[Any], info: Dict[str, Any]) -> None:
+            if job.passes > 1:
+                info["pass"] = journal.passIndex
+            journal.append(y, values, info)
+            accumulator.addRow(y, values)
+            telemetry.rowFinished(y, values, info)
+
+        if job.adaptive:
+            from .adaptive import adaptiveMeasurement
+            controller = FeedrateController(feedrate, job.minFeedrate, job.maxFeedrate or feedrate)
+            grid, summary = adaptiveMeasurement(machine, size, resolution, sensor,
+                feedrate, controller, job.coarseFactor, job.refineFraction)
+            measurement["adaptive"] = {
+                "coarseFactor": job.coarseFactor,
+                "refineFraction": job.refineFraction,
+                **summary
+            }
+        else:
+            controller = None
+            if job.fast or job.tagged:
+                if job.fast and (job.autoFeedrate or job.probeFeedrate) and \
+                        "plannedFeedrate" not in journal.header:
+                    planner = FeedratePlanner(sensor)
+                    overhead = planner.measureOverhead(machine)
+                    plannedFeedrate = planner.maxFeedrate(size[0] / resolution[0])
+                    if job.probeFeedrate:
+                        plannedFeedrate = planner.calibrate(machine, size, resolution,
+                            feedrate, job.minFeedrate)
+                    print(f"Per-sample overhead {1000 * overhead:.1f} ms, scanning with feedrate {plannedFeedrate:.0f}")
+                    # A resumed measurement continues with the planned feedrate
+                    journal.updateHeader({"plannedFeedrate": plannedFeedrate})
+                plannedFeedrate = journal.header.get("plannedFeedrate")
+                if plannedFeedrate is not None:
+                    measurement["plannedFeedrate"] = plannedFeedrate
+                initialFeedrate = plannedFeedrate or feedrate
+                ceiling = job.maxFeedrate or initialFeedrate
+                floor = job.minFeedrate or min(initialFeedrate, ceiling) / 10
+                # Continue with the feedrate the interrupted measurement ended with
+                scanFeedrate = journal.rowInfo.get(startRow - 1, {}).get("feedrate", initialFeedrate)
+                controller = FeedrateController(scanFeedrate, floor, ceiling)
+            while True:
+                startRow = journal.firstMissingRow()
+                flip = job.alternate and journal.passIndex % 2 == 1
+                if job.tagged:
+                    taggedMeasurement(machine, size, resolution, sensor, feedrate,
+                        startRow=startRow, onRow=onRow, controller=controller, flip=flip)
+                elif job.fast:
+                    fastMeasurement(machine, size, resolution, sensor, feedrate,
+                        startRow=startRow, onRow=onRow, controller=controller,
+                        binary=job.binary, flip=flip)
+                else:
+                    conservativeMeasurement(machine, size, resolution, sensor, feedrate,
+                        startRow=startRow, onRow=onRow, batched=job.batched,
+                        binary=job.binary, flip=flip)
+                if journal.passIndex + 1 >= job.passes:
+                    break
+                noise = accumulator.noiseLevel()
+                if job.varianceTarget is not None and noise is not None and noise <= job.varianceTarget:
+                    print(f"Variance of the mean {noise:.3g} reached the target after {journal.passIndex + 1} passes")
+                    break
+                journal.finishPass(accumulator.state())
+            if controller is not None:
+                measurement["minFeedrate"] = controller.floor
+                measurement["maxFeedrate"] = controller.ceiling
+
+    machine.command(f"G0 X0 Y0 F{feedrate}")
+    machine.command("M400", timeout=40)
+    if release:
+        machine.command("M18")
+    measurement["finished"] = datetime.now().isoformat(timespec="seconds")
+    if job.adaptive:
+        measurement["measurements"] = grid
+    elif job.passes > 1:
+        measurement["measurements"] = accumulator.mean
+        measurement["variance"] = accumulator.variance()
+        measurement["passes"] = journal.passIndex + 1
+        measurement["alternate"] = job.alternate
+        if len(sensor.channels) > 1:
+            measurement["channels"] = sensor.channels
+    elif len(sensor.channels) > 1:
+        # Spectral measurements are stored compactly as a (rows, columns,
+        # channels) array of raw sensor counts
+        measurement["measurements"] = np.array(
+            [journal.rows[y] for y in range(resolution[1])], dtype=np.uint16)
+        measurement["channels"] = sensor.channels
+    else:
+        measurement["measurements"] = [journal.rows[y] for y in range(resolution[1])]
+    if (job.fast or job.tagged) and not job.adaptive:
+        measurement["rowFeedrates"] = [journal.rowInfo[y]["feedrate"] for y in range(resolution[1])]
+    if job.lagCorrection:
+        from .lag import correctLag, estimateLag
+        pitch = size[0] / resolution[0]
+        velocities = [f / 60 / pitch for f in measurement["rowFeedrates"]]
+        reversedRows = [rowReversed(y) for y in range(resolution[1])]
+        grid = np.asarray(measurement["measurements"], dtype=np.float64)
+        lag = estimateLag(grid, reversedRows, velocities)
+        corrected = correctLag(grid, reversedRows, velocities, lag)
+        if len(sensor.channels) > 1:
+            corrected = np.round(corrected).astype(np.uint16)
+        else:
+            corrected = corrected.tolist()
+        # The raw grid allows to audit or undo the correction
+        measurement["uncorrectedMeasurements"] = measurement["measurements"]
+        measurement["measurements"] = corrected
+        measurement["directionLag"] = lag
+        scanFeedrate = float(np.mean(measurement["rowFeedrates"]))
+        print(f"Directional lag {1000 * lag:.1f} ms ({lag * scanFeedrate / 60:.2f} mm at feedrate {scanFeedrate:.0f})")
+
+    saveMeasurement(job.output, measurement)
+    journal.remove()
+    return measurement
+
 @click.command()
 @click.argument("output", type=click.Path())
 @click.option("--port", type=str, default="/dev/ttyACM0",
@@ -62,93 +444,611 @@ def getSensor(sensor: str) -> Sensor:
 @click.option("--resolution", type=Resolution(),
     help="Number of samples in vertical and horizontal direction")
 @click.option("--sensor", type=click.Choice(["TSL2561", "AS7625"]), default="TSL2561",
-    help="Sensor used for measurement")
+    help="Sensor used for measurement (AS7625 measures all 12 AS7341 channels)")
 @click.option("--feedrate", type=int, default=3000,
     help="Feedrate for the measurement")
+@click.option("--min-feedrate", type=int, default=None,
+    help="Lowest scanning feedrate the fast acquisition can slow down to (default feedrate / 10)")
+@click.option("--max-feedrate", type=int, default=None,
+    help="Highest scanning feedrate the fast acquisition can speed up to (default feedrate)")
 @click.option("--fast", is_flag=True,
     help="Use fast acquisition method")
-def measureLcd(port, output, size, resolution, sensor, feedrate, fast) -> None:
+@click.option("--binary", is_flag=True,
+    help="Transfer the samples of the fast and batched acquisition in binary frames (requires B1 support of M6000/M6002 in the firmware)")
+@click.option("--auto-feedrate", is_flag=True,
+    help="Compute the scanning feedrate of the fast acquisition from the sample pitch and sensor timing")
+@click.option("--probe-feedrate", is_flag=True,
+    help="Verify the automatic feedrate by a short probe pass (implies --auto-feedrate)")
+@click.option("--tagged", is_flag=True,
+    help="Sample continuously and resample the position-tagged samples onto the grid")
+@click.option("--adaptive", is_flag=True,
+    help="Scan only some rows first, then the rows where interpolating them would be the least accurate")
+@click.option("--passes", type=click.IntRange(min=1), default=1,
+    help="Measure the screen this many times and store the per-cell mean and variance")
+@click.option("--alternate", is_flag=True,
+    help="Swap the scanning direction of the rows in every other pass")
+@click.option("--variance-target", type=float, default=None,
+    help="Stop the passes early once the variance of the mean (95th percentile over the cells) drops below this value")
+@click.option("--lag-correction", is_flag=True,
+    help="Estimate the shift of the samples between rows scanned in opposite directions and correct it (fast acquisition only)")
+@click.option("--batched", is_flag=True,
+    help="Measure each row of the conservative acquisition by a single command (requires M6002 in the firmware)")
+@click.option("--coarse-factor", type=click.IntRange(min=1), default=4,
+    help="The adaptive acquisition first measures every n-th row")
+@click.option("--refine-fraction", type=click.FloatRange(0, 1), default=0.25,
+    help="Fraction of the skipped rows the adaptive acquisition can measure afterwards")
+@click.option("--max-in-flight", type=click.IntRange(min=1), default=MARLIN_BUFSIZE,
+    help="Maximal number of unacknowledged commands sent to the device")
+@click.option("--resume", is_flag=True,
+    help="Resume an interrupted measurement from its journal. Size, resolution, sensor, feedrates and acquisition method are taken from the journal")
+@click.option("--daemon", type=click.Path(), default=None,
+    help="Submit the measurement to a running 'drlcd daemon' listening on this socket instead of connecting to the port")
+@click.option("--record", type=click.Path(dir_okay=False), default=None,
+    help="Record the serial session into this file; replay it via port 'replay:<file>'")
+@click.option("--metrics", type=click.Path(dir_okay=False), default=None,
+    help="Append per-row acquisition metrics into this file (JSON lines)")
+def measureLcd(port, output, size, resolution, sensor, feedrate, min_feedrate,
+               max_feedrate, fast, binary, auto_feedrate, probe_feedrate, tagged, adaptive,
+               passes, alternate, variance_target, lag_correction, batched, coarse_factor,
+               refine_fraction, max_in_flight, resume, daemon, record, metrics) -> None:
     """
-    Take and LCD measurement and save the result into a file
+    Take and LCD measurement and save the result into a file (JSON or binary
+    when the file has the .drlcd extension). Measured rows
+    are continuously saved into <output>.journal, so an interrupted measurement
+    can be resumed (except for the adaptive acquisition).
     """
-    measurement = {
-        "sensor": sensor,
-        "size": size,
-        "resolution": resolution
-    }
+    job = MeasurementJob(output, size, resolution, sensor, feedrate,
+        min_feedrate, max_feedrate, fast, binary, auto_feedrate, probe_feedrate,
+        tagged, adaptive, batched, passes, alternate, variance_target,
+        lag_correction, coarse_factor, refine_fraction,
+        os.path.abspath(metrics) if metrics is not None else None)
+    if daemon is not None:
+        if record is not None:
+            raise RuntimeError("Sessions of the daemon cannot be recorded")
+        from .daemon import submitJob
+        # The daemon has a different working directory
+        result = submitJob(daemon, job._replace(output=os.path.abspath(output)), resume)
+        print(f"Measurement saved to {result['output']} in {result['duration']:.0f} s")
+        return
+    # The journal is created once the device is connected, so a failed
+    # connection does not leave a journal behind
+    with machineConnection(port, max_in_flight, record=record) as machine:
+        job, journal = openJournal(job, resume)
+        runMeasurement(machine, job, journal)
 
-    sensor = getSensor(sensor)
 
-    with machineConnection(port) as machine:
-        machine.command("M17")
-        machine.command("G28")
-        machine.command(f"G0 X0 Y0 F{feedrate}")
+def rowReversed(y: int, flip: bool=False) -> bool:
+    """
+    Tell whether row y is scanned from right to left. Rows are scanned in a
+    snake-like pattern; flip swaps the direction of all rows.
+    """
+    return (y % 2 == 1) != flip
 
-        if fast:
-            measurements = fastMeasurement(machine, size, resolution, sensor, feedrate)
-        else:
-            measurements = conservativeMeasurement(machine, size, resolution, sensor, feedrate)
+def fastRowStart(y: int, size: Tuple[int, int], resolution: Tuple[int, int],
+                 flip: bool=False) -> Tuple[float, float, float]:
+    """
+    Return start X, end X and Y coordinate of a row scanned by the fast
+    measurement. Rows are scanned in a snake-like pattern, see `rowReversed`.
+    """
+    targetY = (y + 0.5) * size[1] / (resolution[1])
+    startX, targetX = 0, size[0]
+    if rowReversed(y, flip):
+        startX, targetX = targetX, startX
+    return startX, targetX, targetY
+
+# Called with row index, row values and a dictionary with additional
+# information about the row acquisition
+RowCallback = Callable[[int, List[Any], Dict[str, Any]], None]
 
-        machine.command(f"G0 X0 Y0 F{feedrate}")
+class FeedrateController:
+    """
+    Adapts the scanning feedrate of the fast measurement. After a row with
+    missed samples the feedrate drops (more with more misses), after
+    recoveryRows clean rows it ramps up again. The feedrate stays between
+    floor and ceiling.
+    """
+    def __init__(self, feedrate: float, floor: Optional[float]=None,
+                 ceiling: Optional[float]=None, decrease: float=0.95,
+                 increase: float=1.03, recoveryRows: int=2) -> None:
+        self.ceiling = ceiling if ceiling is not None else feedrate
+        self.floor = floor if floor is not None else min(feedrate, self.ceiling) / 10
+        self.decrease = decrease
+        self.increase = increase
+        self.recoveryRows = recoveryRows
+        self.feedrate = self._clamp(feedrate)
+        self._cleanRows = 0
+
+    def _clamp(self, feedrate: float) -> float:
+        return min(max(feedrate, self.floor), self.ceiling)
+
+    def retryFeedrate(self, attempt: int) -> float:
+        """
+        Feedrate for re-measuring missed samples in given retry attempt
+        (starting from 1). Retries do not affect the feedrate of the next rows.
+        """
+        return max(self.feedrate * self.decrease ** attempt, self.floor)
+
+    def rowFinished(self, samples: int, missed: int) -> None:
+        """
+        Update the feedrate based on the number of samples and missed samples
+        of the first scan of a row.
+        """
+        if missed > 0:
+            self._cleanRows = 0
+            missRate = missed / samples
+            self.feedrate = self._clamp(self.feedrate * max(self.decrease - missRate, 0.5))
+            return
+        self._cleanRows += 1
+        if self._cleanRows >= self.recoveryRows:
+            self._cleanRows = 0
+            self.feedrate = self._clamp(self.feedrate * self.increase)
+
+# Runs of at most this many missed samples are re-measured point by point
+POINT_RETRY_LIMIT = 2
+# Number of attempts to scan a row and to re-measure its missed samples
+ROW_ATTEMPTS = 5
+
+def scanTimeout(pitch: float, feedrate: float, sensor: Sensor, binary: bool=False) -> float:
+    """
+    Return the timeout of M6000 with given sample pitch and scanning
+    feedrate. The firmware reports a text sample as soon as it is taken, but
+    it sends a binary frame only once it is full (or at the end of the scan),
+    so there is no response for the time of scanning a whole frame.
+    """
+    # A frame holds FRAME_MAX_SAMPLES values; a multi-channel sample may span
+    # two frames, so a frame can take a partial sample more
+    samples = math.ceil(FRAME_MAX_SAMPLES / len(sensor.channels)) if binary else 1
+    return 10 + 60 * samples * pitch / feedrate
+
+def missedSegments(values: np.ndarray) -> List[Tuple[int, int]]:
+    """
+    Given samples of M6000, return half-open index ranges of consecutive
+    missed (NaN) samples.
+    """
+    missed = np.isnan(values)
+    if missed.ndim > 1:
+        missed = missed.any(axis=tuple(range(1, missed.ndim)))
+    missed = np.concatenate(([False], missed, [False]))
+    edges = np.flatnonzero(np.diff(missed.astype(np.int8)))
+    return [(int(start), int(end)) for start, end in zip(edges[::2], edges[1::2])]
+
+def segmentRetryCommands(segment: Tuple[int, int], y: int, size: Tuple[int, int],
+        resolution: Tuple[int, int], sensor: Sensor, feedrate: float,
+        scanFeedrate: float, binary: bool=False, flip: bool=False) -> List[Tuple[str, bool]]:
+    """
+    Return commands that re-measure a segment (indices in scanning order) of a
+    fast measurement row. Each command comes with a flag whether its response
+    lines are samples. Short segments are measured point by point, longer by a
+    continuous move over the segment (using binary frames if binary is set).
+    """
+    startX, targetX, targetY = fastRowStart(y, size, resolution, flip)
+    step = (targetX - startX) / resolution[0]
+    start, end = segment
+    if end - start <= POINT_RETRY_LIMIT:
+        commands = []
+        for i in range(start, end):
+            x = startX + (i + 0.5) * step
+            commands += [
+                (f"G1 X{x} Y{targetY} F{feedrate}", False),
+                ("M400", False),
+                (sensor.directCommand, True)
+            ]
+        return commands
+    return [
+        (f"G1 X{startX + start * step} Y{targetY} F{feedrate}", False),
+        (f"M6000 S{end - start} P{sensor.index} X{startX + end * step} F{scanFeedrate}" +
+            (" B1" if binary else ""), True)
+    ]
+
+# Highest scanning feedrate in mm/min the planner proposes (300 mm/s).
+# DEFAULT_MAX_FEEDRATE in fw/Marlin/Configuration.h is in mm/s (18000 mm/s),
+# so the firmware does not limit the scans in practice.
+MACHINE_MAX_FEEDRATE = 18000
+
+class FeedratePlanner:
+    """
+    Computes the fastest feedrate for the fast measurement. M6000 reports a
+    sample as missed when the sensor passes more than one sample slot while
+    taking a reading, so a reading (including per-sample overhead) has to
+    fit into the time the sensor needs to travel the sample pitch.
+    """
+    def __init__(self, sensor: Sensor, overhead: float=0.002, margin: float=0.9) -> None:
+        self.sensor = sensor
+        self.overhead = overhead
+        self.margin = margin
+
+    def maxFeedrate(self, pitch: float) -> float:
+        """
+        Return the maximal safe feedrate in mm/min for given sample pitch in mm
+        """
+        sampleTime = self.sensor.readTime + self.overhead
+        return min(self.margin * 60 * pitch / sampleTime, MACHINE_MAX_FEEDRATE)
+
+    def measureOverhead(self, machine: Machine, readings: int=20) -> float:
+        """
+        Measure the per-sample overhead on top of the sensor reading time by
+        taking a number of direct readings. Updates and returns the overhead.
+        """
         machine.command("M400", timeout=40)
-        machine.command("M18")
-    measurement["measurements"] = measurements
+        start = time.perf_counter()
+        pending = [machine.send(self.sensor.directCommand) for _ in range(readings)]
+        for p in pending:
+            p.result()
+        perReading = (time.perf_counter() - start) / readings
+        self.overhead = max(perReading - self.sensor.readTime, 0)
+        return self.overhead
 
-    with open(output, "w") as f:
-        json.dump(measurement, f)
+    def calibrate(self, machine: Machine, size: Tuple[int, int],
+                  resolution: Tuple[int, int], feedrate: float,
+                  minFeedrate: Optional[float]=None, samples: int=30,
+                  attempts: int=5) -> float:
+        """
+        Verify the planned scanning feedrate by a short probe pass in the
+        middle of the screen, lowering it until no samples are missed, but
+        not below minFeedrate (a tenth of the planned feedrate by default).
+        Returns the feedrate; raises RuntimeError when no probe pass succeeds.
+        """
+        pitch = size[0] / resolution[0]
+        samples = min(samples, resolution[0])
+        scanFeedrate = self.maxFeedrate(pitch)
+        if minFeedrate is None:
+            minFeedrate = scanFeedrate / 10
+        y = size[1] / 2
+        for _ in range(attempts):
+            machine.send(f"G1 X0 Y{y} F{feedrate}")
+            values = machine.command(f"M6000 S{samples} P{self.sensor.index} X{samples * pitch} F{scanFeedrate}",
+                scanTimeout(pitch, scanFeedrate, self.sensor))
+            missed = sum(1 for x in values if "Missed" in x)
+            if missed == 0 and len(values) == samples:
+                return scanFeedrate
+            if scanFeedrate <= minFeedrate:
+                break
+            scanFeedrate = max(scanFeedrate * self.margin * (1 - missed / samples), minFeedrate)
+        raise RuntimeError(f"The probe pass misses samples even at feedrate {scanFeedrate:.0f}")
 
+class FastRowScan:
+    """
+    The acquisition of a single row of the fast measurement: the M6000 scan
+    of the row followed by the re-measurement of the missed samples. The
+    class does no I/O, so it can be shared by the blocking and the asyncio
+    transport; the transport sends the commands it asks for and passes back
+    their responses. Both the scan and the re-measurement give up after
+    ROW_ATTEMPTS attempts.
+    """
+    def __init__(self, y: int, size: Tuple[int, int], resolution: Tuple[int, int],
+                 sensor: Sensor, feedrate: float, controller: FeedrateController,
+                 binary: bool=False, flip: bool=False) -> None:
+        self.y = y
+        self.size = size
+        self.resolution = resolution
+        self.sensor = sensor
+        self.feedrate = feedrate
+        self.controller = controller
+        self.binary = binary
+        self.flip = flip
+        self.startX, self.targetX, self.targetY = fastRowStart(y, size, resolution, flip)
+        self.pitch = size[0] / resolution[0]
+        self.rowFeedrate = controller.feedrate
+        self.values = np.empty(0)
+        self.missed = 0
+        self._scans = 0
+        self._attempt = 0
+
+    def scanCommand(self) -> Tuple[str, float]:
+        """
+        Return the M6000 command scanning the row (the sensor has to be at
+        the row start) and its timeout
+        """
+        if self._scans == ROW_ATTEMPTS:
+            raise RuntimeError(f"Cannot scan row {self.y + 1} in {ROW_ATTEMPTS} attempts")
+        self._scans += 1
+        self.rowFeedrate = self.controller.feedrate
+        suffix = " B1" if self.binary else ""
+        return (f"M6000 S{self.resolution[0]} P{self.sensor.index} X{self.targetX} F{self.rowFeedrate}{suffix}",
+                scanTimeout(self.pitch, self.rowFeedrate, self.sensor, self.binary))
+
+    def scanFinished(self, response: List[ResponseItem], errors: List[str]) -> bool:
+        """
+        Process the response of the scan; return False if the scan has to be
+        repeated
+        """
+        if len(errors) > 0:
+            print("Warning, corrupted sample frame; retrying")
+            return False
+        values = self.sensor.interpretBatch(response)
+        if len(values) != self.resolution[0]:
+            # We cannot tell which samples are missing
+            print("Warning, some samples were missing; retrying")
+            return False
+        self.values = values
+        self.missed = sum(end - start for start, end in missedSegments(values))
+        self.controller.rowFinished(self.resolution[0], self.missed)
+        return True
+
+    def retryCommands(self) -> Tuple[float, List[Tuple[Tuple[int, int], List[Tuple[str, bool]]]]]:
+        """
+        Return the timeout and the commands re-measuring the missed segments
+        of the row (see `segmentRetryCommands`); no segments when the row is
+        complete
+        """
+        segments = missedSegments(self.values)
+        if len(segments) == 0:
+            return 0, []
+        if self._attempt == ROW_ATTEMPTS:
+            raise RuntimeError(f"Cannot measure {sum(end - start for start, end in segments)} "
+                               f"missed samples of row {self.y + 1} in {ROW_ATTEMPTS} attempts")
+        self._attempt += 1
+        retryFeedrate = self.controller.retryFeedrate(self._attempt)
+        return scanTimeout(self.pitch, retryFeedrate, self.sensor, self.binary), [
+            (segment, segmentRetryCommands(segment, self.y, self.size, self.resolution,
+                self.sensor, self.feedrate, retryFeedrate, self.binary, self.flip))
+            for segment in segments]
+
+    def retryFinished(self, segment: Tuple[int, int],
+                      responses: List[Tuple[List[ResponseItem], List[str]]]) -> None:
+        """
+        Process the responses (and errors) of the sample commands of a segment
+        """
+        if any(len(errors) > 0 for _, errors in responses):
+            return
+        start, end = segment
+        samples = self.sensor.interpretBatch([x for response, _ in responses for x in response])
+        if len(samples) == end - start:
+            self.values[start:end] = samples
+
+    def result(self) -> Tuple[List[Any], Dict[str, Any]]:
+        """
+        Return the row values (left to right) and the information about the
+        row acquisition
+        """
+        values = self.values[::-1] if rowReversed(self.y, self.flip) else self.values
+        return values.tolist(), {"feedrate": self.rowFeedrate, "missed": self.missed,
+                                 "retries": self._scans - 1 + self._attempt}
+
+def fastRowOrder(resolution: Tuple[int, int], startRow: int=0, flip: bool=False,
+                 rows: Optional[List[int]]=None) -> List[Tuple[int, bool]]:
+    """
+    Return the rows measured by the fast measurement together with their
+    flip, see `fastMeasurement`
+    """
+    if rows is None:
+        return [(y, flip) for y in range(startRow, resolution[1])]
+    return [(y, rowReversed(y) != rowReversed(i, flip)) for i, y in enumerate(rows)]
 
 def fastMeasurement(machine: Machine, size: Tuple[int, int],
-        resolution: Tuple[int, int], sensor: Sensor, feedrate: int) -> List[List[Any]]:
-    feedMultiplier = 1.0
+        resolution: Tuple[int, int], sensor: Sensor, feedrate: int,
+        startRow: int=0, onRow: Optional[RowCallback]=None,
+        controller: Optional[FeedrateController]=None,
+        binary: bool=False, flip: bool=False,
+        rows: Optional[List[int]]=None) -> List[List[Any]]:
+    """
+    Measure the rows starting with startRow by moving the sensor continuously.
+    The scanning feedrate is driven by the controller; feedrate is used for
+    travel moves. With binary set, the samples are transferred in binary
+    frames instead of text lines. Flip swaps the scanning direction of the
+    rows. If rows is given, only the listed rows are measured in the given
+    order, alternating the scanning direction. Each measured row is passed to
+    onRow together with the scanning feedrate. Returns the measured rows.
+    """
+    if controller is None:
+        controller = FeedrateController(feedrate)
+    order = fastRowOrder(resolution, startRow, flip, rows)
     measurements = []
-    for y in range(resolution[1]):
-        targetY = (y + 0.5) * size[1] / (resolution[1])
-        print(f"Row {y + 1} / {resolution[1]}, {targetY}")
+    positioned = False
+    for i, (y, rowFlip) in enumerate(order):
+        row = FastRowScan(y, size, resolution, sensor, feedrate, controller, binary, rowFlip)
+        while True:
+            # M6000 waits for the previous moves to finish, so there is no
+            # need for M400
+            if not positioned:
+                machine.send(f"G1 X{row.startX} Y{row.targetY} F{feedrate}")
+            positioned = False
+            scan = machine.send(*row.scanCommand())
+            scan.result()
+            if row.scanFinished(scan.response, scan.errors):
+                break
 
+        while True:
+            timeout, segments = row.retryCommands()
+            if len(segments) == 0:
+                break
+            pending = [(segment, [(machine.send(c, timeout), isSample) for c, isSample in commands])
+                       for segment, commands in segments]
+            for segment, handles in pending:
+                row.retryFinished(segment, [(h.result(), h.errors) for h, isSample in handles if isSample])
 
-        startX, targetX = 0, size[0]
-        if y % 2 == 1:
-            startX, targetX = targetX, startX
+        # Move to the next row while we process the data
+        if i + 1 < len(order):
+            nextX, _, nextY = fastRowStart(order[i + 1][0], size, resolution, order[i + 1][1])
+            machine.send(f"G1 X{nextX} Y{nextY} F{feedrate}")
+            positioned = True
 
-        while True:
-            machine.command(f"G1 X{startX} Y{targetY} F{feedrate}")
-            machine.command("M400")
-            values = machine.command(f"M6000 S{resolution[0]} P{sensor.index} X{targetX} F{feedrate * feedMultiplier}")
-            if any("Missed" in x for x in values):
-                feedMultiplier *= 0.95
-                print(f"Measurement unsuccessful, lowering feedrate to {feedrate * feedMultiplier}")
-                continue
-            if len(values) != resolution[0]:
-                print("Warning, some samples were missing; retrying")
-                continue
+        values, info = row.result()
+        measurements.append(values)
+        if onRow is not None:
+            onRow(y, values, info)
+    return measurements
+
+def parseTaggedSamples(lines: List[str], sensor: Sensor) -> Tuple[List[float], List[float], List[int], np.ndarray]:
+    """
+    Given a response of M6001, return X and Y positions, timestamps and values
+    of the samples. Lines that are not samples are ignored.
+    """
+    xs, ys, times, readings = [], [], [], []
+    for line in lines:
+        fields = line.split()
+        if len(fields) != 4:
+            continue
+        try:
+            x, y, t = float(fields[0]), float(fields[1]), int(fields[2])
+        except ValueError:
+            continue
+        xs.append(x)
+        ys.append(y)
+        times.append(t)
+        readings.append(fields[3])
+    return xs, ys, times, sensor.interpretBatch(readings)
+
+def commandRejected(machine: Machine, command: str) -> bool:
+    """
+    Tell whether the firmware reported the command as unknown. Looks at the
+    events received so far; the other events are kept in the queue.
+    """
+    name = command.split()[0]
+    rejected = False
+    kept = []
+    while True:
+        try:
+            event = machine.events.get_nowait()
+        except queue.Empty:
             break
+        # Marlin echoes: Unknown command: "<command line>"
+        _, _, quoted = event.line.partition('Unknown command: "')
+        if quoted.replace('"', " ").split()[:1] == [name]:
+            rejected = True
+        else:
+            kept.append(event)
+    for event in kept:
+        machine.events.put_nowait(event)
+    return rejected
 
-        row = [sensor.interpret(x) for x in values]
-        if y % 2 == 1:
-           row = reversed(row)
-        measurements.append(list(row))
-        print(f"  Got {measurements[-1]}")
+# Number of attempts to measure a row by M6001
+TAGGED_ATTEMPTS = 3
+
+def taggedMeasurement(machine: Machine, size: Tuple[int, int],
+        resolution: Tuple[int, int], sensor: Sensor, feedrate: int,
+        startRow: int=0, onRow: Optional[RowCallback]=None,
+        controller: Optional[FeedrateController]=None,
+        flip: bool=False) -> List[List[Any]]:
+    """
+    Measure the rows starting with startRow by moving the sensor continuously
+    and sampling as fast as the sensor allows. Every sample is tagged with the
+    position the firmware reports for it; the samples are resampled onto the
+    row cells. When some cells get no sample, the controller lowers the
+    scanning feedrate for the next rows. Flip swaps the scanning direction of
+    the rows. Each measured row is passed to onRow together with the scanning
+    feedrate, the number of samples, the largest deviation of the reported Y
+    positions from the row (in mm) and the mean interval between the samples
+    (in ms, from the firmware timestamps). Returns the measured rows.
+    """
+    from .resample import resampleRow
+
+    if controller is None:
+        controller = FeedrateController(feedrate)
+    measurements = []
+    positioned = False
+    for y in range(startRow, resolution[1]):
+        startX, targetX, targetY = fastRowStart(y, size, resolution, flip)
+
+        for retries in range(TAGGED_ATTEMPTS):
+            if not positioned:
+                machine.send(f"G1 X{startX} Y{targetY} F{feedrate}")
+            positioned = False
+            rowFeedrate = controller.feedrate
+            command = f"M6001 P{sensor.index} X{targetX} F{rowFeedrate}"
+            lines = machine.command(command)
+            if commandRejected(machine, command):
+                raise RuntimeError("The firmware does not support position-tagged sampling (M6001)")
+            xs, ys, times, values = parseTaggedSamples(lines, sensor)
+            if len(xs) >= 2:
+                break
+            print("Warning, too few samples in the row; retrying")
+            controller.rowFinished(resolution[0], resolution[0])
+        else:
+            raise RuntimeError(f"Cannot measure row {y + 1}: too few samples in {TAGGED_ATTEMPTS} attempts")
+
+        if y + 1 < resolution[1]:
+            nextX, _, nextY = fastRowStart(y + 1, size, resolution, flip)
+            machine.send(f"G1 X{nextX} Y{nextY} F{feedrate}")
+            positioned = True
+
+        cells = set(min(int(x * resolution[0] / size[0]), resolution[0] - 1) for x in xs)
+        controller.rowFinished(resolution[0], resolution[0] - len(cells))
+        row = resampleRow(xs, values, size[0], resolution[0]).tolist()
+        measurements.append(row)
+        if onRow is not None:
+            onRow(y, row, {
+                "feedrate": rowFeedrate,
+                "samples": len(xs),
+                "retries": retries,
+                "yDeviation": float(np.max(np.abs(np.asarray(ys) - targetY))),
+                "sampleInterval": (times[-1] - times[0]) / (len(times) - 1)
+            })
     return measurements
 
+# Number of attempts to measure a row by M6002
+BATCH_ATTEMPTS = 3
+
+def batchedPointMeasurement(machine: Machine, xs: List[float], y: float,
+        sensor: Sensor, feedrate: int, binary: bool=False) -> Tuple[np.ndarray, int]:
+    """
+    Measure at points xs (evenly spaced) of a row at y by a single M6002
+    command, stopping at each point. The readings are validated against the
+    number of points; an invalid row is measured again. Returns the values in
+    the order of xs and the number of retries.
+    """
+    pitch = abs(xs[-1] - xs[0]) / max(len(xs) - 1, 1)
+    # Each point takes a move (with some time for acceleration) and a reading
+    timeout = 10 + len(xs) * (60 * pitch / feedrate + sensor.readTime + 0.2)
+    command = f"M6002 S{len(xs)} P{sensor.index} X{xs[-1]} Y{y} F{feedrate}" + \
+        (" B1" if binary else "")
+    for attempt in range(BATCH_ATTEMPTS):
+        machine.send(f"G1 X{xs[0]} Y{y} F{feedrate}")
+        pending = machine.send(command, timeout)
+        pending.result()
+        if commandRejected(machine, command):
+            raise RuntimeError("The firmware does not support batched point measurement (M6002)")
+        if len(pending.errors) > 0:
+            print("Warning, corrupted sample frame; retrying")
+            continue
+        values = sensor.interpretBatch(pending.response)
+        if len(values) != len(xs):
+            print(f"Warning, got {len(values)} readings instead of {len(xs)}; retrying")
+            continue
+        if np.isnan(values).any():
+            print("Warning, invalid readings; retrying")
+            continue
+        return values, attempt
+    raise RuntimeError(f"Cannot measure row at Y={y}")
+
 def conservativeMeasurement(machine: Machine, size: Tuple[int, int],
-        resolution: Tuple[int, int], sensor: Sensor, feedrate: int) -> List[List[Any]]:
+        resolution: Tuple[int, int], sensor: Sensor, feedrate: int,
+        startRow: int=0, onRow: Optional[RowCallback]=None,
+        batched: bool=False, binary: bool=False, flip: bool=False) -> List[List[Any]]:
+    """
+    Measure the rows starting with startRow by stopping the sensor at each
+    point. With batched set, each row is measured by a single command (see
+    `batchedPointMeasurement`, binary selects binary frames), otherwise by a
+    move, M400 and a reading per point. Flip swaps the scanning direction of
+    the rows. Each measured row is passed to onRow. Returns the measured rows.
+    """
     measurements = []
-    for y in range(resolution[1]):
+    for y in range(startRow, resolution[1]):
         row = [0 for x in range(resolution[0])]
 
-        xRange = range(resolution[0])
-        if y % 2 == 1:
-            xRange = reversed(xRange)
-        for x in xRange:
-            targetX = x * size[0] / (resolution[0] - 1)
-            targetY = y * size[1] / (resolution[1] - 1)
-            command = f"G1 X{targetX} Y{targetY} F{feedrate}"
-            machine.command(command)
-            machine.command("M400", timeout=15)
-            rawData = machine.command(sensor.directCommand)
-            data = sensor.interpret(rawData[0])
-            print(f"{x}, {y}: {data}")
+        xRange = list(range(resolution[0]))
+        if rowReversed(y, flip):
+            xRange.reverse()
+        targetY = y * size[1] / (resolution[1] - 1)
+        retries = 0
+        if batched:
+            values, retries = batchedPointMeasurement(machine,
+                [x * size[0] / (resolution[0] - 1) for x in xRange], targetY,
+                sensor, feedrate, binary)
+        else:
+            # Queue the whole row; the machine keeps as many commands in flight as
+            # the firmware command buffer allows
+            readings = []
+            for x in xRange:
+                targetX = x * size[0] / (resolution[0] - 1)
+                command = f"G1 X{targetX} Y{targetY} F{feedrate}"
+                machine.send(command)
+                machine.send("M400", timeout=15)
+                readings.append(machine.send(sensor.directCommand))
+            values = sensor.interpretBatch([reading.result()[0] for reading in readings])
+        for x, data in zip(xRange, values.tolist()):
             row[x] = data
         measurements.append(row)
+        if onRow is not None:
+            onRow(y, row, {"retries": retries})
     return measurements
@@ -0,0 +1,114 @@
+import math
+import time
+from typing import Any, Dict, List, Optional, Tuple
+import numpy as np
+from .acquire import FeedrateController, Sensor, fastMeasurement
+from .machine import Machine
+from .resample import gridCenters
+
+def baseRows(rows: int, coarseFactor: int) -> List[int]:
+    """
+    Return indices of every coarseFactor-th row including the last one
+    """
+    indices = list(range(0, rows, coarseFactor))
+    if indices[-1] != rows - 1:
+        indices.append(rows - 1)
+    return indices
+
+def gapCurvature(base: np.ndarray, ys: np.ndarray) -> np.ndarray:
+    """
+    Estimate how badly linear interpolation along Y fails in each gap
+    between the measured rows (rows of base at coordinates ys). The error
+    grows with the second derivative along Y; a gap gets the larger of the
+    curvatures at its two rows (90th percentile over the columns).
+    """
+    if len(ys) < 3:
+        return np.zeros(max(len(ys) - 1, 0))
+    slopes = np.diff(base, axis=0) / np.diff(ys)[:, None]
+    curvature = 2 * np.abs(np.diff(slopes, axis=0)) / (ys[2:] - ys[:-2])[:, None]
+    # The first and the last row have no curvature estimate of their own
+    curvature = np.concatenate([curvature[:1], curvature, curvature[-1:]])
+    perRow = np.percentile(curvature, 90, axis=1)
+    return np.maximum(perRow[:-1], perRow[1:])
+
+def refinementRows(base: np.ndarray, rows: List[int], ys: np.ndarray,
+                   budget: int) -> List[int]:
+    """
+    Pick the skipped rows to measure: whole gaps between the measured rows
+    in the order of decreasing curvature (see `gapCurvature`) as long as they
+    fit into the budget (number of rows).
+    """
+    curvature = gapCurvature(base, ys[rows])
+    selected: List[int] = []
+    for gap in np.argsort(-curvature, kind="stable"):
+        skipped = list(range(rows[gap] + 1, rows[gap + 1]))
+        if len(skipped) == 0 or curvature[gap] <= 0:
+            continue
+        if len(selected) + len(skipped) > budget:
+            continue
+        selected += skipped
+    return sorted(selected)
+
+def interpolateRows(measured: Dict[int, np.ndarray], ys: np.ndarray) -> np.ndarray:
+    """
+    Fill a grid with rows at coordinates ys from the measured rows; the
+    other rows are linearly interpolated along Y
+    """
+    rows = sorted(measured.keys())
+    known = np.array([measured[y] for y in rows])
+    grid = np.empty((len(ys), known.shape[1]))
+    for x in range(known.shape[1]):
+        grid[:, x] = np.interp(ys, ys[rows], known[:, x])
+    return grid
+
+def adaptiveMeasurement(machine: Machine, size: Tuple[int, int],
+        resolution: Tuple[int, int], sensor: Sensor, feedrate: int,
+        controller: Optional[FeedrateController]=None, coarseFactor: int=4,
+        refineFraction: float=0.25) -> Tuple[np.ndarray, Dict[str, Any]]:
+    """
+    Measure the screen coarse-to-fine. The time of the fast acquisition is
+    given by the number of rows (the samples along a row come for free), so
+    first only every coarseFactor-th row is measured. Then the gaps between
+    them where linear interpolation is the least accurate are measured, up
+    to refineFraction of the skipped rows. The remaining rows are
+    interpolated. When this would not skip any row, a plain fast scan is
+    taken. Returns the grid and a summary with the number of measured rows
+    and samples and the estimated time saving against a full fast scan.
+    """
+    if controller is None:
+        controller = FeedrateController(feedrate)
+    _, ys = gridCenters(size, resolution)
+    rows = baseRows(resolution[1], coarseFactor)
+    budget = math.floor(refineFraction * (resolution[1] - len(rows)))
+    if len(rows) + budget >= resolution[1]:
+        print("Refinement would not skip any row, taking a full scan")
+        grid = np.array(fastMeasurement(machine, size, resolution, sensor,
+            feedrate, controller=controller), dtype=np.float64)
+        return grid, {"rows": resolution[1], "samples": grid.size, "estimatedSaving": 0.0}
+
+    print(f"Measuring {len(rows)} of {resolution[1]} rows")
+    start = time.perf_counter()
+    base = np.array(fastMeasurement(machine, size, resolution, sensor, feedrate,
+        controller=controller, rows=rows), dtype=np.float64)
+    rowTime = (time.perf_counter() - start) / len(rows)
+    measured = dict(zip(rows, base))
+
+    refined = refinementRows(base, rows, ys, budget)
+    if len(refined) > 0:
+        print(f"Refining {len(refined)} rows")
+        # Start at the bottom where the first pass ended
+        refined.reverse()
+        values = fastMeasurement(machine, size, resolution, sensor, feedrate,
+            controller=controller, rows=refined)
+        measured.update(zip(refined, np.array(values, dtype=np.float64)))
+
+    duration = time.perf_counter() - start
+    saving = 1 - duration / (rowTime * resolution[1])
+    print(f"Measured {len(measured)} of {resolution[1]} rows, "
+          f"estimated saving {saving:.0%} of the time of a full scan")
+    summary = {
+        "rows": len(measured),
+        "samples": len(measured) * resolution[0],
+        "estimatedSaving": saving
+    }
+    return interpolateRows(measured, ys), summary
@@ -0,0 +1,111 @@
+from typing import Any, Dict, List, Optional, Tuple
+from .acquire import (FastRowScan, FeedrateController, RowCallback, Sensor, fastRowOrder,
+                      fastRowStart, getSensor)
+from .aiomachine import AsyncMachine, asyncMachineConnection
+from .machine import MARLIN_BUFSIZE
+
+async def acquireMeasurementAsync(port: str, size: Tuple[int, int],
+        resolution: Tuple[int, int], sensor: str="TSL2561", feedrate: int=3000,
+        fast: bool=False, maxInFlight: int=MARLIN_BUFSIZE) -> Dict[str, Any]:
+    """
+    Take an LCD measurement, see `measureLcd`. Returns the measurement
+    """
+    measurement: Dict[str, Any] = {
+        "sensor": sensor,
+        "size": size,
+        "resolution": resolution
+    }
+
+    sensorObj = getSensor(sensor)
+
+    async with asyncMachineConnection(port, maxInFlight) as machine:
+        await machine.command("M17")
+        await machine.command("G28", timeout=120)
+        await machine.command(f"G0 X0 Y0 F{feedrate}")
+
+        if fast:
+            rowFeedrates: List[float] = []
+            measurements = await fastMeasurementAsync(machine, size, resolution, sensorObj, feedrate,
+                onRow=lambda y, row, info: rowFeedrates.append(info["feedrate"]))
+            measurement["rowFeedrates"] = rowFeedrates
+        else:
+            measurements = await conservativeMeasurementAsync(machine, size, resolution, sensorObj, feedrate)
+
+        await machine.command(f"G0 X0 Y0 F{feedrate}")
+        await machine.command("M400", timeout=40)
+        await machine.command("M18")
+    measurement["measurements"] = measurements
+    return measurement
+
+async def fastMeasurementAsync(machine: AsyncMachine, size: Tuple[int, int],
+        resolution: Tuple[int, int], sensor: Sensor, feedrate: int,
+        startRow: int=0, onRow: Optional[RowCallback]=None,
+        controller: Optional[FeedrateController]=None,
+        binary: bool=False, flip: bool=False,
+        rows: Optional[List[int]]=None) -> List[List[Any]]:
+    """
+    The asyncio counterpart of `fastMeasurement`
+    """
+    if controller is None:
+        controller = FeedrateController(feedrate)
+    order = fastRowOrder(resolution, startRow, flip, rows)
+    measurements = []
+    positioned = False
+    for i, (y, rowFlip) in enumerate(order):
+        row = FastRowScan(y, size, resolution, sensor, feedrate, controller, binary, rowFlip)
+        while True:
+            if not positioned:
+                await machine.send(f"G1 X{row.startX} Y{row.targetY} F{feedrate}")
+            positioned = False
+            scan = await machine.send(*row.scanCommand())
+            await scan.result()
+            if row.scanFinished(scan.response, scan.errors):
+                break
+
+        while True:
+            timeout, segments = row.retryCommands()
+            if len(segments) == 0:
+                break
+            pending = [(segment, [(await machine.send(c, timeout), isSample) for c, isSample in commands])
+                       for segment, commands in segments]
+            for segment, handles in pending:
+                row.retryFinished(segment, [(await h.result(), h.errors) for h, isSample in handles if isSample])
+
+        if i + 1 < len(order):
+            nextX, _, nextY = fastRowStart(order[i + 1][0], size, resolution, order[i + 1][1])
+            await machine.send(f"G1 X{nextX} Y{nextY} F{feedrate}")
+            positioned = True
+
+        values, info = row.result()
+        measurements.append(values)
+        if onRow is not None:
+            onRow(y, values, info)
+    return measurements
+
+async def conservativeMeasurementAsync(machine: AsyncMachine, size: Tuple[int, int],
+        resolution: Tuple[int, int], sensor: Sensor, feedrate: int,
+        startRow: int=0, onRow: Optional[RowCallback]=None) -> List[List[Any]]:
+    """
+    The asyncio counterpart of `conservativeMeasurement`
+    """
+    measurements = []
+    for y in range(startRow, resolution[1]):
+        row = [0 for x in range(resolution[0])]
+
+        xRange = range(resolution[0])
+        if y % 2 == 1:
+            xRange = reversed(xRange)
+        readings = []
+        for x in xRange:
+            targetX = x * size[0] / (resolution[0] - 1)
+            targetY = y * size[1] / (resolution[1] - 1)
+            await machine.send(f"G1 X{targetX} Y{targetY} F{feedrate}")
+            await machine.send("M400", timeout=15)
+            readings.append((x, await machine.send(sensor.directCommand)))
+        values = sensor.interpretBatch([(await reading.result())[0] for _, reading in readings])
+        for (x, _), data in zip(readings, values.tolist()):
+            row[x] = data
+        measurements.append(row)
+        if onRow is not None:
+            onRow(y, row, {})
+    return measurements
@@ -0,0 +1,218 @@
+import asyncio
+import time
+from contextlib import asynccontextmanager
+from typing import TYPE_CHECKING, AsyncGenerator, Dict, List, Optional
+from serial import Serial # type: ignore
+from .machine import (Handshake, LineFramer, LinkStats, MachineEvent, PendingCommand, ResponseItem,
+                      ResponseRouter, EVENT_QUEUE_SIZE, MARLIN_BUFSIZE, MAX_PROBE_INTERVAL,
+                      openPort, parseFirmwareInfo)
+
+if TYPE_CHECKING:
+    from .session import SessionRecorder
+
+# Polling period for ports that cannot be watched by the event loop
+POLL_PERIOD = 0.005
+
+class AsyncPendingCommand(PendingCommand):
+    """
+    A handle of a command issued via `AsyncMachine.send`.
+    """
+    async def result(self) -> List[ResponseItem]: # type: ignore[override]
+        """
+        Wait for the command to complete and return its response lines
+        """
+        await self._machine._waitFor(self)
+        return self.response
+
+class AsyncMachine:
+    """
+    The asyncio counterpart of `Machine`. Instead of a reader thread, the port
+    is watched by the event loop, so a single loop can drive several machines.
+    Has to be created from a running event loop.
+    """
+    def __init__(self, port: Serial, maxInFlight: int=MARLIN_BUFSIZE,
+                 recorder: Optional["SessionRecorder"]=None) -> None:
+        self._port = port
+        self._maxInFlight = maxInFlight
+        self._recorder = recorder
+        self._router = ResponseRouter()
+        self._framer = LineFramer()
+        self.stats = LinkStats()
+        self._readerError: Optional[Exception] = None
+        self._progress = asyncio.Event()
+        self._loop = asyncio.get_running_loop()
+        self._poller: Optional[asyncio.Task] = None
+        self._handshake: Optional[Handshake] = None
+        self.events: "asyncio.Queue[MachineEvent]" = asyncio.Queue(EVENT_QUEUE_SIZE)
+        self.firmware: Dict[str, str] = {}
+        self.rebooted = False
+
+        self._port.timeout = 0
+        try:
+            self._fd = self._port.fileno()
+            self._loop.add_reader(self._fd, self._onReadable)
+        except (AttributeError, NotImplementedError):
+            # Windows ports or event loops without add_reader
+            self._fd = None
+            self._poller = asyncio.create_task(self._pollLoop())
+
+    async def close(self) -> None:
+        """
+        Stop watching the port. The port itself is not closed.
+        """
+        if self._fd is not None:
+            self._loop.remove_reader(self._fd)
+        if self._poller is not None:
+            self._poller.cancel()
+            try:
+                await self._poller
+            except asyncio.CancelledError:
+                pass
+
+    async def handshake(self, timeout: float=15, probeInterval: float=0.2) -> Dict[str, str]:
+        """
+        Synchronize with the firmware. See `Machine.handshake`.
+        """
+        if len(self._router.inFlight) > 0:
+            raise RuntimeError("Cannot handshake with commands in flight")
+        handshake = Handshake()
+        self._handshake = handshake
+        try:
+            deadline = time.monotonic() + timeout
+            while not handshake.synced:
+                now = time.monotonic()
+                if now >= deadline:
+                    raise TimeoutError(f"The device does not respond ({handshake.probes} probes sent)")
+                self._write(handshake.probe().encode("utf-8"))
+                probeDeadline = min(now + probeInterval, deadline)
+                probeInterval = min(1.5 * probeInterval, MAX_PROBE_INTERVAL)
+                while not handshake.synced and time.monotonic() < probeDeadline:
+                    if self._readerError is not None:
+                        raise self._readerError
+                    progress = self._progress
+                    try:
+                        await asyncio.wait_for(progress.wait(), probeDeadline - time.monotonic())
+                    except asyncio.TimeoutError:
+                        pass
+        finally:
+            self._handshake = None
+        self.rebooted = handshake.rebooted
+        self.firmware = parseFirmwareInfo(await self.command("M115"))
+        return self.firmware
+
+    async def send(self, command: str, timeout: float=10) -> AsyncPendingCommand:
+        """
+        Issue G-code command without waiting for its completion. See
+        `Machine.send`.
+        """
+        if not command.endswith("\n"):
+            command += "\n"
+        while len(self._router.inFlight) >= self._maxInFlight:
+            await self._waitForProgress()
+        pending = AsyncPendingCommand(self, command.strip(), timeout) # type: ignore
+        self._router.push(pending)
+        self._write(command.encode("utf-8"))
+        self.stats.commands += 1
+        return pending
+
+    async def command(self, command: str, timeout: float=10) -> List[ResponseItem]:
+        """
+        Issue G-code command, waits for completion and returns a list of
+        returned values (lines of response)
+        """
+        return await (await self.send(command, timeout)).result()
+
+    async def flush(self) -> None:
+        """
+        Wait for all issued commands to complete
+        """
+        while len(self._router.inFlight) > 0:
+            await self._waitForProgress()
+
+    async def _waitFor(self, pending: PendingCommand) -> None:
+        while not pending.done:
+            await self._waitForProgress()
+
+    async def _waitForProgress(self) -> None:
+        if self._readerError is not None:
+            raise self._readerError
+        remaining = self._router.remaining()
+        if remaining <= 0:
+            raise TimeoutError(f"No response on command {self._router.inFlight[0].command}")
+        progress = self._progress
+        start = time.perf_counter()
+        try:
+            await asyncio.wait_for(progress.wait(), remaining)
+        except asyncio.TimeoutError:
+            pass
+        self.stats.waitTime += time.perf_counter() - start
+
+    def _onReadable(self) -> None:
+        try:
+            data = self._port.read(max(1, self._port.in_waiting))
+        except Exception as e:
+            self._readerError = e
+            self._loop.remove_reader(self._fd)
+            self._notify()
+            return
+        self._process(data)
+
+    async def _pollLoop(self) -> None:
+        while True:
+            try:
+                data = self._port.read(self._port.in_waiting)
+            except Exception as e:
+                self._readerError = e
+                self._notify()
+                return
+            self._process(data)
+            await asyncio.sleep(POLL_PERIOD)
+
+    def _write(self, data: bytes) -> None:
+        if self._recorder is not None:
+            self._recorder.sent(data)
+        self._port.write(data)
+        self.stats.bytesSent += len(data)
+
+    def _process(self, data: bytes) -> None:
+        if self._recorder is not None and len(data) > 0:
+            self._recorder.received(data)
+        self.stats.bytesReceived += len(data)
+        lines = self._framer.feed(data)
+        if len(lines) == 0:
+            return
+        self.stats.linesReceived += len(lines)
+        for line in lines:
+            if self._handshake is not None:
+                self._handshake.feed(line)
+                continue
+            _, event = self._router.route(line)
+            if event is not None:
+                try:
+                    self.events.put_nowait(event)
+                except asyncio.QueueFull:
+                    pass
+        self._notify()
+
+    def _notify(self) -> None:
+        self._progress.set()
+        self._progress = asyncio.Event()
+
+
+@asynccontextmanager
+async def asyncMachineConnection(port: str, maxInFlight: int=MARLIN_BUFSIZE,
+                                 handshake: bool=True, record: Optional[str]=None) -> AsyncGenerator[AsyncMachine, None]:
+    recorder = None
+    if record is not None:
+        from .session import SessionRecorder
+        recorder = SessionRecorder(record, port)
+    with openPort(port) as s:
+        machine = AsyncMachine(s, maxInFlight, recorder)
+        try:
+            if handshake:
+                await machine.handshake()
+            yield machine
+        finally:
+            await machine.close()
+            if recorder is not None:
+                recorder.close()
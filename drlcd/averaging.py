@@ -0,0 +1,61 @@
+from typing import Any, Dict, List, Optional, Tuple
+import numpy as np
+
+class CellAccumulator:
+    """
+    Streaming mean and variance of repeated measurements of a grid, per cell,
+    using Welford's algorithm. Rows are folded in one at a time as they are
+    measured, so the accumulator never holds more than the running
+    statistics. Cells of a multi-channel sensor have one value per channel.
+    """
+    def __init__(self, rows: int, columns: int, channels: int=1) -> None:
+        shape: Tuple[int, ...] = (rows, columns) if channels == 1 else (rows, columns, channels)
+        self.count = np.zeros(rows, dtype=np.int64)
+        self.mean = np.zeros(shape)
+        self._m2 = np.zeros(shape)
+
+    def addRow(self, y: int, values: List[Any]) -> None:
+        x = np.asarray(values, dtype=np.float64)
+        self.count[y] += 1
+        delta = x - self.mean[y]
+        self.mean[y] += delta / self.count[y]
+        self._m2[y] += delta * (x - self.mean[y])
+
+    def variance(self) -> np.ndarray:
+        """
+        Return per-cell sample variance; NaN for cells measured less than
+        twice
+        """
+        n = self._rowCounts()
+        return np.divide(self._m2, n - 1, out=np.full_like(self._m2, np.nan), where=n > 1)
+
+    def meanVariance(self) -> np.ndarray:
+        """
+        Return per-cell variance of the mean, i.e., how much the mean would
+        vary between repeated measurements
+        """
+        return self.variance() / self._rowCounts()
+
+    def noiseLevel(self, percentile: float=95) -> Optional[float]:
+        """
+        Return the given percentile of the variance of the mean over all
+        cells, or None if some cell has not been measured twice yet
+        """
+        if self.count.min() < 2:
+            return None
+        return float(np.percentile(self.meanVariance(), percentile))
+
+    def _rowCounts(self) -> np.ndarray:
+        return self.count.reshape((-1,) + (1,) * (self.mean.ndim - 1))
+
+    def state(self) -> Dict[str, Any]:
+        return {
+            "count": self.count.tolist(),
+            "mean": self.mean.tolist(),
+            "m2": self._m2.tolist()
+        }
+
+    def restore(self, state: Dict[str, Any]) -> None:
+        self.count = np.array(state["count"], dtype=np.int64)
+        self.mean = np.array(state["mean"], dtype=np.float64)
+        self._m2 = np.array(state["m2"], dtype=np.float64)
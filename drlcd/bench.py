@@ -0,0 +1,189 @@
+import json
+import platform
+import time
+from datetime import datetime
+from typing import Any, Callable, Dict, List
+import click
+import numpy as np
+from .acquire import getSensor, Sensor
+from .machine import machineConnection, Machine, MARLIN_BUFSIZE
+
+# A command that the firmware answers right away without side effects
+PING_COMMAND = "M118 drlcd-ping"
+
+def latencyStats(samples: List[float]) -> Dict[str, float]:
+    """
+    Summarize durations in seconds; the result is in milliseconds
+    """
+    ms = 1000 * np.asarray(samples)
+    return {
+        "count": len(samples),
+        "mean": float(ms.mean()),
+        "min": float(ms.min()),
+        "p50": float(np.percentile(ms, 50)),
+        "p90": float(np.percentile(ms, 90)),
+        "p99": float(np.percentile(ms, 99)),
+        "max": float(ms.max())
+    }
+
+def timeCommands(machine: Machine, command: Callable[[int], str], count: int,
+                 timeout: float=10) -> List[float]:
+    """
+    Issue count commands one after another, return their round-trip times
+    """
+    durations = []
+    for i in range(count):
+        start = time.perf_counter()
+        machine.command(command(i), timeout)
+        durations.append(time.perf_counter() - start)
+    return durations
+
+def benchRoundTrip(machine: Machine, count: int) -> Dict[str, Any]:
+    """
+    Round-trip latency of a command with no work in the firmware
+    """
+    return latencyStats(timeCommands(machine, lambda _: PING_COMMAND, count))
+
+def benchPipelined(machine: Machine, count: int) -> Dict[str, Any]:
+    """
+    Command throughput when the commands are pipelined up to the in-flight
+    limit of the machine
+    """
+    start = time.perf_counter()
+    pending = [machine.send(PING_COMMAND) for _ in range(count)]
+    for p in pending:
+        p.result()
+    duration = time.perf_counter() - start
+    return {"count": count, "duration": duration, "commandsPerSecond": count / duration}
+
+def benchCommandOverhead(machine: Machine, sensor: Sensor, count: int) -> Dict[str, Any]:
+    """
+    Round-trip times of M400 (with an empty planner) and of a direct sensor
+    reading. The sensor overhead is the time on top of its integration time.
+    """
+    machine.command("M400", timeout=40)
+    sync = latencyStats(timeCommands(machine, lambda _: "M400", count))
+    read = latencyStats(timeCommands(machine, lambda _: sensor.directCommand, count))
+    read["overhead"] = read["mean"] - 1000 * sensor.readTime
+    return {"M400": sync, sensor.directCommand: read}
+
+def benchBursts(machine: Machine, sensor: Sensor, bursts: int, samples: int,
+                pitch: float, feedrate: float, binary: bool) -> Dict[str, Any]:
+    """
+    Measure M6000 scans of given number of samples back and forth along the X
+    axis. The wall time of a scan is split into the motion time (as planned,
+    without acceleration) and the rest; host parsing is timed separately.
+    """
+    length = samples * pitch
+    suffix = " B1" if binary else ""
+    machine.command(f"G1 X0 Y0 F{feedrate}")
+    machine.command("M400", timeout=40)
+    durations, parsing, missed, received, lines = [], [], 0, 0, 0
+    for i in range(bursts):
+        targetX = length if i % 2 == 0 else 0
+        start = time.perf_counter()
+        response = machine.command(f"M6000 S{samples} P{sensor.index} X{targetX} F{feedrate}{suffix}",
+            timeout=10 + 120 * length / feedrate)
+        durations.append(time.perf_counter() - start)
+        start = time.perf_counter()
+        values = sensor.interpretBatch(response)
+        parsing.append(time.perf_counter() - start)
+        missed += int(np.isnan(values).reshape(len(values), -1).any(axis=1).sum())
+        lines += len(response)
+        received += sum(len(item) + (0 if isinstance(item, bytes) else 1) for item in response)
+    motionTime = 60 * length / feedrate
+    totalTime = sum(durations)
+    return {
+        "bursts": bursts,
+        "samples": samples,
+        "binary": binary,
+        "feedrate": feedrate,
+        "scan": latencyStats(durations),
+        "motion": 1000 * motionTime,
+        "overhead": 1000 * (totalTime / bursts - motionTime),
+        "parsing": latencyStats(parsing),
+        "missed": missed,
+        "linesPerSecond": lines / totalTime,
+        "bytesPerSecond": received / totalTime
+    }
+
+def printReport(report: Dict[str, Any]) -> None:
+    def row(name: str, stats: Dict[str, float]) -> None:
+        print(f"  {name:<24} mean {stats['mean']:8.2f}  p50 {stats['p50']:8.2f}  "
+              f"p90 {stats['p90']:8.2f}  p99 {stats['p99']:8.2f}  max {stats['max']:8.2f} ms")
+
+    results = report["results"]
+    print(f"Link benchmark of {report['port']} (max in flight {report['maxInFlight']})")
+    row("round trip", results["roundTrip"])
+    pipelined = results["pipelined"]
+    print(f"  {'pipelined':<24} {pipelined['commandsPerSecond']:8.1f} commands/s")
+    for command, stats in results["commandOverhead"].items():
+        row(command, stats)
+    burst = results["bursts"]
+    row(f"M6000 S{burst['samples']}", burst["scan"])
+    print(f"  {'':<24} motion {burst['motion']:.1f} ms, overhead {burst['overhead']:.1f} ms, "
+          f"{burst['linesPerSecond']:.0f} lines/s, {burst['bytesPerSecond']:.0f} B/s, "
+          f"{burst['missed']} missed")
+    row("parsing", burst["parsing"])
+
+@click.command("bench-link")
+@click.option("--port", type=str, default="/dev/ttyACM0",
+    help="Port for device connection (a 'sim:' port works as a stand-in)")
+@click.option("--sensor", type=click.Choice(["TSL2561", "AS7625"]), default="TSL2561",
+    help="Sensor to use for the readings")
+@click.option("--count", type=click.IntRange(min=1), default=100,
+    help="Number of commands for the latency measurements")
+@click.option("--bursts", type=click.IntRange(min=1), default=10,
+    help="Number of M6000 scans")
+@click.option("--samples", type=click.IntRange(min=1), default=100,
+    help="Number of samples per M6000 scan")
+@click.option("--pitch", type=float, default=1,
+    help="Distance of the samples in millimeters")
+@click.option("--feedrate", type=float, default=3000,
+    help="Feedrate of the M6000 scans")
+@click.option("--binary", is_flag=True,
+    help="Transfer the samples in binary frames")
+@click.option("--home/--no-home", default=True,
+    help="Home the machine before the scans")
+@click.option("--max-in-flight", type=click.IntRange(min=1), default=MARLIN_BUFSIZE,
+    help="Maximal number of unacknowledged commands sent to the device")
+@click.option("--output", type=click.Path(dir_okay=False), default=None,
+    help="Save the results as JSON into this file ('-' for standard output)")
+def benchLink(port, sensor, count, bursts, samples, pitch, feedrate, binary,
+              home, max_in_flight, output):
+    """
+    Measure the command round-trip latency, the command throughput, the
+    overhead of M400 and of sensor readings and the M6000 sample throughput.
+    The times are wall clock, so run simulated devices without speedup.
+    """
+    sensorObj = getSensor(sensor)
+    started = datetime.now().isoformat(timespec="seconds")
+    with machineConnection(port, max_in_flight) as machine:
+        firmware = machine.firmware
+        results: Dict[str, Any] = {
+            "roundTrip": benchRoundTrip(machine, count),
+            "pipelined": benchPipelined(machine, count)
+        }
+        machine.command("M17")
+        if home:
+            machine.command("G28", timeout=120)
+        results["commandOverhead"] = benchCommandOverhead(machine, sensorObj, count)
+        results["bursts"] = benchBursts(machine, sensorObj, bursts, samples,
+            pitch, feedrate, binary)
+        machine.command("M18")
+    report = {
+        "port": port,
+        "sensor": sensor,
+        "maxInFlight": max_in_flight,
+        "firmware": firmware,
+        "host": {"python": platform.python_version(), "platform": platform.platform()},
+        "started": started,
+        "results": results
+    }
+    if output == "-":
+        print(json.dumps(report, indent=2))
+        return
+    printReport(report)
+    if output is not None:
+        with open(output, "w") as f:
+            json.dump(report, f, indent=2)
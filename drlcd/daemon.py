@@ -0,0 +1,226 @@
+import json
+import os
+import queue
+import socket
+import socketserver
+import time
+from contextlib import ExitStack
+from typing import Any, Dict, Optional
+import click
+from .acquire import MeasurementJob, jobFromDict, openJournal, runMeasurement
+from .machine import machineConnection, Machine, MARLIN_BUFSIZE
+
+class DeviceDaemon:
+    """
+    Owns the connection to a single device and remembers whether it is homed,
+    so back-to-back measurements skip the connection (which often reboots the
+    board) and homing. The connection is opened lazily and dropped after a
+    failed job.
+    """
+    def __init__(self, port: str, maxInFlight: int=MARLIN_BUFSIZE) -> None:
+        self.port = port
+        self.maxInFlight = maxInFlight
+        self.homed = False
+        self.jobs = 0
+        self.lastActivity = time.monotonic()
+        self._connection = ExitStack()
+        self._machine: Optional[Machine] = None
+
+    def _connect(self) -> Machine:
+        if self._machine is None:
+            self._machine = self._connection.enter_context(
+                machineConnection(self.port, self.maxInFlight))
+            # Opening the port often resets the board; we pay for the boot
+            # (see `Machine.handshake`) only once per connection
+            self.homed = False
+        else:
+            self._checkReboot(self._machine)
+        return self._machine
+
+    def _checkReboot(self, machine: Machine) -> None:
+        # A board that rebooted since the last job (e.g., power cycle) says
+        # "start" and it is no longer homed
+        while True:
+            try:
+                event = machine.events.get_nowait()
+            except queue.Empty:
+                return
+            if event.line == "start":
+                print("The device has rebooted, it will be homed again")
+                self.homed = False
+
+    def disconnect(self) -> None:
+        self._connection.close()
+        self._connection = ExitStack()
+        self._machine = None
+        self.homed = False
+
+    def measure(self, job: MeasurementJob, resume: bool=False) -> Dict[str, Any]:
+        """
+        Take a measurement, see `runMeasurement`. Returns a summary of the job.
+        """
+        start = time.monotonic()
+        journal = None
+        try:
+            # Connect before creating the journal, so a failed connection
+            # does not leave a journal behind
+            machine = self._connect()
+            job, journal = openJournal(job, resume)
+            runMeasurement(machine, job, journal, home=not self.homed, release=False)
+            self.homed = True
+        except Exception:
+            if journal is not None:
+                journal.close()
+            # We do not know the state of the machine, start from scratch
+            self.disconnect()
+            raise
+        finally:
+            self.jobs += 1
+            self.lastActivity = time.monotonic()
+        return {"output": job.output, "duration": time.monotonic() - start}
+
+    def release(self) -> None:
+        """
+        Disable the motors; the machine has to be homed again
+        """
+        if self._machine is not None and self.homed:
+            self._machine.command("M18")
+        self.homed = False
+
+    def status(self) -> Dict[str, Any]:
+        return {
+            "port": self.port,
+            "connected": self._machine is not None,
+            "homed": self.homed,
+            "jobs": self.jobs
+        }
+
+class DaemonRequestHandler(socketserver.StreamRequestHandler):
+    """
+    Handles a single request: a JSON object on a line, the response is also
+    a JSON object on a line. Requests:
+
+    - {"command": "measure", "job": {...}, "resume": false}
+    - {"command": "status"}
+    - {"command": "shutdown"}
+    """
+    def handle(self) -> None:
+        server: DaemonServer = self.server # type: ignore
+        try:
+            request = json.loads(self.rfile.readline())
+            command = request.get("command")
+            if command == "measure":
+                job = jobFromDict(request["job"])
+                print(f"Measuring {job.output}")
+                response = server.device.measure(job, request.get("resume", False))
+            elif command == "status":
+                response = server.device.status()
+            elif command == "shutdown":
+                server.running = False
+                response = {}
+            else:
+                raise RuntimeError(f"Unknown command {command}")
+            response["status"] = "ok"
+        except Exception as e:
+            print(f"Request failed: {type(e).__name__}: {e}")
+            response = {"status": "error", "error": f"{type(e).__name__}: {e}"}
+        self.wfile.write((json.dumps(response) + "\n").encode("utf-8"))
+
+class DaemonServer(socketserver.UnixStreamServer):
+    """
+    Serves the requests one at a time. When idle for longer than idleRelease
+    seconds, the motors are released.
+    """
+    def __init__(self, path: str, device: DeviceDaemon, idleRelease: float) -> None:
+        super().__init__(path, DaemonRequestHandler)
+        self.device = device
+        self.idleRelease = idleRelease
+        self.timeout = min(idleRelease, 5)
+        self.running = True
+
+    def handle_timeout(self) -> None:
+        idle = time.monotonic() - self.device.lastActivity
+        if self.device.homed and idle > self.idleRelease:
+            print(f"Idle for {idle:.0f} s, releasing the motors")
+            try:
+                self.device.release()
+            except Exception as e:
+                print(f"Cannot release the motors: {e}")
+                self.device.disconnect()
+
+def submitJob(path: str, job: MeasurementJob, resume: bool=False) -> Dict[str, Any]:
+    """
+    Submit a measurement to a running daemon and wait for its completion.
+    Returns the response of the daemon.
+    """
+    return daemonRequest(path, {"command": "measure", "job": job._asdict(), "resume": resume})
+
+def isListening(path: str) -> bool:
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as s:
+        try:
+            s.connect(path)
+            return True
+        except OSError:
+            return False
+
+def daemonRequest(path: str, request: Dict[str, Any]) -> Dict[str, Any]:
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as s:
+        try:
+            s.connect(path)
+        except OSError as e:
+            raise RuntimeError(f"Cannot connect to the daemon at {path}: {e}") from None
+        s.sendall((json.dumps(request) + "\n").encode("utf-8"))
+        with s.makefile("rb") as f:
+            line = f.readline()
+    if len(line) == 0:
+        raise RuntimeError("The daemon closed the connection without a response")
+    response = json.loads(line)
+    if response["status"] != "ok":
+        raise RuntimeError(f"The daemon failed: {response['error']}")
+    return response
+
+@click.command()
+@click.option("--port", type=str, default="/dev/ttyACM0",
+    help="Port for device connection")
+@click.option("--socket", "socketPath", type=click.Path(), default="/tmp/drlcd.sock",
+    help="Path of the Unix socket to listen on")
+@click.option("--max-in-flight", type=click.IntRange(min=1), default=MARLIN_BUFSIZE,
+    help="Maximal number of unacknowledged commands sent to the device")
+@click.option("--idle-release", type=float, default=600,
+    help="Release the motors after being idle for this many seconds")
+@click.option("--status", is_flag=True,
+    help="Print status of a running daemon instead of starting one")
+@click.option("--shutdown", is_flag=True,
+    help="Stop a running daemon instead of starting one")
+def daemon(port, socketPath, max_in_flight, idle_release, status, shutdown):
+    """
+    Keep the connection to the device open and serve measurement jobs
+    submitted by 'drlcd measurelcd --daemon <socket>'. The device stays homed
+    between the jobs.
+    """
+    if status or shutdown:
+        response = daemonRequest(socketPath, {"command": "status" if status else "shutdown"})
+        response.pop("status")
+        print(json.dumps(response))
+        return
+    if os.path.exists(socketPath):
+        if isListening(socketPath):
+            raise RuntimeError(f"A daemon is already listening on {socketPath}")
+        # A leftover of a daemon that did not shut down cleanly
+        os.remove(socketPath)
+
+    device = DeviceDaemon(port, max_in_flight)
+    with DaemonServer(socketPath, device, idle_release) as server:
+        print(f"Listening on {socketPath}")
+        try:
+            while server.running:
+                server.handle_request()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            try:
+                device.release()
+            except Exception:
+                pass
+            device.disconnect()
+            os.remove(socketPath)
@@ -0,0 +1,158 @@
+import json
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
+from contextlib import ExitStack
+from typing import Any, Dict, List, NamedTuple, Optional, Tuple
+import click
+from .acquire import MeasurementJob, jobFromDict, openJournal, runMeasurement
+from .journal import MeasurementJournal
+from .machine import machineConnection, Machine, MARLIN_BUFSIZE
+
+class FleetJob(NamedTuple):
+    port: str
+    job: MeasurementJob
+    resume: bool = False
+
+class JobResult(NamedTuple):
+    port: str
+    output: str
+    error: Optional[str]
+    duration: float
+    samples: int
+
+def parseFleetJobs(specs: List[Dict[str, Any]]) -> List[FleetJob]:
+    """
+    Parse job specifications. Each job is a dictionary with "port", "output",
+    optional "resume" and fields of `MeasurementJob` (e.g., "size": "202x130",
+    "resolution": "101x65", "fast": true).
+    """
+    jobs = []
+    for i, spec in enumerate(specs):
+        spec = dict(spec)
+        try:
+            port = spec.pop("port")
+            resume = spec.pop("resume", False)
+            jobs.append(FleetJob(port, jobFromDict(spec), resume))
+        except (KeyError, RuntimeError) as e:
+            raise RuntimeError(f"Invalid specification of job {i + 1}: {e}") from None
+    return jobs
+
+class RigProgress:
+    """
+    Progress of the jobs of a single rig. Updated by the rig worker, read by
+    the progress reporting.
+    """
+    def __init__(self, port: str, jobCount: int) -> None:
+        self.port = port
+        self.jobCount = jobCount
+        self.results: List[JobResult] = []
+        self.journal: Optional[MeasurementJournal] = None
+        self.resolution: Optional[Tuple[int, int]] = None
+
+    def currentSamples(self) -> int:
+        journal, resolution = self.journal, self.resolution
+        if journal is None or resolution is None:
+            return 0
+        return len(journal.rows) * resolution[0]
+
+    def status(self) -> str:
+        if len(self.results) == self.jobCount:
+            return f"{self.port}: done"
+        journal, resolution = self.journal, self.resolution
+        row = f", row {len(journal.rows)}/{resolution[1]}" if journal is not None and resolution is not None else ""
+        return f"{self.port}: job {len(self.results) + 1}/{self.jobCount}{row}"
+
+def runRig(port: str, jobs: List[FleetJob], maxInFlight: int, progress: RigProgress) -> None:
+    """
+    Run the jobs of a single rig one after another. The connection is kept
+    open between the jobs; a failed job closes it, so the next job starts
+    with a fresh connection. Failures are recorded in the progress, they do
+    not stop the remaining jobs.
+    """
+    connection = ExitStack()
+    machine: Optional[Machine] = None
+    for fleetJob in jobs:
+        start = time.monotonic()
+        journal = None
+        try:
+            # Connect before creating the journal, so a failed connection
+            # does not leave a journal behind
+            if machine is None:
+                machine = connection.enter_context(machineConnection(port, maxInFlight))
+            job, journal = openJournal(fleetJob.job, fleetJob.resume)
+            progress.resolution = job.resolution
+            progress.journal = journal
+            # The rigs report their progress together, see measureFleet
+            runMeasurement(machine, job, journal, progress=None)
+            error = None
+        except Exception as e:
+            error = f"{type(e).__name__}: {e}"
+            if journal is not None:
+                journal.close()
+            connection.close()
+            connection, machine = ExitStack(), None
+        samples = progress.currentSamples()
+        progress.journal = None
+        progress.results.append(JobResult(port, fleetJob.job.output, error,
+            time.monotonic() - start, samples))
+    connection.close()
+
+def printSummary(results: List[JobResult], duration: float) -> None:
+    print(f"{'Port':<20} {'Output':<30} {'Time':>8} {'Samples/s':>10}  Status")
+    for r in results:
+        rate = r.samples / r.duration if r.duration > 0 else 0
+        status = "ok" if r.error is None else f"FAILED ({r.error})"
+        print(f"{r.port:<20} {r.output:<30} {r.duration:>7.0f}s {rate:>10.1f}  {status}")
+    samples = sum(r.samples for r in results)
+    failed = sum(1 for r in results if r.error is not None)
+    print(f"{len(results) - failed}/{len(results)} jobs succeeded in {duration:.0f} s, "
+          f"{samples} samples, {samples / max(duration, 1e-6):.1f} samples/s overall")
+
+@click.command()
+@click.argument("jobs", type=click.Path(exists=True, file_okay=True, dir_okay=False))
+@click.option("--max-in-flight", type=click.IntRange(min=1), default=MARLIN_BUFSIZE,
+    help="Maximal number of unacknowledged commands sent to a device")
+@click.option("--progress-period", type=float, default=10,
+    help="Period of the progress report in seconds")
+def measureFleet(jobs, max_in_flight, progress_period):
+    """
+    Take measurements on several rigs concurrently. JOBS is a JSON file with a
+    list of jobs; each job has "port", "output" and measurement parameters
+    named as the fields of MeasurementJob, e.g.:
+
+    [{"port": "/dev/ttyACM0", "output": "a.json", "size": "202x130", "resolution": "101x65", "fast": true}]
+
+    Jobs of the same port run one after another, different ports run in
+    parallel. A failure of a job does not affect the other jobs.
+    """
+    with open(jobs) as f:
+        fleetJobs = parseFleetJobs(json.load(f))
+    byPort: Dict[str, List[FleetJob]] = {}
+    for job in fleetJobs:
+        byPort.setdefault(job.port, []).append(job)
+    outputs = [job.job.output for job in fleetJobs]
+    if len(set(outputs)) != len(outputs):
+        raise RuntimeError("Each job has to have a different output")
+
+    progress = {port: RigProgress(port, len(portJobs)) for port, portJobs in byPort.items()}
+    start = time.monotonic()
+    with ThreadPoolExecutor(max_workers=len(byPort), thread_name_prefix="drlcd-rig") as executor:
+        futures = [executor.submit(runRig, port, portJobs, max_in_flight, progress[port])
+                   for port, portJobs in byPort.items()]
+        while True:
+            done, notDone = wait(futures, timeout=progress_period)
+            if len(notDone) == 0:
+                break
+            elapsed = time.monotonic() - start
+            samples = sum(r.samples for p in progress.values() for r in p.results) + \
+                      sum(p.currentSamples() for p in progress.values())
+            print(f"[{elapsed:.0f} s, {samples / elapsed:.1f} samples/s] " +
+                  " | ".join(p.status() for p in progress.values()))
+        for future in futures:
+            future.result()
+
+    results = [r for p in progress.values() for r in p.results]
+    printSummary(results, time.monotonic() - start)
+    failed = sum(1 for r in results if r.error is not None)
+    if failed > 0:
+        raise RuntimeError(f"{failed} of {len(results)} jobs failed")
@@ -1,47 +1,116 @@
 import math
-from typing import List
+from typing import Any, Dict, List, Optional, Tuple
 import plotly.graph_objects as go
 import click
-import json
 import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+from numpy.typing import ArrayLike
 import cv2 as cv
 import itertools
 from scipy.ndimage.filters import gaussian_filter
-from .ui_common import Resolution
+from .storage import loadMeasurement
+from .ui_common import ChannelWeights, Resolution
 
-def replacePeaks(arr: np.array, threshold: float, windowSize: int):
+def replacePeaks(arr: np.array, threshold: float, windowSize: int,
+                 border: Optional[str]=None) -> np.array:
     """
     Given an array and threshold, replace peaks with local average of
-    windowSize×windowSize.
+    windowSize×windowSize. Values equal to the peak are excluded from the
+    average.
+
+    By default, pixels closer than windowSize // 2 to the edge are left
+    untouched. When border is given, the array is padded using the
+    corresponding `numpy.pad` mode (e.g., "reflect" or "edge") and the edge
+    pixels are processed as well.
     """
+    arr = np.asarray(arr)
     result = np.copy(arr)
-    height, width = arr.shape
-
     halfWindow = windowSize // 2
+    window = 2 * halfWindow + 1
+
+    if border is None:
+        if arr.shape[0] < window or arr.shape[1] < window:
+            return result
+        source = arr
+        offset = halfWindow
+    else:
+        source = np.pad(arr, halfWindow, mode=border)
+        offset = 0
+    windows = sliding_window_view(source, (window, window))
+    centers = arr[offset: arr.shape[0] - offset, offset: arr.shape[1] - offset]
 
-    for i in range(halfWindow, height - halfWindow):
-        for j in range(halfWindow, width - halfWindow):
-            if arr[i, j] > threshold:
-                localWindow = arr[i - halfWindow: i + halfWindow + 1, j - halfWindow: j + halfWindow + 1]
-                localWindowWithoutPeak = localWindow[localWindow != arr[i, j]]
-                localAverage = np.mean(localWindowWithoutPeak)
-                result[i, j] = localAverage
+    rows, cols = np.nonzero(centers > threshold)
+    if len(rows) == 0:
+        return result
+    peaks = centers[rows, cols]
+    peakWindows = windows[rows, cols].reshape(len(rows), -1)
+    keep = peakWindows != peaks[:, np.newaxis]
+    counts = np.count_nonzero(keep, axis=1)
+
+    # Group the peaks by the number of values that enter the average, so we
+    # can average each group as a dense matrix. The values keep their
+    # row-major order, which makes the result bit-identical to averaging each
+    # window separately.
+    averages = np.full(len(rows), np.nan)
+    for count in np.unique(counts):
+        if count == 0:
+            continue
+        group = counts == count
+        values = peakWindows[group][keep[group]].reshape(-1, count)
+        averages[group] = np.mean(values, axis=1)
+    result[rows + offset, cols + offset] = averages
 
     return result
 
 
-def normalizeData(data: List[List[float]], lowThreshold=0) -> List[List[float]]:
-    npArray = np.array(data)
+def normalizeData(data: ArrayLike, lowThreshold=0, dtype=np.float64) -> np.ndarray:
+    """
+    Filter out faulty peaks from a measurement and mark values not above
+    lowThreshold as NaN. Returns a new array of the given floating point type;
+    the input is not modified.
+    """
+    npArray = np.asarray(data, dtype=dtype)
 
     # There are often faulty peaks in the source data, let's filter them out
-    mean = np.mean(npArray)
+    mean = np.nanmean(npArray)
     npArray = replacePeaks(npArray, 1.5 * mean, 3)
 
-    max = np.max(npArray)
+    max = np.nanmax(npArray)
     npArray = np.clip(npArray, lowThreshold, max)
-    npArray[npArray == lowThreshold] = None
+    npArray[npArray == lowThreshold] = np.nan
+
+    return npArray
+
+def selectChannel(measurement: Dict[str, Any], channel: Optional[str]=None,
+                  weights: Optional[Dict[str, float]]=None) -> np.ndarray:
+    """
+    Return the measured values as a 2D array. Spectral measurements have a
+    value per channel; pick a channel (by name or index) or a weighted
+    combination of channels. By default, the first channel (415 nm, the
+    closest one to the UV backlight) is used.
+    """
+    data = measurement["measurements"]
+    if data.ndim == 2:
+        if channel is not None or weights is not None:
+            raise RuntimeError("The measurement has only a single channel")
+        return data
+    if channel is not None and weights is not None:
+        raise RuntimeError("Specify either a channel or channel weights, not both")
+    names = measurement.get("channels", [str(i) for i in range(data.shape[2])])
 
-    return npArray.tolist()
+    def channelIndex(name: str) -> int:
+        if name in names:
+            return names.index(name)
+        if name.isdigit() and int(name) < len(names):
+            return int(name)
+        raise RuntimeError(f"Unknown channel {name}, available channels: {', '.join(names)}")
+
+    if weights is not None:
+        vector = np.zeros(len(names))
+        for name, weight in weights.items():
+            vector[channelIndex(name)] += weight
+        return np.tensordot(data, vector, axes=([2], [0]))
+    return np.asarray(data[:, :, channelIndex(channel) if channel is not None else 0])
 
 @click.command()
 @click.argument("input", type=click.Path())
@@ -52,10 +121,13 @@ def normalizeData(data: List[List[float]], lowThreshold=0) -> List[List[float]]:
     help="Immediately show")
 @click.option("--threshold", type=int, default=0,
     help="Minimal value to crop")
-def visualize(input, output, title, show, threshold):
-    with open(input) as f:
-        measurement = json.load(f)
-    data = normalizeData(measurement["measurements"], lowThreshold=threshold)
+@click.option("--channel", type=str, default=None,
+    help="Channel of a spectral measurement to show (name or index)")
+@click.option("--weights", type=ChannelWeights(), default=None,
+    help="Show a weighted combination of channels of a spectral measurement, e.g., 415nm=1,445nm=0.4")
+def visualize(input, output, title, show, threshold, channel, weights):
+    measurement = loadMeasurement(input)
+    data = normalizeData(selectChannel(measurement, channel, weights), lowThreshold=threshold)
     fig = go.Figure(data=[go.Surface(z=data)])
     fig.update_layout(title=title, autosize=True,
                   scene_aspectmode="manual", scene_aspectratio=dict(x=1, y=measurement["resolution"][1]/measurement["resolution"][0], z=0.1))
@@ -78,25 +150,30 @@ def lineIntersection(line1, line2):
     ])
     b = np.array([[rho1], [rho2]])
     try:
-        x0, y0 = np.linalg.solve(A, b)
+        x0, y0 = np.linalg.solve(A, b).flatten()
     except np.linalg.LinAlgError:
         return None
     x0, y0 = int(np.round(x0)), int(np.round(y0))
     return (x0, y0)
 
-def locateScreenAutomatic(image, threshold):
-    npImg = np.array(image)
+def locateScreenAutomatic(image: np.ndarray, threshold: float) -> List[Tuple[int, int]]:
+    """
+    Find corners of the screen in a normalized measurement. Returns a list of
+    corner candidates; the screen is found if there are exactly four.
+    """
+    npImg = np.asarray(image)
+    height, width = npImg.shape
     ret, thresholded = cv.threshold(npImg, threshold, 255, cv.THRESH_BINARY)
     thresholded = np.uint8(thresholded)
 
     contours, hierarchy = cv.findContours(thresholded, cv.RETR_TREE, cv.CHAIN_APPROX_SIMPLE)
 
     # We draw contours to find lines in the using Hough transform
-    countoursImg = np.zeros((len(image), len(image[0])), dtype=np.uint8)
+    countoursImg = np.zeros((height, width), dtype=np.uint8)
     cv.drawContours(countoursImg, contours, 0, 255,  1)
 
     # Detect the lines
-    lines = cv.HoughLines(countoursImg, 0.5, np.pi / 360, len(image[0]) // 5, None, 0, 0, 0, 3 / 4 * np.pi)
+    lines = cv.HoughLines(countoursImg, 0.5, np.pi / 360, width // 5, None, 0, 0, 0, 3 / 4 * np.pi)
     dbgImg1 = cv.cvtColor(countoursImg, cv.COLOR_GRAY2RGB)
 
     def thetaClose(a, b):
@@ -105,9 +182,9 @@ def locateScreenAutomatic(image, threshold):
     def rhoClose(a, b):
         return abs(a - b) < 10
 
+    strongLines = []
     if lines is not None:
         # Find strong lines
-        strongLines = []
         for line in lines:
             rho, theta = line[0][0], line[0][1]
             if any(rhoClose(rho, l[0]) and thetaClose(theta, l[1]) for l in strongLines):
@@ -126,17 +203,17 @@ def locateScreenAutomatic(image, threshold):
             cv.line(dbgImg1, pt1, pt2, (255,0,255), 1, cv.LINE_AA)
 
     intersections = [lineIntersection(l1, l2) for l1, l2 in itertools.product(strongLines, strongLines) if l1 != l2]
-    fitsInImage = lambda p: p[0] > 0 and p[0] <= len(image[0]) and p[1] > 0 and p[1] <= len(image)
+    fitsInImage = lambda p: p[0] > 0 and p[0] <= width and p[1] > 0 and p[1] <= height
     corners = list(set([x for x in intersections if x is not None and fitsInImage(x)]))
     return corners
 
 def originDistance(point):
     return point[0] ** 2 + point[1] ** 2
 
-def cropToScreen(image, corners, screenSize):
+def cropToScreen(image: np.ndarray, corners, screenSize: Tuple[int, int]) -> np.ndarray:
     assert len(corners) == 4
 
-    npImg = np.array(image)
+    npImg = np.asarray(image)
 
     sortedCorners = sorted(corners, key=originDistance)
     expected = sorted([(0, 0), (0, screenSize[1]), (screenSize[0], 0), screenSize],
@@ -149,7 +226,7 @@ def cropToScreen(image, corners, screenSize):
 @click.argument("output", type=click.Path())
 @click.option("--measurement", type=click.Path(exists=True, file_okay=True, dir_okay=False),
     required=True,
-    help="The full-screen measurement JSON file")
+    help="The full-screen measurement file (JSON or .drlcd)")
 @click.option("--min", type=int, required=True,
     help="The minimal brightness to compensate for")
 @click.option("--max", type=int, default=None,
@@ -162,16 +239,28 @@ def cropToScreen(image, corners, screenSize):
     help="The screen resolution in pixels")
 @click.option("--manual", is_flag=True,
     help="Locate screen manually")
-def compensate(output, measurement, min, max, by, cutoff, screen, manual):
+@click.option("--channel", type=str, default=None,
+    help="Channel of a spectral measurement to compensate for (name or index)")
+@click.option("--weights", type=ChannelWeights(), default=None,
+    help="Compensate for a weighted combination of channels of a spectral measurement, e.g., 415nm=1,445nm=0.4")
+def compensate(output, measurement, min, max, by, cutoff, screen, manual, channel, weights):
     """
     Build a compensation mask for a given LCD. Provide a full-screen measurement
     and screen resolution to build a PNG compensation mask that you can load
     into UVTools and apply it.
     """
-    with open(measurement) as f:
-        measurement = json.load(f)
-    data = normalizeData(measurement["measurements"])
+    measurement = loadMeasurement(measurement)
+    data = normalizeData(selectChannel(measurement, channel, weights))
+    map = buildCompensationMap(data, screen, min, max, by, cutoff, manual)
+    cv.imwrite(output, map)
 
+def buildCompensationMap(data: np.ndarray, screen: Tuple[int, int], low: float,
+                         high: Optional[float], by: float, cutoff: float=50,
+                         manual: bool=False) -> np.ndarray:
+    """
+    Build a compensation map of the given screen resolution from a normalized
+    measurement. Brightness between low and high is mapped to 0 to by.
+    """
     corners = []
     if not manual:
         corners = locateScreenAutomatic(data, cutoff)
@@ -180,10 +269,7 @@ def compensate(output, measurement, min, max, by, cutoff, screen, manual):
         corners = locateScreenManually(data)
 
     map = cropToScreen(data, corners, screen)
-    if max is None:
-        max = np.max(map)
-    map = np.clip(map - min, 0, max - min) * by / (max - min)
-    map = cv.rotate(map, cv.ROTATE_180)
-    cv.imwrite(output, map)
-
-
+    if high is None:
+        high = np.max(map)
+    map = np.clip(map - low, 0, high - low) * by / (high - low)
+    return cv.rotate(map, cv.ROTATE_180)
@@ -0,0 +1,124 @@
+import json
+import os
+from typing import Any, Dict, List, Optional, Tuple
+
+class MeasurementJournal:
+    """
+    An append-only on-disk log of measured rows. The first line contains the
+    measurement parameters, each following line a single row. Every row is
+    flushed to the disk before the acquisition continues, so an interrupted
+    measurement can be resumed.
+
+    A measurement of several passes records the end of each pass together
+    with a state summarizing the finished passes; `rows` and `rowInfo` then
+    hold only the rows of the current pass. Parameters determined during the
+    acquisition are added to the header by `updateHeader`.
+    """
+    def __init__(self, path: str, header: Dict[str, Any], rows: Dict[int, List[Any]],
+                 rowInfo: Dict[int, Dict[str, Any]], validLength: int,
+                 passIndex: int=0, passState: Optional[Dict[str, Any]]=None) -> None:
+        self.path = path
+        self.header = header
+        self.rows = rows
+        self.rowInfo = rowInfo
+        self.passIndex = passIndex
+        self.passState = passState
+        self._file = open(path, "r+" if validLength > 0 else "w")
+        # Drop an incomplete record left by an interrupted write
+        self._file.truncate(validLength)
+        self._file.seek(validLength)
+
+    @staticmethod
+    def create(path: str, header: Dict[str, Any]) -> "MeasurementJournal":
+        journal = MeasurementJournal(path, header, {}, {}, 0)
+        journal._write(header)
+        return journal
+
+    @staticmethod
+    def resume(path: str) -> "MeasurementJournal":
+        header, rows, rowInfo, validLength, passIndex, passState = readJournal(path)
+        return MeasurementJournal(path, header, rows, rowInfo, validLength,
+                                  passIndex, passState)
+
+    def firstMissingRow(self) -> int:
+        y = 0
+        while y in self.rows:
+            y += 1
+        return y
+
+    def append(self, y: int, values: List[Any], info: Optional[Dict[str, Any]]=None) -> None:
+        """
+        Record a measured row with additional information about its acquisition
+        """
+        if info is None:
+            info = {}
+        self.rows[y] = values
+        self.rowInfo[y] = info
+        self._write({"row": y, "values": values, "info": info})
+
+    def updateHeader(self, fields: Dict[str, Any]) -> None:
+        """
+        Record additional measurement parameters
+        """
+        self.header.update(fields)
+        self._write({"header": fields})
+
+    def finishPass(self, state: Dict[str, Any]) -> None:
+        """
+        Record the end of the current pass with a state of the finished
+        passes; the next rows belong to the next pass
+        """
+        self.passIndex += 1
+        self.passState = state
+        self.rows = {}
+        self.rowInfo = {}
+        self._write({"pass": self.passIndex, "state": state})
+
+    def close(self) -> None:
+        self._file.close()
+
+    def remove(self) -> None:
+        self.close()
+        os.remove(self.path)
+
+    def _write(self, record: Dict[str, Any]) -> None:
+        self._file.write(json.dumps(record) + "\n")
+        self._file.flush()
+        os.fsync(self._file.fileno())
+
+def readJournal(path: str) -> Tuple[Dict[str, Any], Dict[int, List[Any]],
+                                    Dict[int, Dict[str, Any]], int, int,
+                                    Optional[Dict[str, Any]]]:
+    """
+    Read a journal. Return the header, the measured rows of the current pass,
+    information about the rows, the length of the valid part of the file,
+    the number of finished passes and the state recorded with the last one.
+    """
+    rows: Dict[int, List[Any]] = {}
+    rowInfo: Dict[int, Dict[str, Any]] = {}
+    header = None
+    validLength = 0
+    passIndex = 0
+    passState = None
+    with open(path) as f:
+        for line in f:
+            if not line.endswith("\n"):
+                break
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                break
+            if header is None:
+                header = record
+            elif "header" in record:
+                header.update(record["header"])
+            elif "pass" in record:
+                passIndex, passState = record["pass"], record["state"]
+                rows, rowInfo = {}, {}
+            else:
+                rows[record["row"]] = record["values"]
+                rowInfo[record["row"]] = record.get("info", {})
+            validLength += len(line.encode("utf-8"))
+    if header is None:
+        raise RuntimeError(f"Journal {path} is empty")
+    return header, rows, rowInfo, validLength, passIndex, passState
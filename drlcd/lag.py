@@ -0,0 +1,81 @@
+"""
+Correction of the directional sample lag of the fast acquisition.
+
+A sample of M6000 is not taken exactly at the center of its cell: the
+reading starts when the sensor enters the cell and the sensor integrates
+while moving, so the sample is taken a bit further along the scanning
+direction. Rows are scanned in both directions, so the samples of adjacent
+rows are shifted against each other, which shows as a zig-zag pattern
+growing with the feedrate. The lag is modeled as a constant time; at row
+velocity v (in cells per second), the samples of a row are shifted by
+lag * v cells in the scanning direction.
+"""
+
+from typing import List
+import numpy as np
+
+def rowShifts(reversedRows: np.ndarray, velocities: np.ndarray, lag: float) -> np.ndarray:
+    """
+    Return shift of the samples of each row in cells (positive to the right)
+    for given lag in seconds
+    """
+    direction = np.where(np.asarray(reversedRows), -1.0, 1.0)
+    return lag * np.asarray(velocities, dtype=np.float64) * direction
+
+def shiftRows(grid: np.ndarray, shifts: np.ndarray) -> np.ndarray:
+    """
+    Resample rows of the grid (rows, columns[, channels]) whose samples were
+    taken shifts[y] cells to the right of the cell centers back onto the cell
+    centers. Values beyond the ends of a row are clamped.
+    """
+    grid = np.asarray(grid, dtype=np.float64)
+    centers = np.arange(grid.shape[1], dtype=np.float64)
+    result = np.empty_like(grid)
+    for y, shift in enumerate(shifts):
+        row = grid[y].reshape(grid.shape[1], -1)
+        out = result[y].reshape(grid.shape[1], -1)
+        for c in range(row.shape[1]):
+            out[:, c] = np.interp(centers, centers + shift, row[:, c])
+    return result
+
+def estimateLag(grid: np.ndarray, reversedRows: List[bool], velocities: List[float],
+                maxShift: float=2, steps: int=81) -> float:
+    """
+    Estimate the directional lag in seconds from a grid of rows scanned in
+    alternating directions with given velocities (cells per second). The lag
+    is the one that best aligns adjacent rows scanned in opposite directions
+    (in the least squares sense), searched up to maxShift cells at the
+    fastest row and refined by a parabola fit. Returns 0 when the grid has
+    no such rows or is too narrow.
+    """
+    grid = np.asarray(grid, dtype=np.float64)
+    reversedRows = np.asarray(reversedRows)
+    velocities = np.asarray(velocities, dtype=np.float64)
+    pairs = np.flatnonzero(reversedRows[:-1] != reversedRows[1:])
+    margin = int(np.ceil(maxShift))
+    if len(pairs) == 0 or grid.shape[1] <= 2 * margin + 1 or velocities.max() <= 0:
+        return 0.0
+
+    limit = maxShift / velocities.max()
+    candidates = np.linspace(-limit, limit, steps)
+    costs = np.empty(steps)
+    for i, lag in enumerate(candidates):
+        shifted = shiftRows(grid, rowShifts(reversedRows, velocities, lag))
+        inner = shifted[:, margin:grid.shape[1] - margin]
+        costs[i] = np.mean((inner[pairs] - inner[pairs + 1]) ** 2)
+
+    best = int(np.argmin(costs))
+    if best == 0 or best == steps - 1:
+        return float(candidates[best])
+    left, center, right = costs[best - 1:best + 2]
+    curvature = left - 2 * center + right
+    offset = 0.5 * (left - right) / curvature if curvature > 0 else 0
+    return float(candidates[best] + offset * (candidates[1] - candidates[0]))
+
+def correctLag(grid: np.ndarray, reversedRows: List[bool], velocities: List[float],
+               lag: float) -> np.ndarray:
+    """
+    Move the samples of each row back onto the cell centers given the lag in
+    seconds, see `estimateLag`
+    """
+    return shiftRows(grid, rowShifts(np.asarray(reversedRows), velocities, lag))
@@ -1,59 +1,485 @@
+import binascii
+import queue
+import re
+import secrets
+import threading
+import time
+from collections import deque
 from contextlib import contextmanager
-from typing import Generator, List
+from typing import TYPE_CHECKING, Deque, Dict, Generator, List, NamedTuple, Optional, Tuple, Union
 from serial import Serial # type: ignore
 
+if TYPE_CHECKING:
+    from .session import SessionRecorder
+
+# Number of commands Marlin can hold in its command queue, see BUFSIZE in
+# fw/Marlin/Configuration_adv.h
+MARLIN_BUFSIZE = 4
+
+# Maximal number of unsolicited messages kept until they are consumed
+EVENT_QUEUE_SIZE = 1024
+
+# Binary sample frames (M6000 B1) start with this sync sequence followed by
+# sample count, its bitwise complement, count little-endian uint16 samples and
+# CRC-16/XMODEM of the count, complement and samples (little-endian). Marlin
+# outputs only ASCII text, so the sync sequence cannot appear in text lines.
+FRAME_SYNC = b"\xa5\x5a"
+FRAME_MAX_SAMPLES = 32
+# Sample value reporting a missed sample in a binary frame
+MISSED_SAMPLE = 0xFFFF
+
+# A line of text or the samples of a binary frame
+ResponseItem = Union[str, bytes]
+
+# The handshake probes the firmware with increasing period up to this value
+MAX_PROBE_INTERVAL = 1
+
+class MachineEvent(NamedTuple):
+    """
+    A message from the machine that is not a response to a command, e.g., boot
+    messages, echo messages or busy notifications.
+    """
+    kind: str # One of "echo", "busy", "error", "unsolicited"
+    line: str
+    timestamp: float
+
+def classifyLine(line: ResponseItem) -> str:
+    """
+    Classify a response line from Marlin as "ok", "busy", "echo", "error" or
+    "data". Binary frames are always "data".
+    """
+    if isinstance(line, bytes):
+        return "data"
+    if line.endswith("ok"):
+        return "ok"
+    if line.startswith("echo:busy") or line.startswith("busy:"):
+        return "busy"
+    if line.startswith("echo:"):
+        return "echo"
+    if line.startswith("Error:"):
+        return "error"
+    return "data"
+
+class LineFramer:
+    """
+    Split a stream of bytes into response lines and binary sample frames.
+    Frames are returned as the raw bytes of their samples. A frame with a
+    corrupted header or checksum is reported as an error line and the framer
+    looks for the next sync sequence.
+    """
+    def __init__(self) -> None:
+        self._buffer = bytearray()
+
+    def feed(self, data: bytes) -> List[ResponseItem]:
+        self._buffer += data
+        items: List[ResponseItem] = []
+        while True:
+            newline = self._buffer.find(b"\n")
+            sync = self._buffer.find(FRAME_SYNC, 0,
+                newline if newline != -1 else len(self._buffer))
+            if sync == -1:
+                if newline == -1:
+                    break
+                line = bytes(self._buffer[:newline])
+                del self._buffer[:newline + 1]
+                items.append(line.decode("utf-8", errors="replace").strip())
+                continue
+            if len(self._buffer) < sync + 4:
+                break
+            count, complement = self._buffer[sync + 2], self._buffer[sync + 3]
+            if count ^ complement != 0xFF or count > FRAME_MAX_SAMPLES:
+                items.append("Error:Corrupted sample frame")
+                del self._buffer[sync:sync + len(FRAME_SYNC)]
+                continue
+            end = sync + 4 + 2 * count + 2
+            if len(self._buffer) < end:
+                break
+            body = bytes(self._buffer[sync + 2:end - 2])
+            checksum = int.from_bytes(self._buffer[end - 2:end], "little")
+            if binascii.crc_hqx(body, 0) != checksum:
+                items.append("Error:Corrupted sample frame")
+                del self._buffer[sync:sync + len(FRAME_SYNC)]
+                continue
+            items.append(body[2:])
+            del self._buffer[sync:end]
+        return items
+
+def encodeSampleFrame(samples: List[int]) -> bytes:
+    """
+    Encode up to FRAME_MAX_SAMPLES uint16 samples into a binary sample frame
+    """
+    assert len(samples) <= FRAME_MAX_SAMPLES
+    body = bytes([len(samples), len(samples) ^ 0xFF])
+    body += b"".join(s.to_bytes(2, "little") for s in samples)
+    return FRAME_SYNC + body + binascii.crc_hqx(body, 0).to_bytes(2, "little")
+
+def gcodeChecksum(line: str) -> int:
+    """
+    Marlin checksum of a line: XOR of all its bytes
+    """
+    checksum = 0
+    for byte in line.encode("utf-8"):
+        checksum ^= byte
+    return checksum
+
+def numberedLine(number: int, command: str) -> str:
+    """
+    Return a command with a line number and a checksum
+    """
+    line = f"N{number} {command}"
+    return f"{line}*{gcodeChecksum(line)}"
+
+class Handshake:
+    """
+    Synchronization with the firmware after opening a connection. Each probe
+    resets the line numbering (in case a previous host used line numbers) and
+    asks the firmware to echo a unique token. Marlin processes commands in
+    order, so once the token of the latest probe is echoed back and
+    acknowledged, all stale responses (boot messages, responses to earlier
+    probes or to commands of a previous session) have been consumed. Probes
+    sent while the board boots are lost, so the probes are repeated until one
+    of them is answered. The handshake does no I/O, so it can be shared by
+    the blocking and the asyncio transport.
+    """
+    def __init__(self) -> None:
+        self.token: Optional[str] = None
+        self.synced = False
+        self.rebooted = False
+        self.probes = 0
+        self._tokenSeen = False
+
+    def probe(self) -> str:
+        """
+        Return a new probe to send
+        """
+        self.token = f"drlcd-sync-{secrets.token_hex(4)}"
+        self._tokenSeen = False
+        self.probes += 1
+        return f"{numberedLine(0, 'M110 N0')}\nM118 {self.token}\n"
+
+    def feed(self, line: ResponseItem) -> None:
+        """
+        Process a line received during the handshake
+        """
+        if isinstance(line, bytes):
+            return
+        if line == "start":
+            self.rebooted = True
+        elif line == self.token:
+            self._tokenSeen = True
+        elif self._tokenSeen and classifyLine(line) == "ok":
+            self.synced = True
+
+def parseFirmwareInfo(lines: List[ResponseItem]) -> Dict[str, str]:
+    """
+    Parse response of M115 into a dictionary. Capabilities are stored as
+    "Cap:<NAME>".
+    """
+    info = {}
+    for line in lines:
+        if not isinstance(line, str):
+            continue
+        if line.startswith("Cap:"):
+            name, _, value = line[len("Cap:"):].partition(":")
+            info[f"Cap:{name}"] = value
+            continue
+        for match in re.finditer(r"([A-Z_]+):(.*?)(?= [A-Z_]+:|$)", line):
+            info[match.group(1)] = match.group(2).strip()
+    return info
+
+class LinkStats:
+    """
+    Cumulative statistics of a connection: the traffic and the time the host
+    spent blocked waiting for the device (including the time the device
+    spent executing the commands).
+    """
+    def __init__(self) -> None:
+        self.commands = 0
+        self.bytesSent = 0
+        self.bytesReceived = 0
+        self.linesReceived = 0
+        self.waitTime = 0.0
+
+    def snapshot(self) -> Dict[str, float]:
+        return dict(vars(self))
+
+class PendingCommand:
+    """
+    A handle of a command issued via `Machine.send`. The response lines are
+    available once the machine acknowledges the command.
+    """
+    def __init__(self, machine: "Machine", command: str, timeout: float) -> None:
+        self._machine = machine
+        self.command = command
+        self.timeout = timeout
+        self.response: List[ResponseItem] = []
+        self.errors: List[str] = []
+        self.done = False
+
+    def result(self) -> List[ResponseItem]:
+        """
+        Wait for the command to complete and return its response lines
+        """
+        self._machine._waitFor(self)
+        return self.response
+
+class ResponseRouter:
+    """
+    Keeps track of the commands in flight and assigns response lines to them.
+    Marlin processes the commands in order, so a response always belongs to
+    the oldest command in flight. The router does no I/O, so it can be shared
+    by the blocking and the asyncio transport.
+    """
+    def __init__(self) -> None:
+        self.inFlight: Deque[PendingCommand] = deque()
+        self.lastActivity = time.monotonic()
+
+    def push(self, pending: PendingCommand) -> None:
+        if len(self.inFlight) == 0:
+            self.lastActivity = time.monotonic()
+        self.inFlight.append(pending)
+
+    def remaining(self) -> float:
+        """
+        Return how long can we wait for a response of the command being
+        executed before it times out.
+        """
+        return self.lastActivity + self.inFlight[0].timeout - time.monotonic()
+
+    def route(self, line: ResponseItem) -> Tuple[Optional[PendingCommand], Optional[MachineEvent]]:
+        """
+        Process a response line. Return the command it completed (if any) and
+        an event to report (if any).
+        """
+        now = time.monotonic()
+        kind = classifyLine(line)
+        if kind == "busy":
+            self.lastActivity = now
+            return None, MachineEvent(kind, line, now)
+        if kind == "echo":
+            return None, MachineEvent(kind, line, now)
+        if len(self.inFlight) == 0:
+            return None, MachineEvent("error" if kind == "error" else "unsolicited", line, now)
+        self.lastActivity = now
+        head = self.inFlight[0]
+        if kind == "ok":
+            if line[:-2] != "":
+                head.response.append(line[:-2])
+            head.done = True
+            self.inFlight.popleft()
+            return head, None
+        if kind == "error":
+            head.errors.append(line)
+            return None, MachineEvent(kind, line, now)
+        head.response.append(line)
+        return None, None
+
 class Machine:
-    def __init__(self, port: Serial) -> None:
+    """
+    Connection to the DrLCD device. A background thread reads the serial port,
+    splits the data into lines and assigns them to the commands in flight.
+    Messages that do not belong to any command are available in the `events`
+    queue. If a recorder is given, all data exchanged with the device are
+    recorded, see `drlcd.session`.
+    """
+    def __init__(self, port: Serial, maxInFlight: int=MARLIN_BUFSIZE,
+                 recorder: Optional["SessionRecorder"]=None) -> None:
         self._port = port
+        self._maxInFlight = maxInFlight
+        self._recorder = recorder
+        self._router = ResponseRouter()
+        self.stats = LinkStats()
+        self._condition = threading.Condition()
+        self._readerError: Optional[Exception] = None
+        self._running = True
+        self._handshake: Optional[Handshake] = None
+        self.events: "queue.Queue[MachineEvent]" = queue.Queue(EVENT_QUEUE_SIZE)
+        # Filled by the handshake
+        self.firmware: Dict[str, str] = {}
+        self.rebooted = False
 
-    @contextmanager
-    def _preserveTimeout(self) -> Generator[None, None, None]:
-        originalTimeout = self._port.timeout
-        try:
-            yield
-        finally:
-            self._port.timeout = originalTimeout
+        self._port.timeout = 0.1
+        self._reader = threading.Thread(target=self._readLoop,
+            name="drlcd-serial-reader", daemon=True)
+        self._reader.start()
 
-    def waitForBoot(self) -> None:
+    def close(self) -> None:
         """
-        Wait for the board to boot up - that is there are no new info is echoed
+        Stop the reader thread. The port itself is not closed.
         """
-        with self.preserveTimeout():
-            self._port.timeout = 2
-            while True:
-                line = self._port.readline().decode("utf-8")
-                if line == "":
-                    return
+        self._running = False
+        self._reader.join()
 
-    def command(self, command: str, timeout: float=10) -> List[str]:
+    def handshake(self, timeout: float=15, probeInterval: float=0.2) -> Dict[str, str]:
         """
-        Issue G-code command, waits for completion and returns a list of
-        returned values (lines of response)
+        Synchronize with the firmware, see `Handshake`. Returns as soon as the
+        firmware answers; raises TimeoutError if it does not answer within
+        timeout. Afterwards, `rebooted` tells whether the board rebooted on
+        open. Returns (and stores in `firmware`) the firmware information.
+        """
+        with self._condition:
+            if len(self._router.inFlight) > 0:
+                raise RuntimeError("Cannot handshake with commands in flight")
+            handshake = Handshake()
+            self._handshake = handshake
+            try:
+                deadline = time.monotonic() + timeout
+                while not handshake.synced:
+                    now = time.monotonic()
+                    if now >= deadline:
+                        raise TimeoutError(f"The device does not respond ({handshake.probes} probes sent)")
+                    self._write(handshake.probe().encode("utf-8"))
+                    probeDeadline = min(now + probeInterval, deadline)
+                    probeInterval = min(1.5 * probeInterval, MAX_PROBE_INTERVAL)
+                    while not handshake.synced and time.monotonic() < probeDeadline:
+                        if self._readerError is not None:
+                            raise self._readerError
+                        self._condition.wait(probeDeadline - time.monotonic())
+            finally:
+                self._handshake = None
+        self.rebooted = handshake.rebooted
+        self.firmware = parseFirmwareInfo(self.command("M115"))
+        return self.firmware
+
+    def waitForBoot(self, quietPeriod: float=2) -> None:
+        """
+        Wait for the board to boot up - that is there are no new info is echoed.
+        Prefer `handshake`, which does not need a quiet period.
+        """
+        while True:
+            try:
+                self.events.get(timeout=quietPeriod)
+            except queue.Empty:
+                return
+
+    def send(self, command: str, timeout: float=10) -> PendingCommand:
+        """
+        Issue G-code command without waiting for its completion. Up to
+        maxInFlight commands are kept unacknowledged in the Marlin command
+        queue; when the queue is full, wait for the oldest command to
+        complete. The timeout limits how long can the command run without
+        the machine responding.
         """
         if not command.endswith("\n"):
             command += "\n"
-        with self._preserveTimeout():
-            # Clear pending data
-            self._port.timeout = None
-            self._port.read_all()
-            # Send command
-            self._port.write(command.encode("utf-8"))
-            # Wait for response
-            response = []
-            self._port.timeout = timeout
-            while True:
-                line = self._port.readline().decode("utf-8")
-                if line == "":
-                    raise TimeoutError(f"No response on command {command.strip()}")
-                line = line.strip()
-                if line.endswith("ok"):
-                    if line[:-2] != "":
-                        response.append(line[:-2])
-                    return response
-                response.append(line)
+        with self._condition:
+            while len(self._router.inFlight) >= self._maxInFlight:
+                self._waitForProgress()
+            pending = PendingCommand(self, command.strip(), timeout)
+            self._router.push(pending)
+            self._write(command.encode("utf-8"))
+            self.stats.commands += 1
+        return pending
+
+    def command(self, command: str, timeout: float=10) -> List[ResponseItem]:
+        """
+        Issue G-code command, waits for completion and returns a list of
+        returned values (lines of response)
+        """
+        return self.send(command, timeout).result()
+
+    def flush(self) -> None:
+        """
+        Wait for all issued commands to complete
+        """
+        with self._condition:
+            while len(self._router.inFlight) > 0:
+                self._waitForProgress()
+
+    def _waitFor(self, pending: PendingCommand) -> None:
+        with self._condition:
+            while not pending.done:
+                self._waitForProgress()
+
+    def _waitForProgress(self) -> None:
+        """
+        Wait until the reader thread receives a line. Raise TimeoutError when
+        the command being executed does not respond within its timeout. Has to
+        be called with the condition held.
+        """
+        if self._readerError is not None:
+            raise self._readerError
+        remaining = self._router.remaining()
+        if remaining <= 0:
+            raise TimeoutError(f"No response on command {self._router.inFlight[0].command}")
+        start = time.perf_counter()
+        self._condition.wait(remaining)
+        self.stats.waitTime += time.perf_counter() - start
 
+    def _write(self, data: bytes) -> None:
+        if self._recorder is not None:
+            self._recorder.sent(data)
+        self._port.write(data)
+        self.stats.bytesSent += len(data)
+
+    def _readLoop(self) -> None:
+        framer = LineFramer()
+        try:
+            while self._running:
+                data = self._port.read(max(1, self._port.in_waiting))
+                if len(data) == 0:
+                    continue
+                if self._recorder is not None:
+                    self._recorder.received(data)
+                self.stats.bytesReceived += len(data)
+                lines = framer.feed(data)
+                if len(lines) == 0:
+                    continue
+                with self._condition:
+                    self.stats.linesReceived += len(lines)
+                    for line in lines:
+                        if self._handshake is not None:
+                            self._handshake.feed(line)
+                            continue
+                        _, event = self._router.route(line)
+                        if event is not None:
+                            self._emit(event)
+                    self._condition.notify_all()
+        except Exception as e:
+            with self._condition:
+                self._readerError = e
+                self._condition.notify_all()
+
+    def _emit(self, event: MachineEvent) -> None:
+        try:
+            self.events.put_nowait(event)
+        except queue.Full:
+            pass
+
+
+def openPort(port: str) -> Serial:
+    """
+    Open a serial port. Port "sim:..." opens a virtual device, see
+    `drlcd.simulator.simulatorFromUrl`, port "replay:..." plays back a
+    recorded session, see `drlcd.session.replayFromUrl`.
+    """
+    if port.startswith("sim:"):
+        from .simulator import simulatorFromUrl
+        return simulatorFromUrl(port)
+    if port.startswith("replay:"):
+        from .session import replayFromUrl
+        return replayFromUrl(port)
+    return Serial(port)
 
 @contextmanager
-def machineConnection(port: str) -> Generator[Machine, None, None]:
-    with Serial(port) as s:
-        yield Machine(s)
+def machineConnection(port: str, maxInFlight: int=MARLIN_BUFSIZE,
+                      handshake: bool=True, record: Optional[str]=None) -> Generator[Machine, None, None]:
+    """
+    Open a connection to the device. Unless handshake is False, wait until the
+    firmware is ready, see `Machine.handshake`. If record is given, the
+    session is recorded into that file, see `drlcd.session`.
+    """
+    recorder = None
+    if record is not None:
+        from .session import SessionRecorder
+        recorder = SessionRecorder(record, port)
+    with openPort(port) as s:
+        machine = Machine(s, maxInFlight, recorder)
+        try:
+            if handshake:
+                machine.handshake()
+            yield machine
+        finally:
+            machine.close()
+            if recorder is not None:
+                recorder.close()
@@ -17,8 +17,8 @@ class ManualScreenLocator:
     def __init__(self, image, windowWidth=1024):
         pygame.init()
 
-        self._srcImg = image
-        self._srcSize = (len(image[0]), len(image))
+        self._srcImg = np.asarray(image)
+        self._srcSize = (self._srcImg.shape[1], self._srcImg.shape[0])
         self._windowSize = (windowWidth,
                             windowWidth / self._srcSize[0] * self._srcSize[1])
         self._img = self._prepareImg(self._srcImg)
@@ -31,7 +31,7 @@ class ManualScreenLocator:
         """
         Given a raw measurement image, convert it into pygame surface
         """
-        npImg = np.transpose(np.array(image))
+        npImg = np.transpose(image)
         npImg = (255 * npImg) / np.nanmax(npImg)
         w, h = npImg.shape
         rgbImg = np.empty((w, h, 3), dtype=np.uint8)
@@ -0,0 +1,32 @@
+from typing import Tuple
+import numpy as np
+
+def gridCenters(size: Tuple[float, float], resolution: Tuple[int, int]) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Return X and Y coordinates of the cell centers of a grid of given
+    resolution covering an area of given size.
+    """
+    xs = (np.arange(resolution[0]) + 0.5) * size[0] / resolution[0]
+    ys = (np.arange(resolution[1]) + 0.5) * size[1] / resolution[1]
+    return xs, ys
+
+def resampleRow(xs: np.ndarray, values: np.ndarray, size: float, count: int) -> np.ndarray:
+    """
+    Resample samples of a single row taken at positions xs onto count cell
+    centers of a row of given length. Samples falling into the same cell are
+    averaged, cells without a sample are linearly interpolated from the
+    neighboring ones.
+    """
+    xs = np.asarray(xs, dtype=np.float64)
+    values = np.asarray(values, dtype=np.float64)
+    cells = np.clip((xs * count / size).astype(int), 0, count - 1)
+    hits = np.bincount(cells, minlength=count)
+    sums = np.bincount(cells, weights=values, minlength=count)
+    centers = gridCenters((size, 1), (count, 1))[0]
+    covered = hits > 0
+    result = np.empty(count)
+    result[covered] = sums[covered] / hits[covered]
+    if not covered.all():
+        order = np.argsort(xs)
+        result[~covered] = np.interp(centers[~covered], xs[order], values[order])
+    return result
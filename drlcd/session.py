@@ -0,0 +1,208 @@
+"""
+Recording of serial sessions and their replay.
+
+`SessionRecorder` logs all data exchanged with the device. The log is a JSON
+lines file: a header object followed by records `[time, direction, data]`,
+where time is in seconds since the start of the session, direction is "tx"
+(host to device) or "rx" and data is a line (including the newline) decoded
+as Latin-1, so binary sample frames survive the round trip.
+
+`ReplaySerial` plays a recorded session back in place of the device. Use port
+"replay:<log>" (optionally followed by ",speedup=<factor>") wherever a serial
+port is expected and run the same measurement as when recording.
+"""
+
+import json
+import os
+import queue
+import re
+import threading
+import time
+from datetime import datetime
+from typing import Any, Dict, List, Optional, Tuple
+from .simulator import PipeSerial
+
+SESSION_FORMAT = "drlcd-session"
+SESSION_VERSION = 1
+
+# The handshake tokens are random, so they differ between the recording and
+# the replay, see `drlcd.machine.Handshake`
+HANDSHAKE_TOKEN = re.compile(r"drlcd-sync-[0-9a-f]+")
+
+# How long the replay waits for a command the host sent in the recording
+REPLAY_DIVERGENCE_TIMEOUT = 30
+
+class SessionRecorder:
+    """
+    Records the data exchanged with a device into a session log. Thread safe.
+    """
+    def __init__(self, path: str, port: str="") -> None:
+        self._file = open(path, "w")
+        self._lock = threading.Lock()
+        self._start = time.perf_counter()
+        self._pending = {"tx": bytearray(), "rx": bytearray()}
+        header = {
+            "format": SESSION_FORMAT,
+            "version": SESSION_VERSION,
+            "port": port,
+            "started": datetime.now().isoformat(timespec="seconds")
+        }
+        self._file.write(json.dumps(header) + "\n")
+
+    def __enter__(self) -> "SessionRecorder":
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+    def sent(self, data: bytes) -> None:
+        self._record("tx", data)
+
+    def received(self, data: bytes) -> None:
+        self._record("rx", data)
+
+    def close(self) -> None:
+        with self._lock:
+            if self._file.closed:
+                return
+            t = time.perf_counter() - self._start
+            for direction, buffer in self._pending.items():
+                if len(buffer) > 0:
+                    self._write(t, direction, bytes(buffer))
+            self._file.close()
+
+    def _record(self, direction: str, data: bytes) -> None:
+        t = time.perf_counter() - self._start
+        with self._lock:
+            buffer = self._pending[direction]
+            buffer += data
+            while True:
+                end = buffer.find(b"\n")
+                if end == -1:
+                    break
+                self._write(t, direction, bytes(buffer[:end + 1]))
+                del buffer[:end + 1]
+
+    def _write(self, t: float, direction: str, data: bytes) -> None:
+        self._file.write(json.dumps([round(t, 6), direction, data.decode("latin-1")]) + "\n")
+
+def loadSession(path: str) -> Tuple[Dict[str, Any], List[Tuple[float, str, bytes]]]:
+    """
+    Load a session log, return its header and records
+    """
+    with open(path) as f:
+        header = json.loads(f.readline())
+        if header.get("format") != SESSION_FORMAT:
+            raise RuntimeError(f"{path} is not a session log")
+        if header.get("version") != SESSION_VERSION:
+            raise RuntimeError(f"Unsupported version {header.get('version')} of session log {path}")
+        records = []
+        for line in f:
+            if line.strip() == "":
+                continue
+            t, direction, data = json.loads(line)
+            records.append((t, direction, data.encode("latin-1")))
+    return header, records
+
+class ReplaySerial(PipeSerial):
+    """
+    A stand-in for `serial.Serial` that plays back a recorded session. The
+    lines the host sends are checked against the recording. A received line
+    is delivered with the delay it had after the preceding sent line in the
+    recording (divided by speedup), so the timing of the device is reproduced
+    while the host runs at its own pace. Reading from the port raises
+    RuntimeError when the host diverges from the recording.
+    """
+    def __init__(self, path: str, speedup: float=1) -> None:
+        super().__init__()
+        self.header, self._records = loadSession(path)
+        self.speedup = speedup
+        self.error: Optional[Exception] = None
+        self._sent: "queue.Queue[Optional[bytes]]" = queue.Queue()
+        self._pendingInput = bytearray()
+        self._tokens: Dict[bytes, bytes] = {}
+        self._stop = threading.Event()
+        self._player = threading.Thread(target=self._play,
+            name="drlcd-replay", daemon=True)
+        self._player.start()
+
+    def _shutdown(self) -> None:
+        self._stop.set()
+        self._sent.put(None)
+        self._player.join()
+
+    def write(self, data: bytes) -> int:
+        self._pendingInput += data
+        while True:
+            end = self._pendingInput.find(b"\n")
+            if end == -1:
+                break
+            self._sent.put(bytes(self._pendingInput[:end + 1]))
+            del self._pendingInput[:end + 1]
+        return len(data)
+
+    def read(self, size: int=1) -> bytes:
+        data = super().read(size)
+        if len(data) == 0 and self.error is not None:
+            raise self.error
+        return data
+
+    def _play(self) -> None:
+        anchor = (0.0, time.monotonic())
+        for i, (t, direction, data) in enumerate(self._records):
+            if direction == "tx":
+                self._expect(i, data)
+                if self.error is not None:
+                    return
+                anchor = (t, time.monotonic())
+                continue
+            delay = (t - anchor[0]) / self.speedup - (time.monotonic() - anchor[1])
+            if delay > 0 and self._stop.wait(delay):
+                return
+            os.write(self._writeFd, self._substituteTokens(data))
+        self._expect(len(self._records), None)
+
+    def _expect(self, index: int, expected: Optional[bytes]) -> None:
+        """
+        Wait for the host to send a line and check it matches the expected
+        line. Expected None means the end of the recording.
+        """
+        try:
+            line = self._sent.get(timeout=REPLAY_DIVERGENCE_TIMEOUT)
+        except queue.Empty:
+            self.error = RuntimeError(f"Replay diverged at record {index + 1}: "
+                                      f"the host did not send {expected!r}")
+            return
+        if line is None or self._stop.is_set():
+            return
+        if expected is None:
+            self.error = RuntimeError(f"Replay diverged: the host sent {line!r} after the end of the recording")
+            return
+        expectedToken = HANDSHAKE_TOKEN.search(expected.decode("latin-1"))
+        actualToken = HANDSHAKE_TOKEN.search(line.decode("latin-1"))
+        if expectedToken is not None and actualToken is not None:
+            self._tokens[expectedToken.group(0).encode()] = actualToken.group(0).encode()
+            line = line.replace(actualToken.group(0).encode(), expectedToken.group(0).encode())
+        if line != expected:
+            self.error = RuntimeError(f"Replay diverged at record {index + 1}: "
+                                      f"expected {expected!r}, the host sent {line!r}")
+
+    def _substituteTokens(self, data: bytes) -> bytes:
+        for recorded, actual in self._tokens.items():
+            data = data.replace(recorded, actual)
+        return data
+
+def replayFromUrl(url: str) -> ReplaySerial:
+    """
+    Create a replay port from a port specification in the form
+    "replay:<session log>[,speedup=<factor>]"
+    """
+    assert url.startswith("replay:")
+    path, *items = url[len("replay:"):].split(",")
+    speedup = 1.0
+    for item in items:
+        key, _, value = item.partition("=")
+        if key.strip() != "speedup":
+            raise RuntimeError(f"Unknown replay option '{item}'")
+        speedup = float(value)
+    return ReplaySerial(path, speedup)
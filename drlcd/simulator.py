@@ -0,0 +1,667 @@
+"""
+A virtual DrLCD device for running the acquisition without the physical rig.
+
+The device emulates the subset of Marlin used by `drlcd.acquire` including
+motion timing, sensor integration time and serial link properties. It is
+connected via `VirtualSerial`, a stand-in for `serial.Serial`. Use port
+"sim:" (optionally followed by comma separated `key=value` options, see
+`simulatorFromUrl`) wherever a serial port is expected.
+
+The simulator needs a POSIX system as it uses a pipe to emulate the port.
+"""
+
+import array
+import fcntl
+import heapq
+import math
+import os
+import queue
+import select
+import termios
+import threading
+import time
+from typing import Callable, Dict, List, Optional, Tuple
+import numpy as np
+from scipy.ndimage import map_coordinates
+from .machine import encodeSampleFrame, FRAME_MAX_SAMPLES, MISSED_SAMPLE
+from .storage import loadMeasurement
+
+# Motion parameters, see fw/Marlin/Configuration.h
+ACCELERATION = 5000 # mm/s^2
+MAX_FEEDRATE = 18000 # mm/s (DEFAULT_MAX_FEEDRATE)
+HOMING_FEEDRATE = 20 # mm/s (HOMING_FEEDRATE_MM_M of Marlin is 20*60 mm/min)
+BLOCK_BUFFER_SIZE = 16
+
+# TSL2561 with 13 ms integration time needs 15 ms per reading, see
+# fw/Marlin/src/feature/drlcd/drlcd.h
+TSL2561_READ_TIME = 0.015
+# AS7341 with ATIME = ASTEP = 100 needs two integrations of ~28 ms per reading
+AS7341_READ_TIME = 0.06
+AS7341_CHANNELS = 12
+# Duration of a single iteration of the firmware idle loop
+LOOP_TICK = 0.0002
+
+class SimClock:
+    """
+    Simulated time. The simulation can run faster than real time.
+    """
+    def __init__(self, speedup: float=1) -> None:
+        self.speedup = speedup
+        self._origin = time.monotonic()
+
+    def now(self) -> float:
+        return (time.monotonic() - self._origin) * self.speedup
+
+    def toReal(self, duration: float) -> float:
+        return duration / self.speedup
+
+    def sleepUntil(self, t: float) -> None:
+        remaining = t - self.now()
+        if remaining > 0:
+            time.sleep(self.toReal(remaining))
+
+class Backlight:
+    """
+    Backlight intensity over the measured area given as a sampled image
+    spanning size[0]×size[1] millimeters.
+    """
+    def __init__(self, image: np.ndarray, size: Tuple[float, float]) -> None:
+        self.image = np.asarray(image, dtype=np.float64)
+        self.size = size
+
+    def at(self, x: float, y: float) -> float:
+        rows, cols = self.image.shape
+        col = x / self.size[0] * cols - 0.5
+        row = y / self.size[1] * rows - 0.5
+        return float(map_coordinates(self.image, [[row], [col]], order=1, mode="nearest")[0])
+
+    @staticmethod
+    def fromMeasurement(path: str) -> "Backlight":
+        """
+        Use an existing measurement as the backlight
+        """
+        measurement = loadMeasurement(path)
+        image = np.nan_to_num(np.array(measurement["measurements"], dtype=np.float64))
+        return Backlight(image, measurement["size"])
+
+def syntheticBacklight(size: Tuple[float, float], leds: Tuple[int, int]=(8, 5),
+                       intensity: float=3000, margin: float=6) -> Backlight:
+    """
+    Build a backlight consisting of a grid of LEDs behind a screen. The screen
+    is inset by margin millimeters; the frame around it is almost dark.
+    """
+    resolution = 2 # samples per millimeter
+    ys, xs = np.mgrid[0:size[1] * resolution, 0:size[0] * resolution] / resolution
+    spacing = (size[0] / leds[0], size[1] / leds[1])
+    sigma = 0.5 * max(spacing)
+    image = np.zeros_like(xs)
+    for i in range(leds[0]):
+        for j in range(leds[1]):
+            cx, cy = (i + 0.5) * spacing[0], (j + 0.5) * spacing[1]
+            image += np.exp(-((xs - cx) ** 2 + (ys - cy) ** 2) / (2 * sigma ** 2))
+    image *= intensity / np.max(image)
+
+    def edge(v, length):
+        return np.clip(np.minimum(v - margin, length - margin - v), 0, 1)
+    screen = np.minimum(edge(xs, size[0]), edge(ys, size[1]))
+    image = image * (0.02 + 0.98 * screen)
+    return Backlight(image, size)
+
+class Move:
+    """
+    A linear move with a trapezoidal velocity profile
+    """
+    def __init__(self, start: Tuple[float, float], end: Tuple[float, float],
+                 feedrate: float, startTime: float) -> None:
+        self.start = start
+        self.end = end
+        self.length = math.hypot(end[0] - start[0], end[1] - start[1])
+        self.velocity = min(feedrate / 60, MAX_FEEDRATE)
+        accelDistance = self.velocity ** 2 / ACCELERATION
+        if self.length < accelDistance:
+            self.accelTime = math.sqrt(self.length / ACCELERATION)
+            self.velocity = ACCELERATION * self.accelTime
+            self.cruiseTime = 0.0
+        else:
+            self.accelTime = self.velocity / ACCELERATION
+            self.cruiseTime = (self.length - accelDistance) / self.velocity
+        self.startTime = startTime
+        self.duration = 2 * self.accelTime + self.cruiseTime
+        self.endTime = startTime + self.duration
+
+    def progressAt(self, t: float) -> float:
+        """
+        Return traveled distance at given time
+        """
+        t = min(max(t - self.startTime, 0), self.duration)
+        accelDistance = ACCELERATION * self.accelTime ** 2 / 2
+        if t <= self.accelTime:
+            return ACCELERATION * t ** 2 / 2
+        t -= self.accelTime
+        if t <= self.cruiseTime:
+            return accelDistance + self.velocity * t
+        t = min(t - self.cruiseTime, self.accelTime)
+        return accelDistance + self.velocity * self.cruiseTime + \
+               self.velocity * t - ACCELERATION * t ** 2 / 2
+
+    def timeAt(self, distance: float) -> float:
+        """
+        Return time at which the move traveled given distance
+        """
+        distance = min(max(distance, 0), self.length)
+        accelDistance = ACCELERATION * self.accelTime ** 2 / 2
+        if distance <= accelDistance:
+            return self.startTime + math.sqrt(2 * distance / ACCELERATION)
+        distance -= accelDistance
+        cruiseDistance = self.velocity * self.cruiseTime
+        if distance <= cruiseDistance:
+            return self.startTime + self.accelTime + distance / self.velocity
+        distance = min(distance - cruiseDistance, accelDistance)
+        discriminant = max(self.velocity ** 2 - 2 * ACCELERATION * distance, 0)
+        t = (self.velocity - math.sqrt(discriminant)) / ACCELERATION
+        return self.startTime + self.accelTime + self.cruiseTime + t
+
+    def positionAt(self, t: float) -> Tuple[float, float]:
+        if self.length == 0:
+            return self.end
+        ratio = self.progressAt(t) / self.length
+        return (self.start[0] + ratio * (self.end[0] - self.start[0]),
+                self.start[1] + ratio * (self.end[1] - self.start[1]))
+
+def parseGcode(line: str) -> Tuple[str, Dict[str, float]]:
+    """
+    Split a G-code line into the command and its numeric parameters. Line
+    numbers, checksums and comments are ignored.
+    """
+    line = line.split(";")[0].split("*")[0].strip()
+    words = line.split()
+    if len(words) > 0 and words[0].startswith("N"):
+        words = words[1:]
+    if len(words) == 0:
+        return "", {}
+    command = words[0].upper()
+    params = {}
+    for word in words[1:]:
+        try:
+            params[word[0].upper()] = float(word[1:])
+        except ValueError:
+            continue
+    return command, params
+
+class SampleReporter:
+    """
+    Reports samples of M6000 and M6002 either as text lines or in binary
+    frames. A sample is a list of channel values or None for a missed one.
+    """
+    def __init__(self, device: "VirtualDrLcd", binary: bool, channels: int) -> None:
+        self.device = device
+        self.binary = binary
+        self.channels = channels
+        self._frame: List[int] = []
+
+    def report(self, values: Optional[List[int]]) -> None:
+        if not self.binary:
+            self.device._print("Missed" if values is None else " ".join(str(v) for v in values))
+            return
+        if values is None:
+            values = [MISSED_SAMPLE] * self.channels
+        else:
+            values = [min(v, MISSED_SAMPLE - 1) for v in values]
+        for value in values:
+            self._frame.append(value)
+            if len(self._frame) == FRAME_MAX_SAMPLES:
+                self.flush()
+
+    def flush(self) -> None:
+        if len(self._frame) > 0:
+            self.device._write(encodeSampleFrame(self._frame))
+            self._frame.clear()
+
+class VirtualDrLcd:
+    """
+    Emulation of the DrLCD firmware. The commands are processed in a separate
+    thread in simulated time.
+    """
+    def __init__(self, backlight: Backlight, clock: SimClock, noise: float=0.01,
+                 spikeRate: float=0.001, glitchRate: float=0.0,
+                 glitchDelay: float=0.03, bootTime: float=0,
+                 seed: Optional[int]=None, unsupported: Optional[List[str]]=None) -> None:
+        self.backlight = backlight
+        self.clock = clock
+        self.noise = noise
+        self.spikeRate = spikeRate
+        self.glitchRate = glitchRate
+        self.glitchDelay = glitchDelay
+        self._rng = np.random.default_rng(seed)
+        self._bootEnd = clock.now() + bootTime
+        self._moves: List[Move] = []
+        self._position = (0.0, 0.0)
+        self._feedrate = 3000.0
+        self._input: "queue.Queue[Optional[Tuple[float, str]]]" = queue.Queue()
+        self._output: Optional[Callable[[bytes], None]] = None
+        self._thread = threading.Thread(target=self._run,
+            name="drlcd-virtual-device", daemon=True)
+        self._handlers: Dict[str, Callable[[Dict[str, float], str], None]] = {
+            "G0": self._move,
+            "G1": self._move,
+            "G28": self._home,
+            "M17": self._nop,
+            "M18": self._nop,
+            "M84": self._nop,
+            "M110": self._nop,
+            "M400": self._synchronize,
+            "M115": self._firmwareInfo,
+            "M118": self._echo,
+            "M5500": self._readTsl2561,
+            "M5501": self._readAs7341,
+            "M6000": self._lineMeasurement,
+            "M6001": self._taggedMeasurement,
+            "M6002": self._pointMeasurement,
+        }
+        for command in unsupported or []:
+            self._handlers.pop(command, None)
+
+    def connect(self, output: Callable[[bytes], None]) -> None:
+        self._output = output
+        self._thread.start()
+        if self._bootEnd > self.clock.now():
+            self._input.put((self._bootEnd, ""))
+
+    def disconnect(self) -> None:
+        self._input.put(None)
+        self._thread.join()
+
+    def receive(self, arrival: float, line: str) -> None:
+        """
+        Receive a line from the host at given simulated time
+        """
+        self._input.put((arrival, line))
+
+    def _run(self) -> None:
+        while True:
+            item = self._input.get()
+            if item is None:
+                return
+            arrival, line = item
+            self.clock.sleepUntil(arrival)
+            if line == "":
+                self._print("start")
+                self._print("echo:Marlin DrLCD (virtual)")
+                continue
+            if arrival < self._bootEnd:
+                # The board does not listen while booting
+                continue
+            command, params = parseGcode(line)
+            if command == "":
+                continue
+            handler = self._handlers.get(command)
+            if handler is None:
+                self._print(f'echo:Unknown command: "{line.strip()}"')
+            else:
+                handler(params, line)
+            self._print("ok")
+
+    def _print(self, line: str) -> None:
+        self._write((line + "\n").encode("utf-8"))
+
+    def _write(self, data: bytes) -> None:
+        assert self._output is not None
+        self._output(data)
+
+    def _plannerEnd(self) -> float:
+        if len(self._moves) == 0:
+            return self.clock.now()
+        return max(self._moves[-1].endTime, self.clock.now())
+
+    def _positionAt(self, t: float) -> Tuple[float, float]:
+        for move in self._moves:
+            if t < move.endTime:
+                return move.positionAt(t)
+        return self._position
+
+    def _pruneMoves(self) -> None:
+        now = self.clock.now()
+        self._moves = [m for m in self._moves if m.endTime > now]
+
+    def _nop(self, params: Dict[str, float], line: str) -> None:
+        pass
+
+    def _move(self, params: Dict[str, float], line: str) -> None:
+        self._pruneMoves()
+        if len(self._moves) >= BLOCK_BUFFER_SIZE:
+            self.clock.sleepUntil(self._moves[0].endTime)
+            self._pruneMoves()
+        self._feedrate = params.get("F", self._feedrate)
+        target = (params.get("X", self._position[0]), params.get("Y", self._position[1]))
+        move = Move(self._position, target, self._feedrate, self._plannerEnd())
+        self._moves.append(move)
+        self._position = target
+
+    def _synchronize(self, params: Dict[str, float]=None, line: str="") -> None:
+        self.clock.sleepUntil(self._plannerEnd())
+        self._moves = []
+
+    def _home(self, params: Dict[str, float], line: str) -> None:
+        self._synchronize()
+        distance = math.hypot(*self._position)
+        self.clock.sleepUntil(self.clock.now() + distance / HOMING_FEEDRATE + 1)
+        self._position = (0.0, 0.0)
+
+    def _firmwareInfo(self, params: Dict[str, float], line: str) -> None:
+        self._print("FIRMWARE_NAME:Marlin DrLCD (virtual) SOURCE_CODE_URL:github.com/yaqwsx/DrLCD PROTOCOL_VERSION:1.0 MACHINE_TYPE:DrLCD EXTRUDER_COUNT:0")
+
+    def _echo(self, params: Dict[str, float], line: str) -> None:
+        self._print(line.split("*")[0].strip()[len("M118"):].strip())
+
+    def _sense(self, t: float, duration: float) -> float:
+        """
+        Read the sensor integrating over given interval
+        """
+        x, y = self._positionAt(t + duration / 2)
+        value = self.backlight.at(x, y)
+        value *= 1 + self._rng.normal(0, self.noise)
+        if self._rng.random() < self.spikeRate:
+            value *= self._rng.uniform(1.6, 3)
+        return max(0, round(value))
+
+    def _readTime(self, base: float) -> float:
+        if self._rng.random() < self.glitchRate:
+            return base + self.glitchDelay
+        return base
+
+    def _readTsl2561(self, params: Dict[str, float], line: str) -> None:
+        duration = self._readTime(TSL2561_READ_TIME)
+        value = self._sense(self.clock.now(), duration)
+        self.clock.sleepUntil(self.clock.now() + duration)
+        self._print(f"Data: {value:.2f}")
+
+    def _spectrum(self, t: float, duration: float) -> List[int]:
+        value = self._sense(t, duration)
+        # Rough response of the AS7341 channels to a 405 nm backlight
+        weights = [0.9, 0.35, 0.08, 0.03, 0.6, 0.01, 0.02, 0.01, 0.01, 0.01, 0.6, 0.01]
+        return [min(65535, int(value * w)) for w in weights]
+
+    def _readAs7341(self, params: Dict[str, float], line: str) -> None:
+        duration = self._readTime(AS7341_READ_TIME)
+        values = self._spectrum(self.clock.now(), duration)
+        self.clock.sleepUntil(self.clock.now() + duration)
+        self._print("Data: " + "".join(f" {v:.2f}" for v in values))
+
+    def _lineMeasurement(self, params: Dict[str, float], line: str) -> None:
+        self._synchronize()
+        samples = int(params.get("S", 0))
+        sensor = int(params.get("P", 0))
+        binary = params.get("B", 0) != 0
+        if "F" in params:
+            self._feedrate = params["F"]
+        target = (params.get("X", self._position[0]), params.get("Y", self._position[1]))
+        move = Move(self._position, target, self._feedrate, self.clock.now())
+        self._moves = [move]
+        self._position = target
+        if samples <= 0:
+            self._synchronize()
+            return
+
+        reporter = SampleReporter(self, binary, AS7341_CHANNELS if sensor == 1 else 1)
+        step = move.length / samples
+        halfStep = step / 2
+        t = move.startTime
+        lastMeasurement = 0
+        while lastMeasurement < samples:
+            progress = move.progressAt(t)
+            measurementNo = int((progress + halfStep) / step) if step > 0 else samples
+            measurementAdv = measurementNo - lastMeasurement
+            if measurementAdv > 1:
+                self.clock.sleepUntil(t)
+                for _ in range(measurementAdv):
+                    reporter.report(None)
+                t += LOOP_TICK
+            elif measurementAdv == 1:
+                values: Optional[List[int]] = None
+                if sensor == 0:
+                    duration = self._readTime(TSL2561_READ_TIME)
+                    values = [int(self._sense(t, duration))]
+                elif sensor == 1:
+                    duration = self._readTime(AS7341_READ_TIME)
+                    values = self._spectrum(t, duration)
+                else:
+                    self._print("Unknown sensor specified")
+                    duration = 0
+                t += duration
+                self.clock.sleepUntil(t)
+                if values is not None:
+                    reporter.report(values)
+            else:
+                nextSlot = move.timeAt((lastMeasurement + 0.5) * step)
+                t = max(t + LOOP_TICK, nextSlot)
+            lastMeasurement = measurementNo
+        reporter.flush()
+        self._synchronize()
+
+    def _pointMeasurement(self, params: Dict[str, float], line: str) -> None:
+        self._synchronize()
+        samples = int(params.get("S", 0))
+        sensor = int(params.get("P", 0))
+        binary = params.get("B", 0) != 0
+        if sensor not in (0, 1):
+            self._print("Unknown sensor specified")
+            return
+        start = self._position
+        target = (params.get("X", start[0]), params.get("Y", start[1]))
+        reporter = SampleReporter(self, binary, AS7341_CHANNELS if sensor == 1 else 1)
+        for i in range(samples):
+            ratio = i / (samples - 1) if samples > 1 else 0
+            self._move({
+                "X": start[0] + ratio * (target[0] - start[0]),
+                "Y": start[1] + ratio * (target[1] - start[1]),
+                "F": params.get("F", self._feedrate)
+            }, line)
+            self._synchronize()
+            t = self.clock.now()
+            if sensor == 0:
+                duration = self._readTime(TSL2561_READ_TIME)
+                values = [int(self._sense(t, duration))]
+            else:
+                duration = self._readTime(AS7341_READ_TIME)
+                values = self._spectrum(t, duration)
+            self.clock.sleepUntil(t + duration)
+            reporter.report(values)
+        reporter.flush()
+
+    def _taggedMeasurement(self, params: Dict[str, float], line: str) -> None:
+        self._synchronize()
+        sensor = int(params.get("P", 0))
+        if sensor != 0:
+            self._print("Unknown sensor specified")
+            return
+        if "F" in params:
+            self._feedrate = params["F"]
+        target = (params.get("X", self._position[0]), params.get("Y", self._position[1]))
+        move = Move(self._position, target, self._feedrate, self.clock.now())
+        self._moves = [move]
+        self._position = target
+
+        t = move.startTime
+        while t < move.endTime:
+            t += LOOP_TICK
+            duration = self._readTime(TSL2561_READ_TIME)
+            value = self._sense(t, duration)
+            before, after = move.positionAt(t), move.positionAt(t + duration)
+            x, y = (before[0] + after[0]) / 2, (before[1] + after[1]) / 2
+            timestamp = int(1000 * (t + duration / 2 - move.startTime))
+            t += duration
+            self.clock.sleepUntil(t)
+            self._print(f"{x:.3f} {y:.3f} {timestamp} {int(value)}")
+        self._synchronize()
+
+class PipeSerial:
+    """
+    Base of the stand-ins for `serial.Serial`. The data for the host are
+    written into a pipe, so the port supports `fileno` and can be watched by
+    an event loop. Subclasses implement `write` and `_shutdown`.
+    """
+    def __init__(self) -> None:
+        self.timeout: Optional[float] = None
+        self.is_open = True
+        self._readFd, self._writeFd = os.pipe()
+
+    def __enter__(self) -> "PipeSerial":
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+    def close(self) -> None:
+        if not self.is_open:
+            return
+        self.is_open = False
+        self._shutdown()
+        os.close(self._readFd)
+        os.close(self._writeFd)
+
+    def _shutdown(self) -> None:
+        pass
+
+    def fileno(self) -> int:
+        return self._readFd
+
+    @property
+    def in_waiting(self) -> int:
+        buffer = array.array("i", [0])
+        fcntl.ioctl(self._readFd, termios.FIONREAD, buffer)
+        return buffer[0]
+
+    def read(self, size: int=1) -> bytes:
+        deadline = None if self.timeout is None else time.monotonic() + self.timeout
+        data = bytearray()
+        while len(data) < size:
+            remaining = None if deadline is None else max(0, deadline - time.monotonic())
+            ready, _, _ = select.select([self._readFd], [], [], remaining)
+            if len(ready) == 0:
+                break
+            data += os.read(self._readFd, size - len(data))
+            if remaining == 0:
+                break
+        return bytes(data)
+
+class VirtualSerial(PipeSerial):
+    """
+    A stand-in for `serial.Serial` connected to a virtual device. The link
+    delivers data with given latency and at the speed given by the baudrate
+    (10 bits per byte).
+    """
+    def __init__(self, device: VirtualDrLcd, baudrate: int=115200,
+                 latency: float=0.001) -> None:
+        super().__init__()
+        self.device = device
+        self.clock = device.clock
+        self.baudrate = baudrate
+        self.latency = latency
+        self._condition = threading.Condition()
+        self._scheduled: List[Tuple[float, int, bytes]] = []
+        self._sequence = 0
+        self._toHostFree = 0.0
+        self._toDeviceFree = 0.0
+        self._pendingInput = bytearray()
+        self._delivery = threading.Thread(target=self._deliver,
+            name="drlcd-virtual-link", daemon=True)
+        self._delivery.start()
+        device.connect(self._fromDevice)
+
+    def _shutdown(self) -> None:
+        self.device.disconnect()
+        with self._condition:
+            self._condition.notify_all()
+        self._delivery.join()
+
+    def _transferTime(self, size: int) -> float:
+        return size * 10 / self.baudrate
+
+    def write(self, data: bytes) -> int:
+        now = self.clock.now()
+        self._toDeviceFree = max(now, self._toDeviceFree) + self._transferTime(len(data))
+        arrival = self._toDeviceFree + self.latency
+        self._pendingInput += data
+        while True:
+            end = self._pendingInput.find(b"\n")
+            if end == -1:
+                break
+            line = self._pendingInput[:end].decode("utf-8", errors="replace")
+            del self._pendingInput[:end + 1]
+            self.device.receive(arrival, line)
+        return len(data)
+
+    def _fromDevice(self, data: bytes) -> None:
+        now = self.clock.now()
+        self._toHostFree = max(now, self._toHostFree) + self._transferTime(len(data))
+        arrival = self._toHostFree + self.latency
+        with self._condition:
+            heapq.heappush(self._scheduled, (arrival, self._sequence, data))
+            self._sequence += 1
+            self._condition.notify_all()
+
+    def _deliver(self) -> None:
+        while True:
+            with self._condition:
+                while self.is_open and len(self._scheduled) == 0:
+                    self._condition.wait()
+                if not self.is_open:
+                    return
+                arrival, _, data = self._scheduled[0]
+                remaining = arrival - self.clock.now()
+                if remaining > 0:
+                    self._condition.wait(self.clock.toReal(remaining))
+                    continue
+                heapq.heappop(self._scheduled)
+            os.write(self._writeFd, data)
+
+def simulatorFromUrl(url: str) -> VirtualSerial:
+    """
+    Create a virtual device from a port specification in the form
+    "sim:key=value,key=value". The recognized keys are:
+
+    - backlight: measurement file used as the backlight image (a
+      synthetic backlight is used by default)
+    - size: size of the synthetic backlight in millimeters (default 202x130)
+    - baudrate: link speed (default 115200)
+    - latency: link latency in seconds (default 0.001)
+    - speedup: how many times faster than real time the simulation runs
+    - noise: relative sensor noise (default 0.01)
+    - spikes: probability of a faulty peak in a reading (default 0.001)
+    - glitches: probability that a sensor read takes longer (default 0)
+    - boot: time in seconds the device needs to boot up (default 0)
+    - seed: random seed
+    - unsupported: commands the virtual firmware does not implement separated
+      by '+' (e.g., M6001+M6002) to emulate an older firmware
+    """
+    assert url.startswith("sim:")
+    options: Dict[str, str] = {}
+    for item in url[len("sim:"):].split(","):
+        if item.strip() == "":
+            continue
+        if "=" not in item:
+            raise RuntimeError(f"Invalid simulator option '{item}'")
+        key, value = item.split("=", 1)
+        options[key.strip()] = value.strip()
+    known = {"backlight", "size", "baudrate", "latency", "speedup", "noise",
+             "spikes", "glitches", "boot", "seed", "unsupported"}
+    unknown = set(options.keys()) - known
+    if unknown:
+        raise RuntimeError(f"Unknown simulator options: {', '.join(sorted(unknown))}")
+
+    if "backlight" in options:
+        backlight = Backlight.fromMeasurement(options["backlight"])
+    else:
+        width, height = options.get("size", "202x130").split("x")
+        backlight = syntheticBacklight((float(width), float(height)))
+    clock = SimClock(float(options.get("speedup", 1)))
+    device = VirtualDrLcd(backlight, clock,
+        noise=float(options.get("noise", 0.01)),
+        spikeRate=float(options.get("spikes", 0.001)),
+        glitchRate=float(options.get("glitches", 0)),
+        bootTime=float(options.get("boot", 0)),
+        seed=int(options["seed"]) if "seed" in options else None,
+        unsupported=[c for c in options.get("unsupported", "").split("+") if c != ""])
+    return VirtualSerial(device,
+        baudrate=int(options.get("baudrate", 115200)),
+        latency=float(options.get("latency", 0.001)))
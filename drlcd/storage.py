@@ -0,0 +1,126 @@
+import json
+import struct
+from typing import Any, Dict
+import click
+import numpy as np
+
+# Binary measurement container:
+#
+# - 8 bytes magic (including the format version)
+# - 8 bytes little-endian length of the header
+# - JSON header with the measurement metadata and the array descriptions
+#   ({"metadata": {...}, "arrays": {name: {"dtype", "shape", "offset"}}})
+# - raw little-endian C-order array payloads aligned to ALIGNMENT bytes
+#
+# The arrays can be memory-mapped without parsing the whole file.
+MAGIC = b"DRLCD\x00\x01\x00"
+ALIGNMENT = 64
+BINARY_EXTENSION = ".drlcd"
+
+# Keys of a measurement that hold arrays
+ARRAY_KEYS = {"measurements", "variance", "uncorrectedMeasurements"}
+
+def _align(offset: int) -> int:
+    return (offset + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+
+def isBinaryMeasurement(path: str) -> bool:
+    if path.endswith(BINARY_EXTENSION):
+        return True
+    with open(path, "rb") as f:
+        return f.read(len(MAGIC)) == MAGIC
+
+def loadMeasurement(path: str, mmap: bool=True) -> Dict[str, Any]:
+    """
+    Load a measurement in either JSON or binary format. The arrays are
+    returned as NumPy arrays; binary measurements are memory-mapped unless
+    mmap is False.
+    """
+    if isBinaryMeasurement(path):
+        return loadBinaryMeasurement(path, mmap)
+    with open(path) as f:
+        measurement = json.load(f)
+    for key in ARRAY_KEYS & measurement.keys():
+        measurement[key] = np.array(measurement[key], dtype=np.float64)
+    return measurement
+
+def loadBinaryMeasurement(path: str, mmap: bool=True) -> Dict[str, Any]:
+    with open(path, "rb") as f:
+        magic = f.read(len(MAGIC))
+        if magic != MAGIC:
+            raise RuntimeError(f"{path} is not a DrLCD measurement")
+        headerLength, = struct.unpack("<Q", f.read(8))
+        header = json.loads(f.read(headerLength).decode("utf-8"))
+        measurement = dict(header["metadata"])
+        for name, desc in header["arrays"].items():
+            dtype = np.dtype(desc["dtype"])
+            shape = tuple(desc["shape"])
+            if mmap:
+                measurement[name] = np.memmap(path, dtype=dtype, mode="r",
+                                              offset=desc["offset"], shape=shape)
+            else:
+                f.seek(desc["offset"])
+                count = int(np.prod(shape))
+                measurement[name] = np.fromfile(f, dtype=dtype, count=count).reshape(shape)
+    return measurement
+
+def saveMeasurement(path: str, measurement: Dict[str, Any]) -> None:
+    """
+    Save a measurement. The format is chosen by the extension: binary for
+    BINARY_EXTENSION, JSON otherwise.
+    """
+    if path.endswith(BINARY_EXTENSION):
+        saveBinaryMeasurement(path, measurement)
+        return
+    serializable = {
+        key: np.asarray(value).tolist() if isinstance(value, np.ndarray) else value
+        for key, value in measurement.items()
+    }
+    with open(path, "w") as f:
+        json.dump(serializable, f)
+
+def saveBinaryMeasurement(path: str, measurement: Dict[str, Any]) -> None:
+    metadata = {}
+    arrays = {}
+    for key, value in measurement.items():
+        if key in ARRAY_KEYS or isinstance(value, np.ndarray):
+            value = np.asarray(value)
+            arrays[key] = np.ascontiguousarray(value, dtype=value.dtype.newbyteorder("<"))
+        else:
+            metadata[key] = value
+
+    # The offsets depend on the header length, so we iterate until the header
+    # fits
+    headerLength = 0
+    while True:
+        offset = _align(len(MAGIC) + 8 + headerLength)
+        descriptions = {}
+        for name, array in arrays.items():
+            descriptions[name] = {
+                "dtype": array.dtype.str,
+                "shape": list(array.shape),
+                "offset": offset
+            }
+            offset = _align(offset + array.nbytes)
+        header = json.dumps({"metadata": metadata, "arrays": descriptions}).encode("utf-8")
+        if len(header) <= headerLength:
+            break
+        headerLength = len(header)
+    header = header.ljust(headerLength)
+
+    with open(path, "wb") as f:
+        f.write(MAGIC)
+        f.write(struct.pack("<Q", headerLength))
+        f.write(header)
+        for name, array in arrays.items():
+            f.seek(descriptions[name]["offset"])
+            f.write(array.tobytes())
+
+@click.command()
+@click.argument("input", type=click.Path(exists=True, file_okay=True, dir_okay=False))
+@click.argument("output", type=click.Path())
+def convert(input, output):
+    """
+    Convert a measurement between JSON and binary (.drlcd) format. The format
+    is given by the extension of the output.
+    """
+    saveMeasurement(output, loadMeasurement(input, mmap=False))
@@ -0,0 +1,99 @@
+import json
+import sys
+import time
+from typing import Any, Dict, List, Optional, TextIO, Tuple
+from .machine import Machine
+
+def formatDuration(seconds: float) -> str:
+    seconds = int(round(seconds))
+    if seconds >= 3600:
+        return f"{seconds // 3600}:{seconds // 60 % 60:02d}:{seconds % 60:02d}"
+    return f"{seconds // 60}:{seconds % 60:02d}"
+
+class AcquisitionTelemetry:
+    """
+    Collects per-row metrics of an acquisition: duration, retries, effective
+    feedrate, sample rate, ETA and the serial link breakdown (the time the
+    host waited for the device vs. the time it spent on its own, traffic).
+    Each row is written as a JSON object into the metrics file (if given)
+    and summarized on a single line of the progress stream (if given).
+    Use `rowFinished` as (or from) the onRow callback of the acquisition.
+    The ETA covers all passes, starting with passIndex.
+    """
+    def __init__(self, machine: Machine, resolution: Tuple[int, int], startRow: int=0,
+                 metricsPath: Optional[str]=None,
+                 progress: Optional[TextIO]=sys.stdout,
+                 passes: int=1, passIndex: int=0) -> None:
+        self.machine = machine
+        self.resolution = resolution
+        self.passes = passes
+        self.progress = progress
+        self._metrics = open(metricsPath, "a") if metricsPath is not None else None
+        self._start = time.perf_counter()
+        self._last = self._start
+        self._lastStats = machine.stats.snapshot()
+        self._remaining = (passes - passIndex) * resolution[1] - startRow
+        self._rows = 0
+        self._samples = 0
+
+    def __enter__(self) -> "AcquisitionTelemetry":
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+    def close(self) -> None:
+        if self._metrics is not None:
+            self._metrics.close()
+            self._metrics = None
+
+    def rowFinished(self, y: int, values: List[Any], info: Dict[str, Any]) -> Dict[str, Any]:
+        """
+        Record a finished row, return its metrics
+        """
+        now = time.perf_counter()
+        duration = now - self._last
+        stats = self.machine.stats.snapshot()
+        link = {key: stats[key] - self._lastStats[key] for key in stats}
+        self._last, self._lastStats = now, stats
+        self._rows += 1
+        self._remaining -= 1
+        samples = info.get("samples", len(values))
+        self._samples += samples
+        elapsed = now - self._start
+        record = {
+            "row": y,
+            "pass": info.get("pass", 0),
+            "duration": duration,
+            "samples": samples,
+            "samplesPerSecond": samples / duration if duration > 0 else 0,
+            "feedrate": info.get("feedrate"),
+            "retries": info.get("retries", 0),
+            "missed": info.get("missed", 0),
+            "deviceWait": link["waitTime"],
+            "hostTime": max(duration - link["waitTime"], 0),
+            "commands": link["commands"],
+            "bytesSent": link["bytesSent"],
+            "bytesReceived": link["bytesReceived"],
+            "linesReceived": link["linesReceived"],
+            "elapsed": elapsed,
+            "eta": elapsed / self._rows * self._remaining
+        }
+        if self._metrics is not None:
+            self._metrics.write(json.dumps(record) + "\n")
+            self._metrics.flush()
+        if self.progress is not None:
+            self.progress.write(self.formatProgress(record) + "\n")
+            self.progress.flush()
+        return record
+
+    def formatProgress(self, record: Dict[str, Any]) -> str:
+        feedrate = f", F{record['feedrate']:.0f}" if record["feedrate"] is not None else ""
+        retries = f", {record['retries']} retries" if record["retries"] > 0 else ""
+        wait = record["deviceWait"] / record["duration"] if record["duration"] > 0 else 0
+        row = f"Row {record['row'] + 1}/{self.resolution[1]}"
+        if self.passes > 1:
+            row = f"Pass {record['pass'] + 1}/{self.passes}, row {record['row'] + 1}/{self.resolution[1]}"
+        return (f"{row}: {record['duration']:.1f} s, "
+                f"{record['samplesPerSecond']:.1f} samples/s{feedrate}{retries}, "
+                f"{wait:.0%} waiting for device, ETA {formatDuration(record['eta'])}")
@@ -1,15 +1,23 @@
 import click
 
 from .acquire import measureLcd
+from .bench import benchLink
+from .daemon import daemon
+from .fleet import measureFleet
 from .image import visualize, compensate
+from .storage import convert
 
 @click.group()
 def cli():
     pass
 
 cli.add_command(measureLcd)
+cli.add_command(measureFleet)
+cli.add_command(daemon)
+cli.add_command(benchLink)
 cli.add_command(visualize)
 cli.add_command(compensate)
+cli.add_command(convert)
 
 if __name__ == "__main__":
     cli()
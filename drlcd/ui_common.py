@@ -1,5 +1,5 @@
 import click
-from typing import Optional, Tuple
+from typing import Dict, Optional, Tuple
 
 class Resolution(click.ParamType):
     """
@@ -20,3 +20,22 @@ class Resolution(click.ParamType):
             return tuple([int(x) for x in splitted])
         except ValueError as e:
             self.fail("Invalid number specified")
+
+class ChannelWeights(click.ParamType):
+    """
+    A CLI argument type for a weighted combination of sensor channels.
+    Comma separated list of `channel=weight` pairs, e.g., `415nm=1,445nm=0.4`.
+    """
+    name = "channel weights"
+
+    def convert(self, value: str, param: Optional[click.Parameter], ctx: click.Context) -> Dict[str, float]:
+        weights = {}
+        for item in value.split(","):
+            splitted = item.split("=")
+            if len(splitted) != 2:
+                self.fail(f"'{item}' is not a channel=weight pair", param, ctx)
+            try:
+                weights[splitted[0].strip()] = float(splitted[1])
+            except ValueError:
+                self.fail(f"Invalid weight of channel {splitted[0].strip()}", param, ctx)
+        return weights
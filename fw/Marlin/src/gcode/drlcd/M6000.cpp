@@ -10,11 +10,24 @@ void measureAndReportTSL2561() {
     SERIAL_ECHO("\n");
 }
 
+void measureAndReportAS7341() {
+    auto values = DR_LCD.readAS7341();
+    for (int i = 0; i != int(values.size()); i++) {
+        if (i != 0)
+            SERIAL_ECHO(" ");
+        SERIAL_ECHO(values[i]);
+    }
+    SERIAL_ECHO("\n");
+}
+
 void measureAndReport(int sensorType) {
     switch (sensorType) {
         case 0:
             measureAndReportTSL2561();
             break;
+        case 1:
+            measureAndReportAS7341();
+            break;
         default:
             SERIAL_ECHO("Unknown sensor specified\n");
     }
@@ -24,13 +37,86 @@ void reportMeasurementMiss() {
     SERIAL_ECHO("Missed\n");
 }
 
+/**
+ * Binary sample frames (M6000 B1). A frame consists of:
+ *
+ * - sync bytes 0xA5 0x5A
+ * - number of samples N (at most FRAME_MAX_SAMPLES) and its bitwise complement
+ * - N little-endian uint16 values, 0xFFFF for a missed sample. A sample of a
+ *   multi-channel sensor consists of one value per channel and it can span
+ *   several frames.
+ * - little-endian CRC-16/XMODEM of the count, its complement and the samples
+ */
+constexpr int FRAME_MAX_SAMPLES = 32;
+constexpr uint16_t MISSED_SAMPLE = 0xFFFF;
+
+struct SampleFrame {
+    uint16_t samples[FRAME_MAX_SAMPLES];
+    int count = 0;
+};
+
+uint16_t crc16Update(uint16_t crc, uint8_t byte) {
+    crc ^= uint16_t(byte) << 8;
+    for (int i = 0; i != 8; i++)
+        crc = (crc & 0x8000) ? (crc << 1) ^ 0x1021 : crc << 1;
+    return crc;
+}
+
+void sendByte(uint8_t byte, uint16_t& crc) {
+    SERIAL_CHAR(byte);
+    crc = crc16Update(crc, byte);
+}
+
+void flushFrame(SampleFrame& frame) {
+    if (frame.count == 0)
+        return;
+    uint16_t crc = 0;
+    SERIAL_CHAR(0xA5);
+    SERIAL_CHAR(0x5A);
+    sendByte(frame.count, crc);
+    sendByte(~frame.count, crc);
+    for (int i = 0; i != frame.count; i++) {
+        sendByte(frame.samples[i] & 0xFF, crc);
+        sendByte(frame.samples[i] >> 8, crc);
+    }
+    SERIAL_CHAR(crc & 0xFF);
+    SERIAL_CHAR(crc >> 8);
+    frame.count = 0;
+}
+
+void pushSample(SampleFrame& frame, uint16_t value) {
+    frame.samples[frame.count++] = value;
+    if (frame.count == FRAME_MAX_SAMPLES)
+        flushFrame(frame);
+}
+
+int sensorChannels(int sensorType) {
+    return sensorType == 1 ? 12 : 1;
+}
+
+void measureAndPush(int sensorType, SampleFrame& frame) {
+    switch (sensorType) {
+        case 0:
+            pushSample(frame, min(DR_LCD.readTSL2561(), int(MISSED_SAMPLE) - 1));
+            break;
+        case 1:
+            for (auto value : DR_LCD.readAS7341())
+                pushSample(frame, min(value, uint16_t(MISSED_SAMPLE - 1)));
+            break;
+        default:
+            SERIAL_ECHO("Unknown sensor specified\n");
+    }
+}
+
 /**
  * Makes a line move and performs measurements using a specified
  * sensor along the movement without stopping. It reports
  *
  * - P specifies the sensor:
  *   - 0 = TSL2561
+ *   - 1 = AS7341 (all 12 channels separated by space on a line)
  * - S specifies the number of samples (including start and end point)
+ * - B1 reports the samples in binary frames instead of text lines
  */
 void GcodeSuite::M6000() {
     planner.synchronize();
@@ -40,6 +126,8 @@ void GcodeSuite::M6000() {
     get_destination_from_command();
     int samples = parser.intval('S');
     int sensor = parser.intval('P');
+    bool binary = parser.intval('B') != 0;
+    SampleFrame frame;
 
     xy_pos_t direction = destination - startPoint;
     float length = direction.magnitude();
@@ -59,13 +147,113 @@ void GcodeSuite::M6000() {
         int measurementNo = (progress + half_step) * step_inv;
         int measurementAdv = measurementNo - lastMeasurement;
         if (measurementAdv > 1) {
-            for (int i = 0; i != measurementAdv; i++)
-                reportMeasurementMiss();
+            for (int i = 0; i != measurementAdv; i++) {
+                if (binary) {
+                    for (int c = 0; c != sensorChannels(sensor); c++)
+                        pushSample(frame, MISSED_SAMPLE);
+                } else
+                    reportMeasurementMiss();
+            }
         } else if (measurementAdv == 1) {
-            measureAndReport(sensor);
+            if (binary)
+                measureAndPush(sensor, frame);
+            else
+                measureAndReport(sensor);
         }
         lastMeasurement = measurementNo;
     }
+    flushFrame(frame);
 
     planner.synchronize();
 }
+
+void reportTaggedSample(xy_pos_t position, millis_t time, int value) {
+    SERIAL_ECHO_F(position.x, 3);
+    SERIAL_ECHO(" ");
+    SERIAL_ECHO_F(position.y, 3);
+    SERIAL_ECHO(" ");
+    SERIAL_ECHO(time);
+    SERIAL_ECHO(" ");
+    SERIAL_ECHO(value);
+    SERIAL_ECHO("\n");
+}
+
+/**
+ * Makes a line move and measures continuously using a specified sensor
+ * along the movement. Unlike M6000, the samples are not bound to fixed
+ * positions; every sample is reported together with the position of the
+ * sensor (average of positions at the start and the end of the reading)
+ * and the time since the start of the movement in milliseconds:
+ *
+ *   <x> <y> <time> <value>
+ *
+ * - P specifies the sensor:
+ *   - 0 = TSL2561
+ */
+void GcodeSuite::M6001() {
+    planner.synchronize();
+
+    get_destination_from_command();
+    int sensor = parser.intval('P');
+    if (sensor != 0) {
+        SERIAL_ECHO("Unknown sensor specified\n");
+        return;
+    }
+
+    prepare_line_to_destination();
+
+    millis_t start = millis();
+    while (planner.busy()) {
+        idle();
+        get_cartesian_from_steppers();
+        xy_pos_t before = cartes;
+        millis_t time = millis();
+        int value = DR_LCD.readTSL2561();
+        get_cartesian_from_steppers();
+        xy_pos_t after = cartes;
+        reportTaggedSample((before + after) * 0.5f, (time + millis()) / 2 - start, value);
+    }
+}
+
+/**
+ * Measures at evenly spaced points along a line, stopping at each of them:
+ * moves to the point, waits for the move to finish and takes a reading. A
+ * single command replaces a sequence of G1, M400 and M5500/M5501 per point.
+ * The samples are reported as in M6000.
+ *
+ * - P specifies the sensor:
+ *   - 0 = TSL2561
+ *   - 1 = AS7341 (all 12 channels separated by space on a line)
+ * - S specifies the number of points (including start and end point)
+ * - B1 reports the samples in binary frames instead of text lines
+ */
+void GcodeSuite::M6002() {
+    planner.synchronize();
+
+    xy_pos_t startPoint = current_position;
+
+    get_destination_from_command();
+    xy_pos_t endPoint = destination;
+    int samples = parser.intval('S');
+    int sensor = parser.intval('P');
+    bool binary = parser.intval('B') != 0;
+    if (sensor != 0 && sensor != 1) {
+        SERIAL_ECHO("Unknown sensor specified\n");
+        return;
+    }
+    SampleFrame frame;
+
+    for (int i = 0; i != samples; i++) {
+        float ratio = samples > 1 ? float(i) / (samples - 1) : 0.0f;
+        xy_pos_t point = startPoint + (endPoint - startPoint) * ratio;
+        destination.x = point.x;
+        destination.y = point.y;
+        prepare_line_to_destination();
+        planner.synchronize();
+        if (binary)
+            measureAndPush(sensor, frame);
+        else
+            measureAndReport(sensor);
+    }
+    flushFrame(frame);
+}
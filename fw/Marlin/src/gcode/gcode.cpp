@@ -1091,6 +1091,8 @@ void GcodeSuite::process_parsed_command(const bool no_ok/*=false*/) {
         case 5500: M5500(); break;
         case 5501: M5501(); break;
         case 6000: M6000(); break;
+        case 6001: M6001(); break;
+        case 6002: M6002(); break;
       #endif
 
       default: parser.unknown_command_warning(); break;
@@ -320,6 +320,10 @@
  * M999 - Restart after being stopped by error
  *
  * M5500 - Read luminosity data
+ * M5501 - Read spectral data
+ * M6000 - Measure at evenly spaced points along a line move
+ * M6001 - Measure continuously along a line move, report positions of samples
+ * M6002 - Measure at evenly spaced points along a line, stopping at each point
  *
  * D... - Custom Development G-code. Add hooks to 'gcode_D.cpp' for developers to test features. (Requires MARLIN_DEV_MODE)
  *        D576 - Set buffer monitoring options. (Requires BUFFER_MONITORING)
@@ -1247,6 +1251,8 @@ private:
     static void M5500();
     static void M5501();
     static void M6000();
+    static void M6001();
+    static void M6002();
   #endif
 
   static void T(const int8_t tool_index);
@@ -24,6 +24,7 @@ setuptools.setup(
     ],
     install_requires=[
         "click>=7.1",
+        "numpy>=1.23",
         "pyserial~=3.5",
         "opencv-python~=4.6",
         "scipy~=1.9",
@@ -0,0 +1,6 @@
+import pytest
+from drlcd.acquire import MeasurementJob
+
+@pytest.fixture
+def job(tmp_path) -> MeasurementJob:
+    return MeasurementJob(str(tmp_path / "measurement.json"), (40, 20), (20, 6))
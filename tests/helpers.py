@@ -0,0 +1,61 @@
+"""
+Helpers of the tests running the acquisition against the virtual device
+"""
+from typing import Any, Dict, Tuple
+from drlcd.acquire import MeasurementJob, openJournal, runMeasurement
+from drlcd.machine import machineConnection
+
+# The simulated time runs this many times faster than the real time; the
+# host-side timeouts are in real time
+SPEEDUP = 50
+
+def simPort(size: Tuple[int, int], **options) -> str:
+    """
+    Return a port of a virtual device with a synthetic backlight of given size
+    """
+    items = {"speedup": SPEEDUP, "seed": 1, "size": f"{size[0]}x{size[1]}", **options}
+    return "sim:" + ",".join(f"{key}={value}" for key, value in items.items())
+
+def measure(job: MeasurementJob, port: str, resume: bool=False) -> Dict[str, Any]:
+    """
+    Take a measurement like `drlcd measurelcd` without the progress output
+    """
+    with machineConnection(port) as machine:
+        job, journal = openJournal(job, resume)
+        try:
+            return runMeasurement(machine, job, journal, progress=None)
+        except Exception:
+            journal.close()
+            raise
+
+class Interrupted(Exception):
+    pass
+
+class InterruptingProgress:
+    """
+    A progress stream of `runMeasurement` that interrupts the measurement
+    after given number of rows
+    """
+    def __init__(self, rows: int) -> None:
+        self.rows = rows
+
+    def write(self, text: str) -> None:
+        self.rows -= 1
+        if self.rows == 0:
+            raise Interrupted()
+
+    def flush(self) -> None:
+        pass
+
+def interruptedMeasurement(job: MeasurementJob, port: str, rows: int) -> None:
+    """
+    Start a measurement and interrupt it after given number of rows
+    """
+    with machineConnection(port) as machine:
+        job, journal = openJournal(job)
+        try:
+            runMeasurement(machine, job, journal, progress=InterruptingProgress(rows))
+        except Interrupted:
+            pass
+        finally:
+            journal.close()
@@ -0,0 +1,105 @@
+import os
+import numpy as np
+import pytest
+from drlcd.acquire import fastMeasurement, getSensor, scanTimeout, taggedMeasurement, MeasurementJob
+from drlcd.machine import machineConnection, FRAME_MAX_SAMPLES
+from drlcd.storage import loadMeasurement
+from helpers import simPort, measure, interruptedMeasurement
+
+@pytest.mark.parametrize("options", [
+    {},
+    {"fast": True},
+    {"fast": True, "binary": True},
+    {"tagged": True},
+    {"batched": True},
+])
+def test_measurement(job, options):
+    job = job._replace(**options)
+    result = measure(job, simPort(job.size))
+    grid = np.asarray(loadMeasurement(job.output)["measurements"], dtype=np.float64)
+    assert grid.shape == (job.resolution[1], job.resolution[0])
+    assert not np.isnan(grid).any()
+    assert (grid > 0).all()
+    assert result["firmware"]["FIRMWARE_NAME"] != ""
+
+def test_slow_binary_row():
+    # A binary frame comes only after FRAME_MAX_SAMPLES samples, so at a slow
+    # feedrate there is no response for more than the default timeout
+    sensor = getSensor("TSL2561")
+    assert scanTimeout(2, 300, sensor, binary=True) > 60 * FRAME_MAX_SAMPLES * 2 / 300
+    # A frame of 12-channel samples ends with a partial one, so it spans
+    # three samples
+    assert scanTimeout(2, 300, getSensor("AS7625"), binary=True) >= 60 * 3 * 2 / 300
+    with machineConnection(simPort((80, 10))) as machine:
+        machine.command("G28")
+        rows = fastMeasurement(machine, (80, 10), (40, 2), sensor, 300, binary=True)
+    assert np.asarray(rows).shape == (2, 40)
+
+def test_failed_connection_leaves_no_journal(job):
+    with pytest.raises(RuntimeError):
+        measure(job, simPort(job.size, bogus=1))
+    assert not os.path.exists(job.output + ".journal")
+
+def test_resume(job):
+    job = job._replace(fast=True)
+    port = simPort(job.size)
+    interruptedMeasurement(job, port, 3)
+    measure(job, port, resume=True)
+    assert len(loadMeasurement(job.output)["measurements"]) == job.resolution[1]
+
+def test_resume_auto_feedrate(job):
+    job = job._replace(fast=True, autoFeedrate=True)
+    port = simPort(job.size)
+    interruptedMeasurement(job, port, 3)
+    # The resumed measurement takes the parameters from the journal
+    measure(job._replace(autoFeedrate=False), port, resume=True)
+    result = loadMeasurement(job.output)
+    assert result["plannedFeedrate"] > job.feedrate
+    assert min(result["rowFeedrates"]) > job.feedrate
+
+def test_tagged_row_info():
+    infos = []
+    with machineConnection(simPort((40, 20))) as machine:
+        machine.command("G28")
+        taggedMeasurement(machine, (40, 20), (20, 4), getSensor("TSL2561"), 3000,
+            onRow=lambda y, row, info: infos.append(info))
+    assert len(infos) == 4
+    for info in infos:
+        # The sensor moves along the row only
+        assert info["yDeviation"] < 0.01
+        assert info["sampleInterval"] > 0
+
+def test_tagged_without_m6001(job):
+    job = job._replace(tagged=True)
+    with pytest.raises(RuntimeError, match="M6001"):
+        measure(job, simPort(job.size, unsupported="M6001"))
+
+def test_batched_without_m6002(job):
+    job = job._replace(batched=True)
+    with pytest.raises(RuntimeError, match="M6002"):
+        measure(job, simPort(job.size, unsupported="M6002"))
+
+def test_fast_without_m6000(job):
+    job = job._replace(fast=True)
+    with pytest.raises(RuntimeError, match="Cannot scan row"):
+        measure(job, simPort(job.size, unsupported="M6000"))
+
+def test_passes(job):
+    job = job._replace(fast=True, passes=3, alternate=True)
+    result = measure(job, simPort(job.size))
+    assert result["passes"] == 3
+    assert np.asarray(result["variance"]).shape == (job.resolution[1], job.resolution[0])
+
+def test_adaptive(tmp_path):
+    job = MeasurementJob(str(tmp_path / "adaptive.json"),
+        (40, 40), (20, 20), adaptive=True)
+    result = measure(job, simPort(job.size))
+    assert np.asarray(result["measurements"]).shape == (20, 20)
+    assert result["adaptive"]["rows"] < 20
+    assert result["adaptive"]["estimatedSaving"] > 0
+
+def test_adaptive_falls_back_to_full_scan(tmp_path):
+    job = MeasurementJob(str(tmp_path / "adaptive.json"),
+        (40, 20), (20, 6), adaptive=True, coarseFactor=1)
+    result = measure(job, simPort(job.size))
+    assert result["adaptive"]["rows"] == 6
@@ -0,0 +1,21 @@
+import asyncio
+import numpy as np
+import pytest
+from drlcd.aioacquire import acquireMeasurementAsync
+from helpers import simPort
+
+@pytest.mark.parametrize("fast", [False, True])
+def test_async_measurement(fast):
+    result = asyncio.run(asyncio.wait_for(acquireMeasurementAsync(
+        simPort((40, 20)), (40, 20), (20, 4), fast=fast), 60))
+    grid = np.asarray(result["measurements"], dtype=np.float64)
+    assert grid.shape == (4, 20)
+    assert not np.isnan(grid).any()
+    assert (grid > 0).all()
+    if fast:
+        assert len(result["rowFeedrates"]) == 4
+
+def test_fast_without_m6000():
+    with pytest.raises(RuntimeError, match="Cannot scan row"):
+        asyncio.run(asyncio.wait_for(acquireMeasurementAsync(
+            simPort((40, 20), unsupported="M6000"), (40, 20), (20, 4), fast=True), 60))
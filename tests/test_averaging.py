@@ -0,0 +1,15 @@
+import numpy as np
+from drlcd.averaging import CellAccumulator
+
+def test_cell_accumulator():
+    rng = np.random.default_rng(0)
+    passes = rng.normal(100, 5, (4, 3, 5))
+    accumulator = CellAccumulator(3, 5)
+    for grid in passes:
+        for y, row in enumerate(grid):
+            accumulator.addRow(y, row.tolist())
+    assert np.allclose(accumulator.mean, passes.mean(axis=0))
+    assert np.allclose(accumulator.variance(), passes.var(axis=0, ddof=1))
+    restored = CellAccumulator(3, 5)
+    restored.restore(accumulator.state())
+    assert np.allclose(restored.variance(), accumulator.variance())
@@ -0,0 +1,46 @@
+import threading
+import pytest
+from drlcd.acquire import MeasurementJob
+from drlcd.daemon import DaemonServer, DeviceDaemon, daemonRequest, submitJob
+from drlcd.storage import loadMeasurement
+from helpers import simPort
+
+def test_device_stays_connected_and_homed(tmp_path):
+    device = DeviceDaemon(simPort((40, 20)))
+    try:
+        device.measure(MeasurementJob(str(tmp_path / "a.json"), (40, 20), (20, 4), fast=True))
+        machine = device._machine
+        assert device.homed
+        device.measure(MeasurementJob(str(tmp_path / "b.json"), (40, 20), (20, 4), fast=True))
+        assert device._machine is machine
+        assert device.status() == {"port": device.port, "connected": True, "homed": True, "jobs": 2}
+    finally:
+        device.disconnect()
+
+def test_failed_job_drops_connection(tmp_path):
+    device = DeviceDaemon(simPort((40, 20), unsupported="M6000"))
+    with pytest.raises(RuntimeError, match="Cannot scan row"):
+        device.measure(MeasurementJob(str(tmp_path / "a.json"), (40, 20), (20, 4), fast=True))
+    assert not device.status()["connected"]
+    assert not device.homed
+
+def test_submit_job(tmp_path):
+    path = str(tmp_path / "drlcd.sock")
+    device = DeviceDaemon(simPort((40, 20)))
+    with DaemonServer(path, device, idleRelease=600) as server:
+        def serve() -> None:
+            while server.running:
+                server.handle_request()
+        thread = threading.Thread(target=serve)
+        thread.start()
+        try:
+            job = MeasurementJob(str(tmp_path / "a.json"), (40, 20), (20, 4), fast=True)
+            assert submitJob(path, job)["output"] == job.output
+            assert len(loadMeasurement(job.output)["measurements"]) == 4
+            with pytest.raises(RuntimeError, match="The daemon failed"):
+                submitJob(path, job, resume=True)
+            assert daemonRequest(path, {"command": "status"})["jobs"] == 2
+        finally:
+            daemonRequest(path, {"command": "shutdown"})
+            thread.join()
+            device.disconnect()
@@ -0,0 +1,37 @@
+import json
+import os
+from click.testing import CliRunner
+from drlcd.acquire import MeasurementJob
+from drlcd.fleet import FleetJob, RigProgress, measureFleet, runRig
+from drlcd.storage import loadMeasurement
+from helpers import simPort
+
+def test_measure_fleet(tmp_path):
+    ports = [simPort((40, 20)), simPort((40, 20), seed=2)]
+    outputs = [str(tmp_path / f"{name}.json") for name in ["a", "b", "c"]]
+    specs = [
+        {"port": ports[0], "output": outputs[0], "size": "40x20", "resolution": "20x4", "fast": True},
+        {"port": ports[0], "output": outputs[1], "size": "40x20", "resolution": "20x4"},
+        {"port": ports[1], "output": outputs[2], "size": "40x20", "resolution": "20x4", "fast": True}
+    ]
+    jobs = tmp_path / "jobs.json"
+    jobs.write_text(json.dumps(specs))
+    result = CliRunner().invoke(measureFleet, [str(jobs), "--progress-period", "1"])
+    assert result.exit_code == 0, result.output
+    assert "3/3 jobs succeeded" in result.output
+    for output in outputs:
+        assert len(loadMeasurement(output)["measurements"]) == 4
+
+def test_failed_job_does_not_stop_rig(tmp_path):
+    port = simPort((40, 20))
+    jobs = [
+        # There is no journal to resume
+        FleetJob(port, MeasurementJob(str(tmp_path / "a.json"), (40, 20), (20, 4), fast=True), True),
+        FleetJob(port, MeasurementJob(str(tmp_path / "b.json"), (40, 20), (20, 4), fast=True))
+    ]
+    progress = RigProgress(port, len(jobs))
+    runRig(port, jobs, 4, progress)
+    assert progress.results[0].error is not None
+    assert progress.results[1].error is None
+    assert progress.results[1].samples == 80
+    assert os.path.exists(str(tmp_path / "b.json"))
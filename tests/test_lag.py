@@ -0,0 +1,18 @@
+import numpy as np
+import pytest
+from drlcd.lag import correctLag, estimateLag, rowShifts, shiftRows
+
+def test_lag_estimation():
+    xs = np.linspace(0, 4 * np.pi, 60)
+    truth = np.tile(np.sin(xs) + 2, (10, 1))
+    reversedRows = [y % 2 == 1 for y in range(10)]
+    velocities = [100.0] * 10
+    lag = 0.008
+    # The samples are taken later along the scanning direction
+    shifted = shiftRows(truth, -rowShifts(reversedRows, velocities, lag))
+    estimated = estimateLag(shifted, reversedRows, velocities)
+    assert estimated == pytest.approx(lag, abs=0.001)
+    corrected = correctLag(shifted, reversedRows, velocities, estimated)
+    inner = slice(3, -3)
+    assert np.abs(corrected[:, inner] - truth[:, inner]).max() < \
+        np.abs(shifted[:, inner] - truth[:, inner]).max() / 5
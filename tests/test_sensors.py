@@ -0,0 +1,23 @@
+import numpy as np
+import pytest
+from drlcd.acquire import getSensor, parseReadingLines
+from drlcd.machine import LineFramer, encodeSampleFrame
+
+def test_parse_reading_lines():
+    values = parseReadingLines(["Data: 12.5", "Missed", "7"], 1)
+    assert values[0] == 12.5 and np.isnan(values[1]) and values[2] == 7
+    spectral = parseReadingLines(["Data: " + " ".join(map(str, range(12))), "Missed"], 12)
+    assert spectral.shape == (2, 12)
+    assert np.isnan(spectral[1]).all()
+    with pytest.raises(ValueError):
+        parseReadingLines(["1 2"], 1)
+
+def test_text_and_binary_readings_agree():
+    sensor = getSensor("TSL2561")
+    samples = list(range(100, 170))
+    text = LineFramer().feed(b"".join(f"{s}\n".encode() for s in samples))
+    frames = LineFramer().feed(encodeSampleFrame(samples[:32]) + encodeSampleFrame(samples[32:64])
+                               + encodeSampleFrame(samples[64:]))
+    assert np.array_equal(sensor.interpretBatch(text), samples)
+    assert np.array_equal(sensor.interpretBatch(frames), samples)
+    assert np.array_equal(sensor.interpretBatch(text[:10] + frames[1:]), samples[:10] + samples[32:])
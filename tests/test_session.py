@@ -0,0 +1,24 @@
+import numpy as np
+import pytest
+from drlcd.acquire import getSensor, fastMeasurement
+from drlcd.machine import machineConnection
+from helpers import simPort
+
+def scan(port, record=None):
+    with machineConnection(port, record=record) as machine:
+        machine.command("G28")
+        return fastMeasurement(machine, (40, 20), (20, 4), getSensor("TSL2561"), 3000)
+
+def test_replay_reproduces_recording(tmp_path):
+    session = str(tmp_path / "session.jsonl")
+    recorded = scan(simPort((40, 20)), record=session)
+    replayed = scan(f"replay:{session},speedup=50")
+    assert np.array_equal(recorded, replayed)
+
+def test_replay_detects_divergence(tmp_path):
+    session = str(tmp_path / "session.jsonl")
+    scan(simPort((40, 20)), record=session)
+    with pytest.raises(RuntimeError, match="diverged"):
+        with machineConnection(f"replay:{session},speedup=50") as machine:
+            machine.command("G28")
+            fastMeasurement(machine, (40, 20), (10, 4), getSensor("TSL2561"), 3000)
@@ -0,0 +1,19 @@
+import numpy as np
+import pytest
+from drlcd.storage import loadMeasurement, saveMeasurement
+
+@pytest.mark.parametrize("name", ["measurement.json", "measurement.drlcd"])
+def test_storage_round_trip(tmp_path, name):
+    path = str(tmp_path / name)
+    measurement = {
+        "sensor": "TSL2561",
+        "size": [40, 20],
+        "resolution": [4, 2],
+        "measurements": [[1.0, 2.0, 3.0, 4.0], [5.0, 6.0, 7.0, 8.0]],
+        "variance": np.ones((2, 4))
+    }
+    saveMeasurement(path, measurement)
+    loaded = loadMeasurement(path)
+    assert np.array_equal(loaded["measurements"], measurement["measurements"])
+    assert np.array_equal(loaded["variance"], measurement["variance"])
+    assert loaded["sensor"] == "TSL2561"